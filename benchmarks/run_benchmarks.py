@@ -0,0 +1,356 @@
+"""
+Offline benchmarks of the collector, the predictor, the model metrics
+exporter and the training data preparation.
+
+Everything runs against synthetic data in a temporary directory, with
+local stand-ins for Prometheus and TF Serving, so no cluster is needed:
+
+    python benchmarks/run_benchmarks.py --days 1,7,30 --series 1,16
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --compare before.json --max-regression 0.25
+
+The stand-ins run in the same process as the code under test, so the
+absolute numbers include their own overhead. Compare runs with each
+other rather than with production.
+
+With --compare, every timing that got slower than the baseline by more
+than --max-regression is reported and the exit code is 1.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [
+    os.path.join(ROOT, 'cpu-usage', 'common'),
+    os.path.join(ROOT, 'cpu-usage', 'collector'),
+    os.path.join(ROOT, 'cpu-usage', 'predictor'),
+]
+
+from synthetic import SyntheticCpuUsage
+from stubs import StubPrometheus, StubTFServing
+from metrics_store import MetricsStore, RECORD_DTYPE
+from forecast_log import ForecastLog, FORECAST_DTYPE, COMPACTED_DIR
+
+logger = logging.getLogger(__name__)
+
+# Timings where larger is better, everything else is a duration
+THROUGHPUT_METRICS = {'ticks_per_second', 'samples_per_second'}
+
+
+def load_module(name, path):
+    """Import a module from a file whose name is not a valid module name, once"""
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return sys.modules[name]
+
+
+def percentiles(durations):
+    p50, p99 = np.percentile(durations, [50, 99])
+    return {'p50_seconds': float(p50), 'p99_seconds': float(p99)}
+
+
+def series_names(count):
+    return [f"cpu_usage_{i}" if i else "cpu_usage" for i in range(count)]
+
+
+def fill_store(store, names, start, end, step):
+    """
+    Write synthetic history for every series straight into the chunk files
+    and index them once at the end, instead of rewriting index.json for
+    every new chunk as append_many does.
+    """
+    for i, name in enumerate(names):
+        os.makedirs(os.path.join(store.root_path, name), exist_ok=True)
+        generator = SyntheticCpuUsage(seed=i)
+        for timestamps, values in generator.chunks(start, end, step, chunk_seconds=store.chunk_seconds):
+            records = np.empty(len(timestamps), dtype=RECORD_DTYPE)
+            records['timestamp'] = timestamps
+            records['value'] = values
+            with open(store.chunk_path(name, store.chunk_start(timestamps[0])), 'ab') as f:
+                f.write(records.tobytes())
+    store.rebuild_index()
+
+
+def bench_collector(workdir, n_series, ticks, backfill_days, step):
+    """Ticks per second of query + buffered write, and backfill throughput"""
+    import metrics_collector
+
+    queries = {name: f'sum(rate(container_cpu_usage_seconds_total{{pod="{name}"}}[5m]))' for name in series_names(n_series)}
+    with StubPrometheus() as prometheus:
+        collector = metrics_collector.MetricsCollector(
+            prom_url=prometheus.url,
+            storage_path=os.path.join(workdir, 'metrics'),
+            queries=queries,
+            query_interval=1,
+            legacy_csv_path=None,
+        )
+        start = int(time.time()) - ticks
+        began = time.perf_counter()
+        for i in range(ticks):
+            data = collector.query_prometheus(start + i)
+            collector.append_to_store(data)
+            collector.flush_if_due(start + i)
+        collector.writer.flush()
+        elapsed = time.perf_counter() - began
+        result = {'ticks_per_second': ticks / elapsed}
+
+        # Repair a store that is empty over backfill_days, with range queries of `step`
+        collector.query_interval = step
+        collector.gap_threshold = 3 * step
+        end = float(start)
+        began = time.perf_counter()
+        collector.backfill(start=end - backfill_days * 86400, end=end)
+        collector.writer.flush()
+        elapsed = time.perf_counter() - began
+        samples = sum(
+            len(collector.store.read_range(name, end - backfill_days * 86400, end)[0]) for name in queries
+        )
+        result['samples_per_second'] = samples / elapsed
+        collector.executor.shutdown()
+    return result
+
+
+def bench_predictor(workdir, n_series, days, iterations, step):
+    """Latency of one predictor iteration: tail new data, forecast every series, log the forecasts"""
+    import predictor as predictor_module
+
+    names = series_names(n_series)
+    store = MetricsStore(os.path.join(workdir, 'metrics'))
+    end = (int(time.time()) // 60 - iterations) * 60
+    fill_store(store, names, end - days * 86400, end, step)
+
+    with StubTFServing() as serving:
+        predictor = predictor_module.Predictor(
+            store_path=store.root_path,
+            forecast_log_path=os.path.join(workdir, 'forecasts'),
+            model_url=serving.predict_url(),
+            series=names,
+        )
+        began = time.perf_counter()
+        predictor.update_windows()
+        cold_start = time.perf_counter() - began
+
+        durations = []
+        generators = [SyntheticCpuUsage(seed=i) for i in range(n_series)]
+        for i in range(iterations):
+            minute = end + i * 60
+            timestamps = np.arange(minute, minute + 60, step, dtype=np.float64)
+            for name, generator in zip(names, generators):
+                store.append_many(name, timestamps, generator.values(timestamps))
+            began = time.perf_counter()
+            predictor.update_windows()
+            results = predictor.predict_next_60_minutes(names)
+            for name, (predictions, last_timestamp, model_version) in results.items():
+                predictor.save_predictions(predictions, last_timestamp, name, model_version)
+            durations.append(time.perf_counter() - began)
+        if len(results) != n_series:
+            raise RuntimeError(f"Forecast {len(results)} of {n_series} series")
+    return {'cold_start_seconds': cold_start, **percentiles(durations)}
+
+
+def write_forecast_history(log, series, start, end, generator):
+    """Write one forecast issue per minute in [start, end), as compacted hourly files"""
+    horizon = np.arange(1, 61) * 60
+    for hour in range(int(start // 3600) * 3600, int(end), 3600):
+        issues = np.arange(max(hour, start), min(hour + 3600, end), 60, dtype=np.float64)
+        if not len(issues):
+            continue
+        records = np.empty(len(issues) * len(horizon), dtype=FORECAST_DTYPE)
+        records['issue_time'] = np.repeat(issues, len(horizon))
+        records['target_time'] = records['issue_time'] + np.tile(horizon, len(issues))
+        records['value'] = generator.values(records['target_time'])
+        records['model_version'] = 1
+        log._write_atomic(os.path.join(log._dir(series, COMPACTED_DIR), f"{hour}.npy"), records)
+
+
+def bench_exporter(workdir, days, iterations, step):
+    """Time of the first (cold) and of the steady-state calculate_metrics calls"""
+    exporter = load_module(
+        'model_metrics_exporter',
+        os.path.join(ROOT, 'monitoring', 'model-metrics-exporter', 'model-metrics-exporter.py'),
+    )
+
+    store = MetricsStore(os.path.join(workdir, 'metrics'))
+    log = ForecastLog(os.path.join(workdir, 'forecasts'))
+    generator = SyntheticCpuUsage(seed=0)
+    end = (int(time.time()) // 60 - iterations - 1) * 60
+    fill_store(store, ['cpu_usage'], end - days * 86400, end, step)
+    write_forecast_history(log, 'cpu_usage', end - days * 86400, end, generator)
+
+    evaluator = exporter.StreamingEvaluator(store, log)
+    exported = set()
+    # calculate_metrics reports on stdout every call
+    with contextlib.redirect_stdout(io.StringIO()):
+        began = time.perf_counter()
+        exporter.calculate_metrics(evaluator, exported)
+        cold_start = time.perf_counter() - began
+
+        durations = []
+        for i in range(iterations):
+            minute = end + i * 60
+            timestamps = np.arange(minute, minute + 60, step, dtype=np.float64)
+            store.append_many('cpu_usage', timestamps, generator.values(timestamps))
+            targets = minute + np.arange(1, 61) * 60
+            log.append('cpu_usage', minute, targets, generator.values(targets), model_version=1)
+            began = time.perf_counter()
+            exporter.calculate_metrics(evaluator, exported)
+            durations.append(time.perf_counter() - began)
+    if evaluator.last_point is None:
+        raise RuntimeError("The exporter evaluated no minutes")
+    return {'cold_start_seconds': cold_start, **percentiles(durations)}
+
+
+def bench_prepare_data(workdir, n_series, days, step):
+    """
+    Time of prepare_data, the data preparation train_model runs on: from
+    scratch, with every partition cached, and after one new hour of data.
+    """
+    pipeline = load_module('mlops_pipeline', os.path.join(ROOT, 'kubeflow', 'kfp', 'mlops-pipeline.py'))
+    prepare_data = pipeline.prepare_data.python_func
+
+    names = series_names(n_series)
+    store = MetricsStore(os.path.join(workdir, 'metrics'))
+    end = (int(time.time()) // 3600 - 1) * 3600
+    fill_store(store, names, end - days * 86400, end, step)
+    options = {'hours_back': days * 24, 'series': ','.join(names), 'data_root': workdir}
+
+    result = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        began = time.perf_counter()
+        dataset_path = prepare_data(**options)
+        result['cold_seconds'] = time.perf_counter() - began
+
+        began = time.perf_counter()
+        prepare_data(**options)
+        result['cached_seconds'] = time.perf_counter() - began
+
+        fill_store(store, names, end, end + 3600, step)
+        began = time.perf_counter()
+        prepare_data(**options)
+        result['incremental_seconds'] = time.perf_counter() - began
+    result['rows'] = int(len(np.load(os.path.join(dataset_path, 'values.npy'))))
+    return result
+
+
+def run(args):
+    """Run the selected benchmarks over every size, returning one result per run"""
+    results = []
+
+    def record(benchmark, params, function, *function_args):
+        with tempfile.TemporaryDirectory(prefix='mlops-bench-') as workdir:
+            began = time.perf_counter()
+            try:
+                metrics = function(workdir, *function_args)
+            except Exception as e:
+                logger.error(f"{benchmark} {params} failed: {e}")
+                metrics = {'error': str(e)}
+        key = f"{benchmark}[{','.join(f'{k}={v}' for k, v in params.items())}]"
+        results.append({'key': key, 'benchmark': benchmark, 'params': params, 'metrics': metrics})
+        print(f"{key:<40} {format_metrics(metrics)} ({time.perf_counter() - began:.1f}s)", flush=True)
+
+    for n_series in args.series:
+        if 'collector' in args.only:
+            record('collector', {'series': n_series}, bench_collector,
+                   n_series, args.ticks, args.backfill_days, args.step)
+        for days in args.days:
+            if 'predictor' in args.only:
+                record('predictor', {'series': n_series, 'days': days}, bench_predictor,
+                       n_series, days, args.iterations, args.step)
+            if 'prepare_data' in args.only:
+                record('prepare_data', {'series': n_series, 'days': days}, bench_prepare_data,
+                       n_series, days, args.step)
+    if 'exporter' in args.only:
+        for days in args.days:
+            record('exporter', {'days': days}, bench_exporter, days, args.iterations, args.step)
+    return results
+
+
+def format_metrics(metrics):
+    if 'error' in metrics:
+        return f"error: {metrics['error']}"
+    parts = []
+    for name, value in metrics.items():
+        if name.endswith('_seconds'):
+            parts.append(f"{name[:-8]}={value * 1000:.1f}ms")
+        elif isinstance(value, float):
+            parts.append(f"{name}={value:.1f}")
+        else:
+            parts.append(f"{name}={value}")
+    return ' '.join(parts)
+
+
+def compare(results, baseline, max_regression):
+    """
+    List the timings that got worse than the baseline by more than max_regression.
+
+    Returns:
+        list: One message per regression
+    """
+    previous = {result['key']: result['metrics'] for result in baseline}
+    regressions = []
+    for result in results:
+        for name, value in result['metrics'].items():
+            before = previous.get(result['key'], {}).get(name)
+            if not isinstance(value, float) or not isinstance(before, float) or before <= 0:
+                continue
+            # Throughputs regress when they drop, durations when they grow
+            change = before / value - 1 if name in THROUGHPUT_METRICS else value / before - 1
+            if change > max_regression:
+                regressions.append(f"{result['key']} {name}: {before:.4g} -> {value:.4g} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', default='1,7,30', help='Comma-separated days of history to benchmark with')
+    parser.add_argument('--series', default='1,16', help='Comma-separated numbers of series')
+    parser.add_argument('--step', type=float, default=60, help='Seconds between two samples of the history')
+    parser.add_argument('--ticks', type=int, default=200, help='Collector ticks to time')
+    parser.add_argument('--backfill-days', type=float, default=1, help='Days of history the collector backfills')
+    parser.add_argument('--iterations', type=int, default=30, help='Predictor and exporter iterations to time')
+    parser.add_argument('--only', default='collector,predictor,exporter,prepare_data',
+                        help='Comma-separated benchmarks to run')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Allowed relative slowdown against --compare')
+    args = parser.parse_args()
+    args.days = [float(days) if '.' in days else int(days) for days in args.days.split(',')]
+    args.series = [int(n) for n in args.series.split(',')]
+    args.only = set(args.only.split(','))
+
+    # The components log every tick and every forecast
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    failed = [result['key'] for result in results if 'error' in result['metrics']]
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        failed.extend(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import abc
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from synthetic import SyntheticCpuUsage
+
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value):
+    """Parse a Prometheus step, either plain seconds ("15", "1.5") or a duration ("15s", "1m")"""
+    match = re.fullmatch(r'([0-9.]+)(ms|s|m|h|d)?', value)
+    if not match:
+        raise ValueError(f"Invalid duration: {value!r}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+class StubServer(abc.ABC):
+    """
+    Local HTTP server on a free port, served from a background thread.
+
+    Keep-alive connections are supported so pooled clients behave as they
+    do against the real services. Every response can be delayed by
+    `latency` seconds to mimic network and inference time.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, Nagle would hold the body back for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub._dispatch(self, 'GET')
+
+            def do_POST(self):
+                stub._dispatch(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _dispatch(self, handler, method):
+        with self._lock:
+            self.requests += 1
+        parsed = urlparse(handler.path)
+        params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        body = b''
+        length = int(handler.headers.get('Content-Length') or 0)
+        if length:
+            body = handler.rfile.read(length)
+            if handler.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+        try:
+            status, payload = self.handle(method, parsed.path, params, body)
+        except Exception as e:
+            status, payload = 400, {'error': str(e)}
+        if self.latency:
+            time.sleep(self.latency)
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    @abc.abstractmethod
+    def handle(self, method, path, params, body):
+        """Return (status code, JSON payload) for one request"""
+
+
+class StubPrometheus(StubServer):
+    """
+    Answer Prometheus instant and range queries from synthetic series.
+
+    Every distinct PromQL expression is its own SyntheticCpuUsage series,
+    seeded from the expression, so a collector with many queries gets as
+    many different series. Only the query, time, start, end and step
+    parameters are understood.
+    """
+
+    def __init__(self, latency=0.0, **generator_options):
+        super().__init__(latency)
+        self.generator_options = generator_options
+        self._generators = {}
+
+    def generator(self, query):
+        if query not in self._generators:
+            self._generators[query] = SyntheticCpuUsage(seed=zlib.crc32(query.encode()), **self.generator_options)
+        return self._generators[query]
+
+    def handle(self, method, path, params, body):
+        if path == '/api/v1/query':
+            timestamp = float(params.get('time') or time.time())
+            value = float(self.generator(params['query']).values([timestamp])[0])
+            result = [{'metric': {}, 'value': [timestamp, repr(value)]}]
+            return 200, {'status': 'success', 'data': {'resultType': 'vector', 'result': result}}
+        if path == '/api/v1/query_range':
+            start, end = float(params['start']), float(params['end'])
+            step = parse_duration(params['step'])
+            if (end - start) / step > 11000:
+                return 400, {'status': 'error', 'error': 'exceeded maximum resolution of 11,000 points per timeseries'}
+            timestamps, values = self.generator(params['query']).generate(start, end + step / 2, step)
+            result = [{'metric': {}, 'values': [[t, repr(v)] for t, v in zip(timestamps.tolist(), values.tolist())]}]
+            return 200, {'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}
+        return 404, {'status': 'error', 'error': f'unknown path {path}'}
+
+
+class StubTFServing(StubServer):
+    """
+    Answer TF Serving REST predict and model status requests.
+
+    The forecast repeats the last input value over the horizon and is
+    tagged with the version, like the exported models do. Requests are
+    validated like the real model would: instances of shape (N, 60, 1).
+    """
+
+    def __init__(self, model_name='cpu-usage-forecaster', version=1, horizon=60, latency=0.0):
+        super().__init__(latency)
+        self.model_name = model_name
+        self.version = version
+        self.horizon = horizon
+        self.instances = 0
+
+    def predict_url(self):
+        return f"{self.url}/v1/models/{self.model_name}:predict"
+
+    def handle(self, method, path, params, body):
+        model_path = f'/v1/models/{self.model_name}'
+        if method == 'POST' and path == f'{model_path}:predict':
+            instances = np.asarray(json.loads(body)['instances'], dtype=np.float64)
+            if instances.ndim != 3 or instances.shape[1:] != (60, 1):
+                return 400, {'error': f'expected instances of shape (N, 60, 1), got {instances.shape}'}
+            with self._lock:
+                self.instances += len(instances)
+            predictions = np.repeat(instances[:, -1, :], self.horizon, axis=1)
+            return 200, {'predictions': [
+                {'forecast': forecast, 'model_version': self.version} for forecast in predictions.tolist()
+            ]}
+        if method == 'GET' and path == model_path:
+            return 200, {'model_version_status': [
+                {'version': str(self.version), 'state': 'AVAILABLE', 'status': {'error_code': 'OK', 'error_message': ''}}
+            ]}
+        return 404, {'error': f'unknown path {path}'}
@@ -0,0 +1,105 @@
+import numpy as np
+
+DAY = 86400
+WEEK = 7 * DAY
+
+
+def _splitmix64(x):
+    """Hash uint64 keys into well-mixed uint64 values"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class SyntheticCpuUsage:
+    """
+    Synthetic CPU usage: daily and weekly seasonality, a slow trend, Gaussian
+    noise and occasional load spikes.
+
+    The value at a timestamp only depends on the timestamp and the seed, so
+    any interval can be generated on its own and instant queries, range
+    queries and bulk history all agree with each other.
+    """
+
+    def __init__(self, base=0.5, daily_amplitude=0.25, weekly_amplitude=0.1, trend_per_day=0.001,
+                 noise=0.03, spike_probability=0.001, spike_height=0.5, seed=0):
+        """
+        Initialize the generator.
+
+        Args:
+            base: Mean usage in cores
+            daily_amplitude: Amplitude of the daily cycle
+            weekly_amplitude: Amplitude of the weekly cycle
+            trend_per_day: Linear growth per day since the epoch
+            noise: Standard deviation of the Gaussian noise
+            spike_probability: Probability that a sample is a load spike
+            spike_height: Height of a load spike
+            seed: Seed of the noise, one seed per series
+        """
+        self.base = base
+        self.daily_amplitude = daily_amplitude
+        self.weekly_amplitude = weekly_amplitude
+        self.trend_per_day = trend_per_day
+        self.noise = noise
+        self.spike_probability = spike_probability
+        self.spike_height = spike_height
+        self.seed = np.uint64(seed)
+
+    def _uniform(self, timestamps, stream):
+        keys = np.asarray(timestamps, dtype=np.float64).round().astype(np.int64).view(np.uint64)
+        with np.errstate(over='ignore'):
+            hashed = _splitmix64(keys ^ _splitmix64(self.seed * np.uint64(4) + np.uint64(stream)))
+        # 53 random bits, in (0, 1)
+        return ((hashed >> np.uint64(11)).astype(np.float64) + 0.5) / float(1 << 53)
+
+    def values(self, timestamps):
+        """
+        Generate the usage at the given times.
+
+        Args:
+            timestamps: Sample times (epoch seconds)
+
+        Returns:
+            np.ndarray: Usage per timestamp, never negative
+        """
+        t = np.asarray(timestamps, dtype=np.float64)
+        seasonal = (
+            self.base
+            + self.daily_amplitude * np.sin(2 * np.pi * (t % DAY) / DAY)
+            + self.weekly_amplitude * np.sin(2 * np.pi * (t % WEEK) / WEEK)
+            + self.trend_per_day * (t / DAY % 365)
+        )
+        # Box-Muller on two hashed uniforms
+        u1, u2 = self._uniform(t, 0), self._uniform(t, 1)
+        noise = self.noise * np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)
+        spikes = self.spike_height * (self._uniform(t, 2) < self.spike_probability)
+        return np.maximum(seasonal + noise + spikes, 0.0)
+
+    def generate(self, start, end, step=60):
+        """
+        Generate samples every `step` seconds in [start, end).
+
+        Returns:
+            tuple: (timestamps, values) arrays
+        """
+        timestamps = np.arange(start, end, step, dtype=np.float64)
+        return timestamps, self.values(timestamps)
+
+    def chunks(self, start, end, step=60, chunk_seconds=DAY):
+        """
+        Generate samples in [start, end) one `chunk_seconds` slice at a time,
+        so months of data never have to be held in memory at once. Slices
+        are aligned to multiples of `chunk_seconds` since the epoch, like
+        the chunks of the metrics store.
+
+        Yields:
+            tuple: (timestamps, values) arrays
+        """
+        chunk_start = start
+        while chunk_start < end:
+            chunk_end = min((chunk_start // chunk_seconds + 1) * chunk_seconds, end)
+            # Keep the sample grid aligned to start across chunks
+            first = start + np.ceil((chunk_start - start) / step) * step
+            yield self.generate(first, chunk_end, step)
+            chunk_start = chunk_end
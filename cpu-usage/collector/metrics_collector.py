@@ -1,88 +1,363 @@
 import time
-import pandas as pd
-import numpy as np
+import signal
+import json
+import re
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from prometheus_api_client import PrometheusConnect
-from datetime import datetime, timedelta
+from prometheus_client import Gauge, Counter
 import os
 import logging
+import numpy as np
+from metrics_store import MetricsStore, BufferedWriter, import_csv, RECORD_DTYPE
+from instrumentation import Instrumentation, start_metrics_server
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Series collected when no queries are configured
+DEFAULT_QUERIES = {
+    'cpu_usage': 'sum(rate(container_cpu_usage_seconds_total{container="nginx"}[5m]))'
+}
+
+SERIES_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# Scheduler metrics
+tick_lag = Gauge('collector_tick_lag_seconds', 'Delay between the scheduled and the actual start of the last tick')
+tick_jitter = Gauge('collector_tick_jitter_seconds', 'Smoothed variation of the tick lag between consecutive ticks')
+missed_ticks = Counter('collector_missed_ticks_total', 'Ticks skipped because the previous one overran')
+
+# Latency, row and error metrics of the hot paths
+instrumentation = Instrumentation('collector')
+
+def load_queries():
+    """
+    Load named PromQL queries from the environment.
+    
+    COLLECTOR_QUERIES holds a JSON object mapping series names to queries,
+    QUERIES_FILE points to a JSON file with the same content. Every query
+    must return a single sample; its value is stored under the series name.
+    """
+    queries_file = os.getenv('QUERIES_FILE')
+    if queries_file:
+        with open(queries_file) as f:
+            queries = json.load(f)
+    elif os.getenv('COLLECTOR_QUERIES'):
+        queries = json.loads(os.getenv('COLLECTOR_QUERIES'))
+    else:
+        queries = dict(DEFAULT_QUERIES)
+
+    for name in queries:
+        if not SERIES_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid series name: {name!r}")
+    return queries
+
+class TickScheduler:
+    """
+    Schedule ticks on multiples of the interval since the epoch.
+    
+    Deadlines are measured on the monotonic clock, so the schedule does not
+    drift by the time spent querying and writing. A tick that can no longer
+    start before the next one is due is skipped and counted instead of
+    being run late.
+    """
+
+    def __init__(self, interval):
+        self.interval = float(interval)
+        self.missed = 0
+        self.lag = 0.0
+        self.jitter = 0.0
+        self.resync()
+
+    def resync(self):
+        """Anchor the monotonic schedule to the next wall-clock boundary"""
+        wall, mono = time.time(), time.monotonic()
+        self._next_tick = (int(wall // self.interval) + 1) * self.interval
+        self._next_deadline = mono + (self._next_tick - wall)
+
+    def wait_next(self):
+        """
+        Sleep until the next tick is due.
+        
+        Returns:
+            float: Scheduled wall-clock time of the tick (epoch seconds)
+        """
+        now = time.monotonic()
+        behind = int((now - self._next_deadline) // self.interval)
+        if behind > 0:
+            self.missed += behind
+            missed_ticks.inc(behind)
+            self._next_tick += behind * self.interval
+            self._next_deadline += behind * self.interval
+
+        delay = self._next_deadline - now
+        if delay > 0:
+            time.sleep(delay)
+
+        lag = time.monotonic() - self._next_deadline
+        # Smoothed like RTP interarrival jitter (RFC 3550)
+        self.jitter += (abs(lag - self.lag) - self.jitter) / 16
+        self.lag = lag
+        tick_lag.set(lag)
+        tick_jitter.set(self.jitter)
+
+        tick = self._next_tick
+        self._next_tick += self.interval
+        self._next_deadline += self.interval
+
+        # Follow wall-clock steps (e.g. NTP corrections) instead of drifting away
+        if abs(time.time() - lag - tick) > self.interval / 2:
+            logger.warning("Wall clock moved, re-aligning the tick schedule")
+            self.resync()
+        return tick
+
+
 class MetricsCollector:
     def __init__(self,
         prom_url=None,  # Remove default value
-        storage_path='/data/metrics.csv',
-        query_interval=1):  # seconds
+        storage_path=None,
+        queries=None,
+        query_interval=1,  # seconds
+        legacy_csv_path='/data/metrics.csv',
+        flush_rows=None,
+        flush_seconds=None,
+        fsync=None,
+        summary_interval=60,  # seconds
+        max_workers=None,
+        query_timeout=None,  # seconds
+        backfill_hours=None,
+        backfill_max_points=None):
         
         # Get Prometheus URL from environment variable with fallback
         self.prom_url = prom_url or os.getenv('PROMETHEUS_URL', 'http://prometheus-server:9090')
         logger.info(f"Using Prometheus URL: {self.prom_url}")
 
-        self.prom = PrometheusConnect(url=self.prom_url, disable_ssl=True)
-        self.storage_path = storage_path
+        self.queries = queries or load_queries()
+        logger.info(f"Collecting {len(self.queries)} series: {', '.join(self.queries)}")
+
+        # Queries run concurrently over one pooled session, so a tick takes
+        # about as long as the slowest query rather than the sum of all
+        self.max_workers = max_workers or int(os.getenv('MAX_CONCURRENT_QUERIES', 16))
+        self.max_workers = max(1, min(self.max_workers, len(self.queries)))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='query')
+
+        session = requests.Session()
+        self.prom = PrometheusConnect(
+            url=self.prom_url,
+            disable_ssl=True,
+            session=session,
+            timeout=query_timeout or float(os.getenv('QUERY_TIMEOUT', 10))
+        )
+        # Size the connection pool to the number of concurrent queries
+        session.mount(self.prom.url, HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.max_workers,
+            max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[408, 429, 500, 502, 503, 504])
+        ))
+
+        self.storage_path = storage_path or os.getenv('METRICS_STORE_PATH', '/data/metrics')
         self.query_interval = query_interval or os.getenv('QUERY_INTERVAL', 1)
         
         # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(self.storage_path), exist_ok=True)
+        os.makedirs(self.storage_path, exist_ok=True)
         
-        # Initialize or load existing CSV
-        if not os.path.exists(self.storage_path):
-            self._initialize_csv()
-            
-    def _initialize_csv(self):
-        """Initialize empty CSV file with headers"""
-        df = pd.DataFrame(columns=['timestamp', 'cpu_usage'])
-        df.to_csv(self.storage_path, index=False)
-        logger.info(f"Initialized new CSV file at {self.storage_path}")
-
-    def query_prometheus(self):
-        """Query Prometheus for CPU usage metrics"""
+        self.store = MetricsStore(self.storage_path)
+        self.store.rebuild_index()
+        logger.info(f"Using metrics store at {self.storage_path}")
+
+        # Carry over history from the old single-file CSV storage
+        if legacy_csv_path and os.path.exists(legacy_csv_path) and not self.store.chunks('cpu_usage'):
+            import_csv(self.store, legacy_csv_path, series='cpu_usage')
+
+        # Samples are buffered and written in batches instead of one write per sample
+        self.writer = BufferedWriter(
+            self.store,
+            flush_rows=flush_rows or int(os.getenv('FLUSH_ROWS', 60)),
+            flush_seconds=flush_seconds or float(os.getenv('FLUSH_SECONDS', 10)),
+            fsync=fsync if fsync is not None else os.getenv('FSYNC', 'false').lower() == 'true'
+        )
+
+        # Gap repair: how far back to look on startup and how many points one
+        # range query may return (Prometheus rejects more than 11,000)
+        self.backfill_seconds = (backfill_hours or float(os.getenv('BACKFILL_HOURS', 6))) * 3600
+        self.backfill_max_points = backfill_max_points or int(os.getenv('BACKFILL_MAX_POINTS', 10000))
+        self.gap_threshold = 3 * float(self.query_interval)
+        self.failed_since = {}
+
+        self.scheduler = TickScheduler(self.query_interval)
+
+        # Counters for the periodic summary log line
+        self.summary_interval = summary_interval
+        self.samples_collected = 0
+        self.samples_failed = 0
+        self.last_values = {}
+        self._last_summary = time.monotonic()
+
+    def _query_one(self, name, query, timestamp):
+        """Run one instant query, returning its value or None on failure"""
         try:
-            # Query for nginx CPU usage
-            query = 'sum(rate(container_cpu_usage_seconds_total{container="nginx"}[5m]))'
-            result = self.prom.custom_query(query)
-            
+            with instrumentation.timer('prometheus_query'):
+                result = self.prom.custom_query(query, params={'time': timestamp})
             if result and len(result) > 0:
                 # Extract the latest value
-                value = float(result[0]['value'][1])
-                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                return timestamp, value
+                return float(result[0]['value'][1])
             return None
         except Exception as e:
-            logger.error(f"Error querying Prometheus: {e}")
+            logger.error(f"Error querying Prometheus for {name}: {e}")
             return None
 
-    def append_to_csv(self, data):
-        """Append new data to CSV file"""
-        if data is None:
-            return
+    def query_prometheus(self, timestamp=None):
+        """
+        Query Prometheus for all configured series concurrently.
         
-        timestamp, value = data
-        new_row = pd.DataFrame({
-            'timestamp': [timestamp],
-            'cpu_usage': [value]
-        })
+        Args:
+            timestamp: Evaluation time of the queries (epoch seconds), defaults to now
         
-        try:
-            new_row.to_csv(self.storage_path, mode='a', header=False, index=False)
-            logger.info(f"Appended data: {timestamp}, {value}")
-        except Exception as e:
-            logger.error(f"Error appending to CSV: {e}")
+        Returns:
+            tuple: (timestamp, {series name: value}) for the queries that succeeded
+        """
+        timestamp = timestamp or time.time()
+        names = list(self.queries)
+        with instrumentation.timer('query_prometheus'):
+            values = list(self.executor.map(
+                self._query_one, names, [self.queries[name] for name in names], [timestamp] * len(names)
+            ))
+        return timestamp, {name: value for name, value in zip(names, values) if value is not None}
+
+    def append_to_store(self, data):
+        """Append new data to the metrics store, one series per query"""
+        timestamp, values = data
+        self.samples_failed += len(self.queries) - len(values)
+        with instrumentation.timer('append_to_store'):
+            for name, value in values.items():
+                try:
+                    self.writer.append(name, timestamp, value)
+                    self.samples_collected += 1
+                    self.last_values[name] = value
+                except Exception as e:
+                    instrumentation.error('append_to_store')
+                    logger.error(f"Error appending {name} to store: {e}")
+
+    def flush_if_due(self, timestamp):
+        """Flush the buffered samples when due, recording rows, bytes and file sizes"""
+        rows_before = self.writer.rows_written
+        with instrumentation.timer('flush'):
+            self.writer.flush_if_due()
+        rows = self.writer.rows_written - rows_before
+        if rows:
+            instrumentation.count('flush', rows, rows * RECORD_DTYPE.itemsize)
+            # Readers parse the index on every lookup and tail the current chunks
+            instrumentation.file_size('index.json', self.store.index_path)
+            for name in self.queries:
+                instrumentation.file_size(
+                    f"{name}/current_chunk", self.store.chunk_path(name, self.store.chunk_start(timestamp))
+                )
+
+    def _fill_gap(self, name, gap_start, gap_end):
+        """Fill one gap of a series with chunked range queries"""
+        step = float(self.query_interval)
+        chunk_seconds = step * self.backfill_max_points
+        filled = 0
+        chunk_start = gap_start + step
+        while chunk_start < gap_end:
+            chunk_end = min(chunk_start + chunk_seconds, gap_end)
+            result = self.prom.custom_query_range(
+                self.queries[name],
+                start_time=datetime.fromtimestamp(chunk_start, tz=timezone.utc),
+                end_time=datetime.fromtimestamp(chunk_end, tz=timezone.utc),
+                step=f"{step:g}s"
+            )
+            if result:
+                values = np.array(result[0]['values'], dtype=float)
+                inside = (values[:, 0] > gap_start) & (values[:, 0] < gap_end)
+                self.writer.extend(name, values[inside, 0], values[inside, 1])
+                filled += int(inside.sum())
+            chunk_start = chunk_end + step
+        return filled
+
+    def backfill(self, names=None, start=None, end=None):
+        """
+        Find missing intervals in the store and fill them from Prometheus.
+        
+        Args:
+            names: Series to repair, defaults to all configured series
+            start: Start of the interval to check (epoch seconds), defaults to BACKFILL_HOURS ago
+            end: End of the interval to check (epoch seconds), defaults to now
+        """
+        end = end or time.time()
+        start = start or end - self.backfill_seconds
+        self.writer.flush()
+        for name in names or list(self.queries):
+            try:
+                with instrumentation.timer('backfill'):
+                    gaps = self.store.find_gaps(name, start, end, self.gap_threshold)
+                    filled = sum(self._fill_gap(name, gap_start, gap_end) for gap_start, gap_end in gaps)
+                instrumentation.count('backfill', filled, filled * RECORD_DTYPE.itemsize)
+                if gaps:
+                    logger.info(f"Backfilled {filled} samples into {len(gaps)} gaps of {name}")
+            except Exception as e:
+                logger.error(f"Error backfilling {name}: {e}")
+
+    def repair_recovered(self, data):
+        """Backfill series whose queries succeed again after failing"""
+        timestamp, values = data
+        for name in self.queries:
+            if name not in values:
+                self.failed_since.setdefault(name, timestamp)
+        recovered = [name for name in self.failed_since if name in values]
+        if recovered:
+            start = min(self.failed_since.pop(name) for name in recovered) - self.gap_threshold
+            self.backfill(recovered, start=start, end=timestamp)
+
+    def log_summary(self, force=False):
+        """Log collected/failed sample counts once per summary interval"""
+        elapsed = time.monotonic() - self._last_summary
+        if not force and elapsed < self.summary_interval:
+            return
+        logger.info(
+            f"Collected {self.samples_collected} samples ({self.samples_failed} failed) "
+            f"in the last {elapsed:.0f}s, {self.writer.rows_written} rows written in "
+            f"{self.writer.flushes} flushes, {self.scheduler.missed} ticks missed, "
+            f"lag {self.scheduler.lag * 1000:.1f}ms, jitter {self.scheduler.jitter * 1000:.1f}ms, "
+            f"last values: {self.last_values}"
+        )
+        self.samples_collected = 0
+        self.samples_failed = 0
+        self._last_summary = time.monotonic()
+
+    def shutdown(self, signum=None, frame=None):
+        """Flush buffered samples and stop on SIGTERM"""
+        logger.info("Shutting down, flushing buffered samples...")
+        self.executor.shutdown(wait=False)
+        self.writer.close()
+        self.log_summary(force=True)
+        raise SystemExit(0)
 
     def run_forever(self):
         """Run the collector indefinitely"""
         logger.info("Starting metrics collection...")
+        signal.signal(signal.SIGTERM, self.shutdown)
+        self.backfill()
+        self.scheduler.resync()
         while True:
+            # Samples are stamped with the scheduled instant, not the time the query returned
+            timestamp = self.scheduler.wait_next()
             try:
-                data = self.query_prometheus()
-                self.append_to_csv(data)
-                time.sleep(self.query_interval)
+                data = self.query_prometheus(timestamp)
+                self.repair_recovered(data)
+                self.append_to_store(data)
+                self.flush_if_due(timestamp)
+                self.log_summary()
             except Exception as e:
+                instrumentation.error('tick')
                 logger.error(f"Error in collection loop: {e}")
-                time.sleep(self.query_interval)
 
 if __name__ == "__main__":
+    # Start up the server to expose scheduler and hot path metrics
+    start_metrics_server()
     collector = MetricsCollector()
     collector.run_forever()
\ No newline at end of file
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The collector imports the common modules as top-level modules, from /code
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', '..', 'common'))
+sys.path.insert(0, os.path.dirname(here))
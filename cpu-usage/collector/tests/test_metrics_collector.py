@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+import pytest
+from prometheus_client import REGISTRY
+
+import metrics_collector
+from metrics_store import RECORD_DTYPE
+
+HOUR = 1_700_000_000 // 3600 * 3600
+
+
+def sample(name, operation):
+    labels = {'component': 'collector', 'operation': operation}
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.fixture
+def collector(tmp_path):
+    return metrics_collector.MetricsCollector(
+        prom_url='http://prometheus.invalid:9090',
+        storage_path=str(tmp_path / 'metrics'),
+        queries={'cpu_usage': 'up', 'memory_usage': 'up'},
+        legacy_csv_path=None,
+        flush_rows=4,
+        flush_seconds=3600,
+    )
+
+
+def test_flush_records_rows_bytes_and_file_sizes(collector):
+    rows_before = sample('mlops_operation_rows_total', 'flush')
+    bytes_before = sample('mlops_operation_bytes_total', 'flush')
+    flushes_before = sample('mlops_operation_duration_seconds_count', 'flush')
+
+    for tick in range(20):
+        timestamp = HOUR + tick
+        collector.append_to_store((timestamp, {'cpu_usage': 1.0, 'memory_usage': 2.0}))
+        collector.flush_if_due(timestamp)
+
+    # Appending only buffers, every row is written by a flush the collector timed
+    assert collector.writer.rows_written == 40
+    assert collector.writer.flushes == 10
+    assert sample('mlops_operation_rows_total', 'flush') - rows_before == 40
+    assert sample('mlops_operation_bytes_total', 'flush') - bytes_before == 40 * RECORD_DTYPE.itemsize
+    assert sample('mlops_operation_duration_seconds_count', 'flush') - flushes_before == 20
+
+    chunk_path = collector.store.chunk_path('cpu_usage', HOUR)
+    file_sizes = {'component': 'collector', 'file': 'cpu_usage/current_chunk'}
+    assert REGISTRY.get_sample_value('mlops_file_size_bytes', file_sizes) == os.path.getsize(chunk_path)
+    index_size = {'component': 'collector', 'file': 'index.json'}
+    assert REGISTRY.get_sample_value('mlops_file_size_bytes', index_size) == os.path.getsize(collector.store.index_path)
+
+
+class FakePrometheus:
+    """Answers range queries with one sample per step, valued seconds past HOUR"""
+
+    def __init__(self):
+        self.calls = []
+
+    def custom_query_range(self, query, start_time, end_time, step):
+        start, end = start_time.timestamp(), end_time.timestamp()
+        self.calls.append((start, end))
+        timestamps = np.arange(start, end + 1, float(step.rstrip('s')))
+        return [{'values': [[timestamp, str(timestamp - HOUR)] for timestamp in timestamps]}]
+
+
+def test_fill_gap_splits_range_queries_and_keeps_the_gap_only(collector):
+    collector.prom = FakePrometheus()
+    collector.backfill_max_points = 3
+
+    assert collector._fill_gap('cpu_usage', HOUR + 10, HOUR + 20) == 9
+    assert collector.prom.calls == [
+        (HOUR + 11, HOUR + 14), (HOUR + 15, HOUR + 18), (HOUR + 19, HOUR + 20)
+    ]
+    collector.writer.flush()
+    timestamps, values = collector.store.read_range('cpu_usage')
+    np.testing.assert_array_equal(timestamps, np.arange(HOUR + 11, HOUR + 20))
+    np.testing.assert_array_equal(values, np.arange(11, 20))
+
+
+def test_backfill_fills_the_gaps_found_in_the_store(collector):
+    timestamps = np.concatenate([np.arange(HOUR, HOUR + 11), np.arange(HOUR + 20, HOUR + 26)]).astype(np.float64)
+    collector.store.append_many('cpu_usage', timestamps, timestamps - HOUR)
+    collector.prom = FakePrometheus()
+
+    collector.backfill(['cpu_usage'], start=HOUR, end=HOUR + 26)
+
+    assert collector.prom.calls == [(HOUR + 11, HOUR + 20)]
+    timestamps, values = collector.store.read_range('cpu_usage')
+    np.testing.assert_array_equal(timestamps, np.arange(HOUR, HOUR + 26))
+    np.testing.assert_array_equal(values, np.arange(26))
+
+
+class FakeClock:
+    """Wall and monotonic clocks that only move when slept on or stepped"""
+
+    def __init__(self, wall):
+        self.wall = wall
+        self.mono = 50.0
+
+    def time(self):
+        return self.wall
+
+    def monotonic(self):
+        return self.mono
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.wall += seconds
+        self.mono += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock(HOUR + 0.25)
+    monkeypatch.setattr(metrics_collector, 'time', clock)
+    return clock
+
+
+def test_tick_scheduler_ticks_on_interval_boundaries(clock):
+    scheduler = metrics_collector.TickScheduler(5)
+
+    assert scheduler.wait_next() == HOUR + 5
+    assert clock.wall == HOUR + 5
+    clock.advance(1.5)
+    assert scheduler.wait_next() == HOUR + 10
+    assert (scheduler.missed, scheduler.lag) == (0, 0.0)
+
+
+def test_tick_scheduler_skips_ticks_after_an_overrun(clock):
+    missed_before = REGISTRY.get_sample_value('collector_missed_ticks_total') or 0.0
+    scheduler = metrics_collector.TickScheduler(1)
+    assert scheduler.wait_next() == HOUR + 1
+
+    # The tick ran 3.5s, the ones due at +2 and +3 are skipped
+    clock.advance(3.5)
+    assert scheduler.wait_next() == HOUR + 4
+    assert scheduler.missed == 2
+    assert scheduler.lag == pytest.approx(0.5)
+    assert REGISTRY.get_sample_value('collector_missed_ticks_total') - missed_before == 2
+    assert scheduler.wait_next() == HOUR + 5
+
+
+def test_tick_scheduler_follows_wall_clock_steps(clock):
+    scheduler = metrics_collector.TickScheduler(1)
+    assert scheduler.wait_next() == HOUR + 1
+
+    # The wall clock jumps ahead without the monotonic clock moving
+    clock.wall += 100
+    assert scheduler.wait_next() == HOUR + 2
+    # Re-aligned to the first boundary after the new wall-clock time
+    assert scheduler.wait_next() == HOUR + 103
+    assert clock.wall == HOUR + 103
@@ -0,0 +1,283 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# One forecast point: when it was issued, which minute it is for, the value
+# and the model version that produced it (-1 if unknown).
+FORECAST_DTYPE = np.dtype([
+    ('issue_time', '<f8'),
+    ('target_time', '<f8'),
+    ('value', '<f8'),
+    ('model_version', '<i8'),
+])
+
+SEGMENTS_DIR = 'segments'
+COMPACTED_DIR = 'compacted'
+
+
+def dedupe_forecasts(records):
+    """Keep the last written record of every (issue_time, target_time) pair."""
+    if not len(records):
+        return records
+    order = np.lexsort((np.arange(len(records)), records['target_time'], records['issue_time']))
+    records = records[order]
+    last = np.ones(len(records), dtype=bool)
+    last[:-1] = (
+        (records['issue_time'][1:] != records['issue_time'][:-1])
+        | (records['target_time'][1:] != records['target_time'][:-1])
+    )
+    return records[last]
+
+
+class ForecastLog:
+    """
+    Append-only log of forecasts keyed by (issue_time, target_time).
+
+    Every call to append() writes one immutable segment file, atomically
+    (temporary file + rename), so a crash can never leave a half-written
+    log behind. compact() merges the segments of past hours into one file
+    per hour and deletes the hours older than the retention. Forecasts are
+    never overwritten: each issue keeps all of its
+    horizons, and lookups pick the newest issue for a target.
+
+    Layout:
+        <root_path>/<series>/segments/<issue epoch>-<write ns>.npy
+        <root_path>/<series>/compacted/<issue hour epoch>.npy
+    """
+
+    def __init__(self, root_path='/data/forecasts', max_horizon=3600, compact_seconds=3600,
+                 retention_seconds=None):
+        """
+        Initialize the log.
+
+        Args:
+            root_path: Directory holding one sub-directory per series
+            max_horizon: Longest forecast horizon in seconds
+            compact_seconds: Issue-time span merged into one compacted file
+            retention_seconds: Age of the issues compact() deletes, None to keep everything
+        """
+        self.root_path = root_path
+        self.max_horizon = max_horizon
+        self.compact_seconds = compact_seconds
+        self.retention_seconds = retention_seconds
+
+    def _dir(self, series, kind):
+        return os.path.join(self.root_path, series, kind)
+
+    def _write_atomic(self, path, records):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, records)
+        os.replace(tmp_path, path)
+
+    def append(self, series, issue_time, target_times, values, model_version=-1):
+        """
+        Write the forecasts of one issue as a new segment.
+
+        Args:
+            series: Name of the forecast series
+            issue_time: Time the forecast was made for (epoch seconds)
+            target_times: Times the forecast values are for (epoch seconds)
+            values: Forecast values
+            model_version: Version of the model that made the forecast
+        """
+        records = np.empty(len(values), dtype=FORECAST_DTYPE)
+        records['issue_time'] = issue_time
+        records['target_time'] = target_times
+        records['value'] = values
+        records['model_version'] = model_version
+        name = f"{int(issue_time)}-{time.time_ns()}.npy"
+        self._write_atomic(os.path.join(self._dir(series, SEGMENTS_DIR), name), records)
+
+    def _files(self, series, kind):
+        """Return (issue time, path) of the files of one kind, in write order."""
+        directory = self._dir(series, kind)
+        try:
+            names = sorted(n for n in os.listdir(directory) if n.endswith('.npy'))
+        except FileNotFoundError:
+            return []
+        return [(float(n.split('-')[0].split('.')[0]), os.path.join(directory, n)) for n in names]
+
+    def read_issues(self, series, start=None, end=None):
+        """
+        Read the forecasts issued in [start, end).
+
+        Only files whose issue time can fall into the interval are opened.
+
+        Returns:
+            np.ndarray: FORECAST_DTYPE records sorted by (issue_time, target_time)
+        """
+        parts = []
+        for issue_hour, path in self._files(series, COMPACTED_DIR):
+            if (end is None or issue_hour < end) and (start is None or issue_hour + self.compact_seconds > start):
+                parts.append(np.load(path))
+        for issue_time, path in self._files(series, SEGMENTS_DIR):
+            if (end is None or issue_time < end) and (start is None or issue_time >= start):
+                try:
+                    parts.append(np.load(path))
+                except FileNotFoundError:
+                    # Merged by a concurrent compaction, whose output was read above or
+                    # will be picked up by the next call
+                    continue
+        if not parts:
+            return np.empty(0, dtype=FORECAST_DTYPE)
+
+        records = np.concatenate(parts)
+        mask = np.ones(len(records), dtype=bool)
+        if start is not None:
+            mask &= records['issue_time'] >= start
+        if end is not None:
+            mask &= records['issue_time'] < end
+        return dedupe_forecasts(records[mask])
+
+    def latest_for_targets(self, series, target_times):
+        """
+        Look up the most recently issued forecast for each target time.
+
+        Only the segments and compacted files that can hold issues from
+        max_horizon before the earliest target up to the latest one are read.
+
+        Args:
+            series: Name of the forecast series
+            target_times: Target times (epoch seconds)
+
+        Returns:
+            np.ndarray: Forecast values, NaN where no forecast exists
+        """
+        target_times = np.asarray(target_times, dtype=float)
+        result = np.full(len(target_times), np.nan)
+        if not len(target_times):
+            return result
+
+        records = self.read_issues(
+            series, start=target_times.min() - self.max_horizon, end=target_times.max()
+        )
+        records = records[records['issue_time'] < records['target_time']]
+        if not len(records):
+            return result
+
+        # Newest issue per target: sort by (target, issue) and take the last of each target
+        order = np.lexsort((records['issue_time'], records['target_time']))
+        records = records[order]
+        last = np.ones(len(records), dtype=bool)
+        last[:-1] = records['target_time'][1:] != records['target_time'][:-1]
+        latest = records[last]
+
+        positions = np.searchsorted(latest['target_time'], target_times)
+        positions = np.clip(positions, 0, len(latest) - 1)
+        found = latest['target_time'][positions] == target_times
+        result[found] = latest['value'][positions[found]]
+        return result
+
+    def compact(self, series, before=None):
+        """
+        Merge the segments issued before `before` into one file per issue hour,
+        then delete the compacted hours that ended retention_seconds before it.
+
+        Args:
+            series: Name of the forecast series
+            before: Only merge issues older than this, defaults to the start
+                of the current compaction period
+
+        Returns:
+            int: Number of merged segments
+        """
+        if before is None:
+            before = (time.time() // self.compact_seconds) * self.compact_seconds
+        groups = {}
+        for issue_time, path in self._files(series, SEGMENTS_DIR):
+            if issue_time < before:
+                hour = int(issue_time // self.compact_seconds) * self.compact_seconds
+                groups.setdefault(hour, []).append(path)
+
+        merged = 0
+        for hour, paths in sorted(groups.items()):
+            target = os.path.join(self._dir(series, COMPACTED_DIR), f"{hour}.npy")
+            parts = [np.load(target)] if os.path.exists(target) else []
+            parts.extend(np.load(path) for path in paths)
+            self._write_atomic(target, dedupe_forecasts(np.concatenate(parts)))
+            for path in paths:
+                os.remove(path)
+            merged += len(paths)
+        if merged:
+            logger.info(f"Compacted {merged} forecast segments of {series} into {len(groups)} files")
+
+        if self.retention_seconds is not None:
+            expired = [
+                path for issue_hour, path in self._files(series, COMPACTED_DIR)
+                if issue_hour + self.compact_seconds <= before - self.retention_seconds
+            ]
+            for path in expired:
+                os.remove(path)
+            if expired:
+                logger.info(f"Deleted {len(expired)} compacted forecast files of {series} past the retention")
+        return merged
+
+
+class ForecastTailer:
+    """
+    Incrementally read the forecasts appended to one series of the log.
+
+    Segments already seen are remembered by name, so every call only loads
+    new segments. Compacted files are re-read when they change, which
+    happens once per compaction. Files that cannot hold issues from
+    min_issue_time on are skipped without a stat and forgotten.
+    """
+
+    def __init__(self, log, series):
+        self.log = log
+        self.series = series
+        self._seen_segments = set()
+        self._compacted = {}
+
+    def read_new(self, min_issue_time=None):
+        """
+        Read the forecasts written since the previous call.
+
+        Args:
+            min_issue_time: Skip forecasts issued before this time (epoch seconds)
+
+        Returns:
+            np.ndarray: FORECAST_DTYPE records, in write order
+        """
+        parts = []
+        compacted = {}
+        for issue_hour, path in self.log._files(self.series, COMPACTED_DIR):
+            if min_issue_time is not None and issue_hour + self.log.compact_seconds <= min_issue_time:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            compacted[path] = signature
+            if self._compacted.get(path) != signature:
+                parts.append(np.load(path))
+        self._compacted = compacted
+
+        segments = self.log._files(self.series, SEGMENTS_DIR)
+        current = {path for _, path in segments}
+        for issue_time, path in segments:
+            if path in self._seen_segments:
+                continue
+            self._seen_segments.add(path)
+            if min_issue_time is not None and issue_time < min_issue_time:
+                continue
+            try:
+                parts.append(np.load(path))
+            except FileNotFoundError:
+                # Compacted in the meantime, the compacted file is read next time
+                continue
+        self._seen_segments &= current
+
+        if not parts:
+            return np.empty(0, dtype=FORECAST_DTYPE)
+        records = np.concatenate(parts)
+        if min_issue_time is not None:
+            records = records[records['issue_time'] >= min_issue_time]
+        return records
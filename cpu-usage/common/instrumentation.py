@@ -0,0 +1,84 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import start_http_server, Counter, Gauge, Histogram
+
+# From half a millisecond (a buffered write) up to the 30s request timeouts
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+operation_seconds = Histogram(
+    'mlops_operation_duration_seconds', 'Duration of instrumented operations',
+    ['component', 'operation'], buckets=LATENCY_BUCKETS
+)
+operation_errors = Counter('mlops_operation_errors_total', 'Instrumented operations that failed', ['component', 'operation'])
+operation_rows = Counter('mlops_operation_rows_total', 'Rows read or written by instrumented operations', ['component', 'operation'])
+operation_bytes = Counter('mlops_operation_bytes_total', 'Bytes read or written by instrumented operations', ['component', 'operation'])
+loop_lag = Gauge('mlops_loop_lag_seconds', 'Delay between when a loop iteration was due and when it started', ['component', 'loop'])
+file_size_bytes = Gauge('mlops_file_size_bytes', 'Size of the files a component reads on its hot path', ['component', 'file'])
+
+
+class Instrumentation:
+    """
+    Latency histograms, row/byte/error counters and lag gauges of one component.
+
+    All components share the same metric names and tell themselves apart
+    by the component label. Labelled children are resolved once and
+    cached, so recording a sample costs a dict lookup and a lock, cheap
+    enough for loops that run every second.
+    """
+
+    def __init__(self, component):
+        self.component = component
+        self._children = {}
+
+    def _child(self, metric, label):
+        child = self._children.get((metric, label))
+        if child is None:
+            child = self._children[(metric, label)] = metric.labels(self.component, label)
+        return child
+
+    @contextmanager
+    def timer(self, operation):
+        """Observe the duration of the block, and count it as an error if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._child(operation_errors, operation).inc()
+            raise
+        finally:
+            self._child(operation_seconds, operation).observe(time.perf_counter() - start)
+
+    def observe(self, operation, seconds):
+        """Record the duration of an operation timed by the caller"""
+        self._child(operation_seconds, operation).observe(seconds)
+
+    def error(self, operation):
+        """Count a failure the operation handled itself"""
+        self._child(operation_errors, operation).inc()
+
+    def count(self, operation, rows=0, nbytes=0):
+        """Count rows and bytes read or written by an operation"""
+        if rows:
+            self._child(operation_rows, operation).inc(rows)
+        if nbytes:
+            self._child(operation_bytes, operation).inc(nbytes)
+
+    def lag(self, loop, seconds):
+        """Set how late the current iteration of a loop started"""
+        self._child(loop_lag, loop).set(seconds)
+
+    def file_size(self, name, path):
+        """Set the size of a file, ignored if it does not exist (yet)"""
+        try:
+            self._child(file_size_bytes, name).set(os.path.getsize(path))
+        except OSError:
+            pass
+
+
+def start_metrics_server(port=None):
+    """Serve all metrics of the process on /metrics, on METRICS_PORT by default"""
+    port = int(port or os.getenv('METRICS_PORT', 8000))
+    start_http_server(port)
+    return port
@@ -0,0 +1,721 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# One sample on disk: epoch seconds (UTC) and value, both little-endian float64.
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('value', '<f8')])
+
+INDEX_FILE = 'index.json'
+WATERMARK_FILE = 'watermark.json'
+CHUNK_SUFFIX = '.bin'
+
+
+def to_epoch(t):
+    """Convert a datetime, pandas Timestamp or number to epoch seconds (UTC).
+
+    Naive datetimes are interpreted as UTC, which is what the store writes.
+    """
+    if t is None:
+        return None
+    if isinstance(t, (int, float, np.integer, np.floating)):
+        return float(t)
+    if isinstance(t, datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        return t.timestamp()
+    raise TypeError(f"Unsupported timestamp type: {type(t)}")
+
+
+class MetricsStore:
+    """
+    Time-partitioned store for metric samples.
+
+    Every series lives in its own directory and is split into fixed-size
+    time chunks (hourly by default). A chunk is a flat file of RECORD_DTYPE
+    records, so appending is a plain binary write and reading is a single
+    np.fromfile call. A small index.json lists the chunks of every series.
+
+    Layout:
+        <root_path>/index.json
+        <root_path>/<series>/<chunk start epoch>.bin
+    """
+
+    def __init__(self, root_path='/data/metrics', chunk_seconds=3600):
+        """
+        Initialize the store.
+
+        Args:
+            root_path: Directory holding the index and the series directories
+            chunk_seconds: Length of one chunk in seconds
+        """
+        self.root_path = root_path
+        self.chunk_seconds = int(chunk_seconds)
+        self.index_path = os.path.join(self.root_path, INDEX_FILE)
+        self.watermark_path = os.path.join(self.root_path, WATERMARK_FILE)
+        self._index = None
+
+    # ------------------------------------------------------------------
+    # Index
+    # ------------------------------------------------------------------
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = {'chunk_seconds': self.chunk_seconds, 'series': {}}
+        if index.get('chunk_seconds', self.chunk_seconds) != self.chunk_seconds:
+            raise ValueError(
+                f"Store at {self.root_path} uses {index['chunk_seconds']}s chunks, "
+                f"not {self.chunk_seconds}s"
+            )
+        return index
+
+    def _write_index(self, index):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def rebuild_index(self):
+        """Rebuild index.json from the chunk files found on disk."""
+        index = {'chunk_seconds': self.chunk_seconds, 'series': {}}
+        if os.path.isdir(self.root_path):
+            for series in sorted(os.listdir(self.root_path)):
+                series_dir = os.path.join(self.root_path, series)
+                if not os.path.isdir(series_dir):
+                    continue
+                chunks = sorted(
+                    int(name[:-len(CHUNK_SUFFIX)])
+                    for name in os.listdir(series_dir)
+                    if name.endswith(CHUNK_SUFFIX)
+                )
+                index['series'][series] = {'chunks': chunks}
+        os.makedirs(self.root_path, exist_ok=True)
+        self._write_index(index)
+        self._index = index
+        return index
+
+    def series_names(self):
+        """Return the names of all series in the store."""
+        return sorted(self._load_index()['series'])
+
+    def chunks(self, series):
+        """Return the sorted chunk start times (epoch seconds) of a series."""
+        entry = self._load_index()['series'].get(series)
+        return list(entry['chunks']) if entry else []
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def chunk_start(self, timestamp):
+        """Return the start (epoch seconds) of the chunk holding timestamp."""
+        return int(timestamp // self.chunk_seconds) * self.chunk_seconds
+
+    def chunk_path(self, series, chunk_start):
+        return os.path.join(self.root_path, series, f"{chunk_start}{CHUNK_SUFFIX}")
+
+    def _register_chunk(self, series, chunk_start):
+        if self._index is None:
+            self._index = self._load_index()
+        entry = self._index['series'].setdefault(series, {'chunks': []})
+        if chunk_start in entry['chunks']:
+            return
+        entry['chunks'].append(chunk_start)
+        entry['chunks'].sort()
+        self._write_index(self._index)
+
+    def append_many(self, series, timestamps, values):
+        """
+        Append samples to a series.
+
+        Args:
+            series: Name of the series
+            timestamps: Sample times (datetimes or epoch seconds)
+            values: Sample values
+        """
+        records = np.empty(len(timestamps), dtype=RECORD_DTYPE)
+        if isinstance(timestamps, np.ndarray) and timestamps.dtype.kind in 'fiu':
+            records['timestamp'] = timestamps
+        else:
+            records['timestamp'] = [to_epoch(t) for t in timestamps]
+        records['value'] = values
+        if not len(records):
+            return
+
+        os.makedirs(os.path.join(self.root_path, series), exist_ok=True)
+        starts = (records['timestamp'] // self.chunk_seconds).astype(np.int64) * self.chunk_seconds
+        for chunk_start in np.unique(starts):
+            chunk_start = int(chunk_start)
+            path = self.chunk_path(series, chunk_start)
+            with open(path, 'ab') as f:
+                f.write(records[starts == chunk_start].tobytes())
+            self._register_chunk(series, chunk_start)
+
+    def append(self, series, timestamp, value):
+        """Append a single sample to a series."""
+        self.append_many(series, [timestamp], [value])
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    def _read_chunk(self, series, chunk_start):
+        path = self.chunk_path(series, chunk_start)
+        try:
+            # Ignore a trailing partial record written concurrently by the collector
+            count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+            return np.fromfile(path, dtype=RECORD_DTYPE, count=count)
+        except FileNotFoundError:
+            return None
+
+    def _chunks_in_range(self, series, start, end):
+        if start is None:
+            chunks = self.chunks(series)
+            if end is None:
+                return chunks
+            return [c for c in chunks if c < end]
+        last = self.chunk_start(end if end is not None else datetime.now(timezone.utc).timestamp())
+        return range(self.chunk_start(start), last + 1, self.chunk_seconds)
+
+    def read_range(self, series, start=None, end=None):
+        """
+        Read the samples of a series in the half-open interval [start, end).
+
+        Only the chunks overlapping the interval are opened.
+
+        Args:
+            series: Name of the series
+            start: Start of the interval, or None for the beginning of the series
+            end: End of the interval, or None for no upper bound
+
+        Returns:
+            tuple: (timestamps, values) as float64 arrays sorted by time
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        parts = []
+        for chunk_start in self._chunks_in_range(series, start, end):
+            records = self._read_chunk(series, chunk_start)
+            if records is not None and len(records):
+                parts.append(records)
+        if not parts:
+            return np.empty(0), np.empty(0)
+
+        records = np.concatenate(parts)
+        if np.any(np.diff(records['timestamp']) < 0):
+            records = np.sort(records, order='timestamp', kind='stable')
+        mask = np.ones(len(records), dtype=bool)
+        if start is not None:
+            mask &= records['timestamp'] >= start
+        if end is not None:
+            mask &= records['timestamp'] < end
+        records = records[mask]
+        return records['timestamp'].copy(), records['value'].copy()
+
+    def write_watermark(self, last_timestamps):
+        """
+        Publish the newest flushed timestamp of every series.
+
+        Readers watch this one small file to learn that new data landed
+        without touching any chunk.
+        """
+        tmp_path = f"{self.watermark_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'updated': time.time(), 'series': last_timestamps}, f)
+        os.replace(tmp_path, self.watermark_path)
+
+    def read_watermark(self):
+        """Return the newest flushed timestamp per series, or {} if unknown."""
+        try:
+            with open(self.watermark_path) as f:
+                return json.load(f)['series']
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def find_gaps(self, series, start, end, min_gap):
+        """
+        Find the intervals in [start, end) without samples.
+
+        Args:
+            series: Name of the series
+            start: Start of the interval to check
+            end: End of the interval to check
+            min_gap: Shortest distance between samples (seconds) reported as a gap
+
+        Returns:
+            list: (gap_start, gap_end) tuples in epoch seconds, exclusive of both ends
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        timestamps, _ = self.read_range(series, start, end)
+        edges = np.concatenate([[start], timestamps, [end]])
+        gaps = np.nonzero(np.diff(edges) > min_gap)[0]
+        return [(float(edges[i]), float(edges[i + 1])) for i in gaps]
+
+    def last_timestamp(self, series):
+        """Return the newest timestamp of a series (epoch seconds), or None."""
+        for chunk_start in reversed(self.chunks(series)):
+            path = self.chunk_path(series, chunk_start)
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            count = size // RECORD_DTYPE.itemsize
+            if not count:
+                continue
+            with open(path, 'rb') as f:
+                f.seek((count - 1) * RECORD_DTYPE.itemsize)
+                record = np.frombuffer(f.read(RECORD_DTYPE.itemsize), dtype=RECORD_DTYPE)
+            return float(record['timestamp'][0])
+        return None
+
+
+class BufferedWriter:
+    """
+    Buffer samples in memory and write them to the store in batches.
+
+    flush_if_due() flushes the buffered samples once `flush_rows` of them
+    are pending or `flush_seconds` have passed since the last flush,
+    whichever comes first. The caller drives the policy, so it can time and
+    count the flushes. Chunk files stay open between flushes, so a flush is
+    one write() per series. Readers only see samples after they have been
+    flushed.
+    """
+
+    def __init__(self, store, flush_rows=60, flush_seconds=10.0, fsync=False):
+        """
+        Initialize the writer.
+
+        Args:
+            store: MetricsStore to write to
+            flush_rows: Number of pending samples that triggers a flush
+            flush_seconds: Maximum age of the oldest pending sample in seconds
+            fsync: Whether to fsync chunk files after every flush
+        """
+        self.store = store
+        self.flush_rows = max(1, int(flush_rows))
+        self.flush_seconds = float(flush_seconds)
+        self.fsync = fsync
+        self._pending = {}
+        self._pending_rows = 0
+        self._files = {}
+        self._last_flush = time.monotonic()
+        self._last_timestamps = {}
+        self.rows_written = 0
+        self.flushes = 0
+
+    def append(self, series, timestamp, value):
+        """Buffer one sample, written by the next flush."""
+        self._pending.setdefault(series, []).append((to_epoch(timestamp), value))
+        self._pending_rows += 1
+
+    def flush_if_due(self):
+        """Flush when enough rows are pending or the buffer is old enough."""
+        if not self._pending_rows:
+            self._last_flush = time.monotonic()
+            return False
+        if (self._pending_rows >= self.flush_rows
+                or time.monotonic() - self._last_flush >= self.flush_seconds):
+            self.flush()
+            return True
+        return False
+
+    def _file_for(self, series, chunk_start):
+        f = self._files.get(series)
+        if f is not None and f[0] == chunk_start:
+            return f[1]
+        if f is not None:
+            f[1].close()
+        os.makedirs(os.path.join(self.store.root_path, series), exist_ok=True)
+        handle = open(self.store.chunk_path(series, chunk_start), 'ab')
+        self.store._register_chunk(series, chunk_start)
+        self._files[series] = (chunk_start, handle)
+        return handle
+
+    def _write_records(self, series, records):
+        starts = (records['timestamp'] // self.store.chunk_seconds).astype(np.int64) * self.store.chunk_seconds
+        active = self._files.get(series, (None,))[0]
+        newest = int(starts.max())
+        for chunk_start in np.unique(starts):
+            chunk_start = int(chunk_start)
+            if chunk_start == active or (chunk_start == newest and (active is None or newest > active)):
+                handle = self._file_for(series, chunk_start)
+                handle.write(records[starts == chunk_start].tobytes())
+                handle.flush()
+                if self.fsync:
+                    os.fsync(handle.fileno())
+            else:
+                # Late samples for a chunk that is no longer the active one
+                self.store.append_many(series, records['timestamp'][starts == chunk_start],
+                                       records['value'][starts == chunk_start])
+        self.rows_written += len(records)
+        newest = float(records['timestamp'].max())
+        self._last_timestamps[series] = max(self._last_timestamps.get(series, newest), newest)
+
+    def flush(self):
+        """Write all pending samples to their chunk files."""
+        written = False
+        for series, rows in self._pending.items():
+            if rows:
+                self._write_records(series, np.array(rows, dtype=RECORD_DTYPE))
+                written = True
+        if written:
+            self.store.write_watermark(self._last_timestamps)
+        self._pending = {}
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+        self.flushes += 1
+
+    def extend(self, series, timestamps, values):
+        """Write a batch of samples right away, e.g. when backfilling."""
+        records = np.empty(len(timestamps), dtype=RECORD_DTYPE)
+        records['timestamp'] = timestamps
+        records['value'] = values
+        if len(records):
+            self.flush()
+            self._write_records(series, records)
+            self.store.write_watermark(self._last_timestamps)
+
+    def close(self):
+        """Flush pending samples and close all chunk files."""
+        self.flush()
+        for _, handle in self._files.values():
+            handle.close()
+        self._files = {}
+
+
+class StoreWatcher:
+    """
+    Wait for new data in the store without reading it.
+
+    The collector and its readers run in different pods on a network volume,
+    where inotify does not see remote writes, so the watcher polls the
+    metadata of the watermark file written after every flush. A poll is a
+    single stat() call; nothing is read until the watermark changes.
+    """
+
+    def __init__(self, store, poll_interval=0.5, debounce=1.0):
+        """
+        Initialize the watcher.
+
+        Args:
+            store: MetricsStore to watch
+            poll_interval: Seconds between two checks of the watermark
+            debounce: Seconds to wait after a change for further flushes to land
+        """
+        self.store = store
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._signature = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.store.watermark_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def wait(self, timeout=None):
+        """
+        Block until the watermark changes.
+
+        Args:
+            timeout: Maximum seconds to wait, or None to wait forever
+
+        Returns:
+            dict: Newest timestamp per series, or None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            signature = self._stat()
+            if signature is not None and signature != self._signature:
+                time.sleep(self.debounce)
+                self._signature = self._stat()
+                return self.store.read_watermark()
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+
+def import_csv(store, csv_path, series='cpu_usage', column='cpu_usage', batch_rows=100000):
+    """
+    Copy a legacy metrics.csv (timestamp, value) into the store.
+
+    Args:
+        store: Target MetricsStore
+        csv_path: Path of the CSV file
+        series: Name of the series to write
+        column: Name of the value column in the CSV
+        batch_rows: Rows parsed per batch
+
+    Returns:
+        int: Number of imported rows
+    """
+    import pandas as pd
+
+    imported = 0
+    for df in pd.read_csv(csv_path, parse_dates=['timestamp'], chunksize=batch_rows):
+        df = df.dropna(subset=['timestamp', column])
+        timestamps = df['timestamp'].astype('datetime64[ns]').astype('int64') / 1e9
+        store.append_many(series, timestamps.to_numpy(), df[column].to_numpy())
+        imported += len(df)
+    logger.info(f"Imported {imported} rows from {csv_path} into series {series}")
+    return imported
+
+
+class ChunkTailer:
+    """
+    Incrementally read the samples appended to one series.
+
+    The tailer keeps a byte offset into the newest chunk and only parses the
+    records written since the previous call, moving on when the collector
+    starts a new chunk. If the chunk it follows shrinks, is replaced or
+    disappears, it starts over from the last `lookback_seconds` of data and
+    reports a reset so callers can drop derived state.
+    """
+
+    def __init__(self, store, series, lookback_seconds=3600):
+        """
+        Initialize the tailer.
+
+        Args:
+            store: MetricsStore to read from
+            series: Name of the series to follow
+            lookback_seconds: History returned by the first call and after a reset
+        """
+        self.store = store
+        self.series = series
+        self.lookback_seconds = lookback_seconds
+        self.chunk_start = None
+        self.offset = 0
+        self.inode = None
+        self.resets = 0
+
+    def _read_from(self, path, offset, size):
+        count = (size - offset) // RECORD_DTYPE.itemsize
+        if count <= 0:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(count * RECORD_DTYPE.itemsize)
+        return np.frombuffer(data, dtype=RECORD_DTYPE, count=len(data) // RECORD_DTYPE.itemsize)
+
+    def _seed(self):
+        self.chunk_start = None
+        chunks = self.store.chunks(self.series)
+        last_timestamp = self.store.last_timestamp(self.series)
+        if not chunks or last_timestamp is None:
+            return np.empty(0, dtype=RECORD_DTYPE)
+
+        newest = chunks[-1]
+        stat = os.stat(self.store.chunk_path(self.series, newest))
+        since = last_timestamp - self.lookback_seconds
+        parts = [
+            self.store._read_chunk(self.series, chunk_start)
+            for chunk_start in chunks
+            if self.store.chunk_start(since) <= chunk_start < newest
+        ]
+        parts.append(self._read_from(self.store.chunk_path(self.series, newest), 0, stat.st_size))
+
+        self.chunk_start = newest
+        self.offset = stat.st_size - stat.st_size % RECORD_DTYPE.itemsize
+        self.inode = stat.st_ino
+        records = np.concatenate([p for p in parts if p is not None])
+        return records[records['timestamp'] >= since]
+
+    def _next_chunk(self):
+        # A newer chunk can only exist once the current one has ended
+        if time.time() < self.chunk_start + self.store.chunk_seconds:
+            return None
+        for chunk_start in self.store.chunks(self.series):
+            if chunk_start > self.chunk_start:
+                return chunk_start
+        return None
+
+    def read_new(self):
+        """
+        Read the samples appended since the previous call.
+
+        Returns:
+            tuple: (timestamps, values, reset) where reset is True when the
+            returned data restarts the stream instead of continuing it
+        """
+        reset = self.chunk_start is None
+        parts = []
+        if reset:
+            parts.append(self._seed())
+
+        while self.chunk_start is not None:
+            path = self.store.chunk_path(self.series, self.chunk_start)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+
+            replaced = self.inode is not None and stat is not None and stat.st_ino != self.inode
+            if stat is None or replaced or stat.st_size < self.offset:
+                logger.warning(f"Chunk {path} was truncated or replaced, re-reading series {self.series}")
+                self.resets += 1
+                reset = True
+                parts = [self._seed()]
+                continue
+
+            records = self._read_from(path, self.offset, stat.st_size)
+            parts.append(records)
+            self.offset += len(records) * RECORD_DTYPE.itemsize
+            self.inode = stat.st_ino
+
+            next_chunk = self._next_chunk()
+            if next_chunk is None:
+                break
+            self.chunk_start, self.offset, self.inode = next_chunk, 0, None
+
+        records = np.concatenate(parts) if parts else np.empty(0, dtype=RECORD_DTYPE)
+        return records['timestamp'].copy(), records['value'].copy(), reset
+
+
+class MinuteWindow:
+    """
+    Rolling window of per-bucket means kept in a fixed-size ring buffer.
+
+    Equivalent to resample("1min").mean().ffill().tail(size) over the full
+    history, but every update only costs O(new samples). The mean of the
+    newest bucket that left the ring is kept, so gaps at the start of a
+    window are filled from before it. The ring holds `capacity` buckets,
+    so windows can also end a few buckets before the newest one (e.g. at
+    the last complete minute).
+    """
+
+    def __init__(self, size=60, bucket_seconds=60, capacity=None):
+        self.size = size
+        self.capacity = max(capacity or size, size)
+        self.bucket_seconds = bucket_seconds
+        self.sums = np.zeros(self.capacity)
+        self.counts = np.zeros(self.capacity, dtype=np.int64)
+        self.buckets = np.full(self.capacity, -1, dtype=np.int64)
+        self.latest_bucket = None
+        self.first_bucket = None
+        # (bucket, sum, count) of the newest bucket that no longer fits in the ring
+        self.evicted = None
+
+    def clear(self):
+        self.sums[:] = 0
+        self.counts[:] = 0
+        self.buckets[:] = -1
+        self.latest_bucket = None
+        self.first_bucket = None
+        self.evicted = None
+
+    def _evict(self, bucket, total, count):
+        if self.evicted is None or bucket > self.evicted[0]:
+            self.evicted = (bucket, total, count)
+        elif bucket == self.evicted[0]:
+            self.evicted = (bucket, self.evicted[1] + total, self.evicted[2] + count)
+
+    def add(self, timestamps, values):
+        """Add samples (epoch seconds, values) to the window."""
+        if not len(timestamps):
+            return
+        buckets = (np.asarray(timestamps) // self.bucket_seconds).astype(np.int64)
+        values = np.asarray(values, dtype=float)
+
+        latest = int(buckets.max())
+        if self.latest_bucket is not None:
+            latest = max(latest, self.latest_bucket)
+        keep = buckets > latest - self.capacity
+        if not keep.all():
+            dropped = buckets[~keep]
+            newest = dropped == dropped.max()
+            self._evict(int(dropped.max()), float(values[~keep][newest].sum()), int(newest.sum()))
+        buckets, values = buckets[keep], values[keep]
+        if not len(buckets):
+            return
+
+        # Recycle slots that still hold an older bucket
+        new_buckets = np.unique(buckets)
+        slots = new_buckets % self.capacity
+        stale = self.buckets[slots] != new_buckets
+        recycled = slots[stale & (self.counts[slots] > 0)]
+        if len(recycled):
+            slot = recycled[np.argmax(self.buckets[recycled])]
+            self._evict(int(self.buckets[slot]), self.sums[slot], int(self.counts[slot]))
+        self.sums[slots[stale]] = 0
+        self.counts[slots[stale]] = 0
+        self.buckets[slots[stale]] = new_buckets[stale]
+
+        slots = buckets % self.capacity
+        np.add.at(self.sums, slots, values)
+        np.add.at(self.counts, slots, 1)
+
+        self.latest_bucket = latest
+        oldest = int(new_buckets[0])
+        if self.first_bucket is None or oldest < self.first_bucket:
+            self.first_bucket = oldest
+
+    def span(self, end_bucket=None):
+        """Number of buckets between the first one seen and end_bucket (default: the newest)."""
+        if self.latest_bucket is None:
+            return 0
+        end_bucket = self.latest_bucket if end_bucket is None else end_bucket
+        return max(0, end_bucket - self.first_bucket + 1)
+
+    def is_ready(self, end_bucket=None):
+        """True once a window ending at end_bucket spans `size` buckets."""
+        return self.span(end_bucket) >= self.size
+
+    def latest_time(self):
+        """Return the start (epoch seconds) of the newest bucket, or None."""
+        if self.latest_bucket is None:
+            return None
+        return self.latest_bucket * self.bucket_seconds
+
+    def values(self, end_bucket=None):
+        """
+        Return the bucket means in chronological order, forward filled.
+
+        Args:
+            end_bucket: Last bucket of the window, defaults to the newest one
+
+        Returns:
+            np.ndarray of length `size` ending at end_bucket, or None if the
+            window holds no data or end_bucket is out of the ring's range
+        """
+        if self.latest_bucket is None:
+            return None
+        end_bucket = self.latest_bucket if end_bucket is None else end_bucket
+        if end_bucket > self.latest_bucket or end_bucket - self.size < self.latest_bucket - self.capacity:
+            return None
+        wanted = np.arange(end_bucket - self.size + 1, end_bucket + 1)
+        slots = wanted % self.capacity
+        valid = (self.buckets[slots] == wanted) & (self.counts[slots] > 0)
+        if not valid.any():
+            return None
+        means = np.full(self.size, np.nan)
+        means[valid] = self.sums[slots[valid]] / self.counts[slots[valid]]
+
+        # Leading gaps carry the newest bucket before the window, from the ring
+        # or the last evicted one; back fill them only if nothing came before
+        first = np.argmax(valid)
+        if first:
+            carry = self.evicted if self.evicted is not None and self.evicted[0] < wanted[0] else None
+            before = np.flatnonzero((self.buckets < wanted[0]) & (self.counts > 0))
+            if len(before):
+                slot = before[np.argmax(self.buckets[before])]
+                if carry is None or self.buckets[slot] > carry[0]:
+                    carry = (self.buckets[slot], self.sums[slot], self.counts[slot])
+                elif self.buckets[slot] == carry[0]:
+                    # Samples of the bucket arrived both before and after it left the ring
+                    carry = (carry[0], carry[1] + self.sums[slot], carry[2] + self.counts[slot])
+            means[:first] = carry[1] / carry[2] if carry is not None else means[first]
+            valid[:first] = True
+
+        # Forward fill the remaining gaps
+        idx = np.where(valid, np.arange(self.size), 0)
+        np.maximum.accumulate(idx, out=idx)
+        return means[idx]
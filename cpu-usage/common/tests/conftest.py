@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The services import the common modules as top-level modules, from /code
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pytest
+
+from forecast_log import ForecastLog, ForecastTailer, COMPACTED_DIR, SEGMENTS_DIR
+
+HOUR = 1_700_000_000 // 3600 * 3600
+
+
+@pytest.fixture
+def log(tmp_path):
+    return ForecastLog(str(tmp_path / 'forecasts'))
+
+
+def issue(log, issue_time, value, model_version=1):
+    log.append('cpu_usage', issue_time, issue_time + 60 * np.arange(1, 61), np.full(60, value), model_version)
+
+
+def latest_per_target(records):
+    """Value of the newest issue for every target time"""
+    latest = {}
+    for record in records:
+        target = record['target_time']
+        if target not in latest or record['issue_time'] >= latest[target][0]:
+            latest[target] = (record['issue_time'], record['value'])
+    return {target: value for target, (_, value) in latest.items()}
+
+
+def test_compaction_keeps_the_latest_issue_per_target(log):
+    issue(log, HOUR, 1.0)
+    issue(log, HOUR + 60, 2.0)
+    # The issue at HOUR + 60 is written again, e.g. by a restarted predictor
+    issue(log, HOUR + 60, 3.0, model_version=2)
+    issue(log, HOUR + 3600, 4.0)
+    before = log.read_issues('cpu_usage')
+
+    assert log.compact('cpu_usage', before=HOUR + 3600) == 3
+    segments = os.listdir(os.path.join(log.root_path, 'cpu_usage', SEGMENTS_DIR))
+    assert len(segments) == 1
+    assert os.listdir(os.path.join(log.root_path, 'cpu_usage', COMPACTED_DIR)) == [f'{HOUR}.npy']
+
+    records = log.read_issues('cpu_usage')
+    np.testing.assert_array_equal(records, before)
+    assert len(records) == 3 * 60
+    rewritten = records[records['issue_time'] == HOUR + 60]
+    assert (rewritten['value'] == 3.0).all() and (rewritten['model_version'] == 2).all()
+
+    latest = latest_per_target(records)
+    assert latest[HOUR + 60] == 1.0
+    assert latest[HOUR + 120] == 3.0
+    assert latest[HOUR + 3660] == 4.0
+
+
+def test_compaction_merges_into_an_existing_compacted_file(log):
+    issue(log, HOUR, 1.0)
+    log.compact('cpu_usage', before=HOUR + 3600)
+    issue(log, HOUR, 5.0)
+    issue(log, HOUR + 120, 6.0)
+    log.compact('cpu_usage', before=HOUR + 3600)
+
+    records = log.read_issues('cpu_usage')
+    assert len(records) == 2 * 60
+    assert (records[records['issue_time'] == HOUR]['value'] == 5.0).all()
+    assert latest_per_target(records)[HOUR + 180] == 6.0
+
+
+def test_tailer_reads_segments_once_and_compacted_files_when_they_change(log):
+    tailer = ForecastTailer(log, 'cpu_usage')
+    issue(log, HOUR, 1.0)
+    assert len(tailer.read_new()) == 60
+    assert not len(tailer.read_new())
+
+    issue(log, HOUR + 60, 2.0)
+    log.compact('cpu_usage', before=HOUR + 3600)
+    records = tailer.read_new()
+    assert sorted(set(records['issue_time'])) == [HOUR, HOUR + 60]
+    assert not len(tailer.read_new())
+
+
+def test_latest_for_targets_picks_the_newest_issue(log):
+    issue(log, HOUR, 1.0)
+    issue(log, HOUR + 60, 2.0)
+    log.compact('cpu_usage', before=HOUR + 3600)
+    issue(log, HOUR + 3600, 3.0)
+
+    targets = [HOUR, HOUR + 60, HOUR + 120, HOUR + 3600, HOUR + 3660, HOUR + 3600 + 3600, HOUR + 9000]
+    values = log.latest_for_targets('cpu_usage', targets)
+    # Nothing is issued for its own issue time, nor beyond the horizon
+    np.testing.assert_array_equal(values, [np.nan, 1.0, 2.0, 2.0, 3.0, 3.0, np.nan])
+    assert not len(log.latest_for_targets('cpu_usage', []))
+
+
+def test_latest_for_targets_only_reads_files_within_the_horizon(log, monkeypatch):
+    for hour in range(5):
+        issue(log, HOUR + hour * 3600, float(hour))
+    log.compact('cpu_usage', before=HOUR + 4 * 3600)
+
+    loaded = []
+    load = np.load
+
+    def recording_load(path, *args, **kwargs):
+        loaded.append(os.path.basename(path))
+        return load(path, *args, **kwargs)
+
+    monkeypatch.setattr(np, 'load', recording_load)
+    values = log.latest_for_targets('cpu_usage', [HOUR + 3 * 3600 + 600])
+
+    np.testing.assert_array_equal(values, [3.0])
+    assert sorted(loaded) == [f'{HOUR + 2 * 3600}.npy', f'{HOUR + 3 * 3600}.npy']
+
+
+def test_compaction_deletes_hours_past_the_retention(tmp_path):
+    log = ForecastLog(str(tmp_path / 'forecasts'), retention_seconds=2 * 3600)
+    for hour in range(5):
+        issue(log, HOUR + hour * 3600, float(hour))
+    log.compact('cpu_usage', before=HOUR + 5 * 3600)
+
+    compacted = sorted(os.listdir(os.path.join(log.root_path, 'cpu_usage', COMPACTED_DIR)))
+    assert compacted == [f'{HOUR + 3 * 3600}.npy', f'{HOUR + 4 * 3600}.npy']
+
+
+def test_tailer_skips_compacted_files_before_min_issue_time(log, monkeypatch):
+    for hour in range(5):
+        issue(log, HOUR + hour * 3600, float(hour))
+    log.compact('cpu_usage', before=HOUR + 5 * 3600)
+    tailer = ForecastTailer(log, 'cpu_usage')
+
+    statted = []
+    stat = os.stat
+
+    def recording_stat(path, *args, **kwargs):
+        statted.append(os.path.basename(path))
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'stat', recording_stat)
+    records = tailer.read_new(min_issue_time=HOUR + 3 * 3600)
+    assert sorted(set(records['issue_time'])) == [HOUR + 3 * 3600, HOUR + 4 * 3600]
+    assert sorted(statted) == [f'{HOUR + 3 * 3600}.npy', f'{HOUR + 4 * 3600}.npy']
+    assert len(tailer._compacted) == 2
+    assert not len(tailer.read_new(min_issue_time=HOUR + 3 * 3600))
@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+import pytest
+
+from metrics_store import MetricsStore, BufferedWriter, ChunkTailer, MinuteWindow, RECORD_DTYPE
+
+# Some hour in the past, so the tailer may move past its chunks
+HOUR = 1_700_000_000 // 3600 * 3600
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MetricsStore(str(tmp_path / 'metrics'))
+
+
+def test_round_trip_across_hour_rollover(store):
+    timestamps = np.arange(HOUR + 3540, HOUR + 3660, 15, dtype=np.float64)
+    values = np.arange(len(timestamps), dtype=np.float64)
+    store.append_many('cpu_usage', timestamps, values)
+
+    assert store.chunks('cpu_usage') == [HOUR, HOUR + 3600]
+    read_timestamps, read_values = store.read_range('cpu_usage')
+    np.testing.assert_array_equal(read_timestamps, timestamps)
+    np.testing.assert_array_equal(read_values, values)
+
+    # Half-open interval spanning both chunks
+    read_timestamps, _ = store.read_range('cpu_usage', HOUR + 3585, HOUR + 3615)
+    np.testing.assert_array_equal(read_timestamps, [HOUR + 3585, HOUR + 3600])
+    assert store.last_timestamp('cpu_usage') == timestamps[-1]
+
+
+def test_buffered_writer_round_trip_across_hour_rollover(store):
+    writer = BufferedWriter(store, flush_rows=3, flush_seconds=3600)
+    timestamps = np.arange(HOUR + 3570, HOUR + 3630, 5, dtype=np.float64)
+    for timestamp in timestamps:
+        writer.append('cpu_usage', float(timestamp), timestamp - HOUR)
+    writer.close()
+
+    assert store.chunks('cpu_usage') == [HOUR, HOUR + 3600]
+    read_timestamps, read_values = store.read_range('cpu_usage')
+    np.testing.assert_array_equal(read_timestamps, timestamps)
+    np.testing.assert_array_equal(read_values, timestamps - HOUR)
+    assert store.read_watermark()['cpu_usage'] == timestamps[-1]
+
+
+def test_chunk_tailer_resumes_at_byte_offset(store):
+    store.append_many('cpu_usage', np.array([HOUR + 10.0, HOUR + 20.0]), [1.0, 2.0])
+    tailer = ChunkTailer(store, 'cpu_usage', lookback_seconds=3600)
+
+    timestamps, values, reset = tailer.read_new()
+    assert reset
+    np.testing.assert_array_equal(values, [1.0, 2.0])
+    assert tailer.offset == 2 * RECORD_DTYPE.itemsize
+
+    timestamps, values, reset = tailer.read_new()
+    assert not reset and not len(timestamps)
+
+    store.append_many('cpu_usage', np.array([HOUR + 30.0]), [3.0])
+    timestamps, values, reset = tailer.read_new()
+    assert not reset
+    np.testing.assert_array_equal(timestamps, [HOUR + 30.0])
+    assert tailer.offset == 3 * RECORD_DTYPE.itemsize
+
+    # A record that is only half written is picked up once it is complete
+    record = np.array([(HOUR + 40.0, 4.0)], dtype=RECORD_DTYPE).tobytes()
+    path = store.chunk_path('cpu_usage', HOUR)
+    with open(path, 'ab') as f:
+        f.write(record[:5])
+    timestamps, _, _ = tailer.read_new()
+    assert not len(timestamps)
+    with open(path, 'ab') as f:
+        f.write(record[5:])
+    timestamps, values, reset = tailer.read_new()
+    assert not reset
+    np.testing.assert_array_equal(values, [4.0])
+
+    # Moves on to the next chunk once the collector started it
+    store.append_many('cpu_usage', np.array([HOUR + 3600.0, HOUR + 3610.0]), [5.0, 6.0])
+    timestamps, values, reset = tailer.read_new()
+    assert not reset
+    np.testing.assert_array_equal(values, [5.0, 6.0])
+    assert (tailer.chunk_start, tailer.offset) == (HOUR + 3600, 2 * RECORD_DTYPE.itemsize)
+
+
+def test_chunk_tailer_resets_when_chunk_shrinks(store):
+    store.append_many('cpu_usage', np.array([HOUR + 10.0, HOUR + 20.0, HOUR + 30.0]), [1.0, 2.0, 3.0])
+    tailer = ChunkTailer(store, 'cpu_usage', lookback_seconds=3600)
+    tailer.read_new()
+
+    os.truncate(store.chunk_path('cpu_usage', HOUR), RECORD_DTYPE.itemsize)
+    timestamps, values, reset = tailer.read_new()
+    assert reset and tailer.resets == 1
+    np.testing.assert_array_equal(values, [1.0])
+
+
+def test_minute_window_matches_pandas_resample():
+    pd = pytest.importorskip('pandas')
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        timestamps = np.sort(rng.choice(np.arange(0, 400 * 60, 15), rng.integers(50, 400), replace=False))
+        gap_start, gap_end = rng.integers(0, 400, size=2) * 60
+        timestamps = timestamps[(timestamps <= gap_start) | (timestamps >= gap_end)].astype(np.float64)
+        values = rng.random(len(timestamps))
+
+        window = MinuteWindow(size=60, capacity=int(rng.integers(60, 70)))
+        for batch in np.array_split(np.arange(len(timestamps)), rng.integers(1, 10)):
+            window.add(timestamps[batch], values[batch])
+        if not window.is_ready():
+            continue
+
+        expected = pd.Series(values, index=pd.to_datetime(timestamps, unit='s'))
+        expected = expected.resample('1min').mean().ffill().tail(60).to_numpy()
+        np.testing.assert_allclose(window.values(), expected)
+
+
+def test_minute_window_fills_leading_gap_from_evicted_bucket():
+    window = MinuteWindow(size=3, capacity=3)
+    window.add([0.0, 30.0], [1.0, 3.0])
+    window.add([180.0], [5.0])
+
+    # Bucket 0 left the ring, its mean still fills the minutes before bucket 3
+    assert window.evicted == (0, 4.0, 2)
+    np.testing.assert_array_equal(window.values(), [2.0, 2.0, 5.0])
+
+
+def test_minute_window_span_and_end_bucket():
+    window = MinuteWindow(size=3, capacity=5)
+    assert window.values() is None and not window.is_ready()
+
+    window.add([60.0, 70.0, 180.0], [1.0, 3.0, 4.0])
+    assert window.span() == 3 and window.is_ready()
+    assert not window.is_ready(end_bucket=2)
+    assert window.latest_time() == 180
+    np.testing.assert_array_equal(window.values(), [2.0, 2.0, 4.0])
+
+    window.add([300.0], [6.0])
+    np.testing.assert_array_equal(window.values(end_bucket=4), [2.0, 4.0, 4.0])
+    # Ends past the newest bucket, or starts before the ring
+    assert window.values(end_bucket=6) is None
+    assert window.values(end_bucket=2) is None
+
+
+def test_find_gaps_reports_missing_intervals(store):
+    timestamps = np.concatenate([np.arange(HOUR + 10, HOUR + 40), np.arange(HOUR + 100, HOUR + 110)])
+    store.append_many('cpu_usage', timestamps.astype(np.float64), np.ones(len(timestamps)))
+
+    # Before the first sample, between the runs and after the last one
+    assert store.find_gaps('cpu_usage', HOUR, HOUR + 200, min_gap=3) == [
+        (HOUR, HOUR + 10), (HOUR + 39, HOUR + 100), (HOUR + 109, HOUR + 200)
+    ]
+    assert store.find_gaps('cpu_usage', HOUR + 10, HOUR + 40, min_gap=3) == []
+    assert store.find_gaps('memory_usage', HOUR, HOUR + 60, min_gap=3) == [(HOUR, HOUR + 60)]
@@ -1,10 +1,15 @@
 import pandas as pd
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import os
 from datetime import datetime, timedelta
 import logging
+from metrics_store import MetricsStore, ChunkTailer, MinuteWindow, StoreWatcher, RECORD_DTYPE
+from forecast_log import ForecastLog, FORECAST_DTYPE
+from instrumentation import Instrumentation, start_metrics_server
 
 # Set up logging configuration
 logging.basicConfig(
@@ -13,91 +18,287 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Latency, row and error metrics of the hot paths
+instrumentation = Instrumentation('predictor')
+
+class LocalModel:
+    """
+    Run the newest exported SavedModel in-process instead of calling KServe.
+    
+    Versions are exported to <model_dir>/<version>. The newest one is used,
+    or the one serving/stable names once deploy_model promoted a version,
+    so rolled back versions are never loaded. The model is kept in memory
+    and the directory is re-checked every reload_interval seconds. Linear
+    baselines run with NumPy from linear_model.npz, other versions need
+    tensorflow installed in the predictor image.
+    """
+
+    def __init__(self, model_dir, reload_interval=60):
+        self.tf = None
+        self.model_dir = model_dir
+        self.reload_interval = reload_interval
+        self.version = None
+        self._serve = None
+        self._last_check = None
+        self.maybe_reload()
+        if self._serve is None:
+            raise FileNotFoundError(f"No exported model found in {model_dir}")
+
+    def latest_version(self):
+        """Return the stable or highest version number with a complete SavedModel, or None"""
+        try:
+            with open(os.path.join(self.model_dir, "serving", "stable")) as f:
+                stable = f.read().strip()
+            if stable.isdigit() and os.path.exists(os.path.join(self.model_dir, stable, "saved_model.pb")):
+                return int(stable)
+        except FileNotFoundError:
+            pass
+        versions = [
+            int(name) for name in os.listdir(self.model_dir)
+            if name.isdigit() and os.path.exists(os.path.join(self.model_dir, name, "saved_model.pb"))
+        ]
+        return max(versions) if versions else None
+
+    def _load(self, version):
+        version_dir = os.path.join(self.model_dir, str(version))
+        linear_path = os.path.join(version_dir, "linear_model.npz")
+        if os.path.exists(linear_path):
+            linear = np.load(linear_path)
+            weights, bias = linear["weights"], linear["bias"]
+            return linear, lambda x: np.asarray(x)[:, :, 0] @ weights + bias
+
+        if self.tf is None:
+            import tensorflow as tf
+            self.tf = tf
+        loaded = self.tf.saved_model.load(version_dir)
+        serve_tensor = getattr(loaded, "serve", None)
+        if serve_tensor is None:
+            signature = loaded.signatures["serving_default"]
+            input_name = next(iter(signature.structured_input_signature[1]))
+            serve_tensor = lambda x: signature(**{input_name: x})
+        serve = lambda x: np.asarray(self._forecast(serve_tensor(self.tf.constant(x, dtype=self.tf.float32))))
+        # Warm up so the first real request does not pay for tracing
+        serve(np.zeros((1, 60, 1), dtype=np.float32))
+        return loaded, serve
+
+    @staticmethod
+    def _forecast(outputs):
+        """Pick the forecast out of the outputs of a serving function"""
+        if isinstance(outputs, dict):
+            return outputs["forecast"] if "forecast" in outputs else next(iter(outputs.values()))
+        return outputs
+
+    def maybe_reload(self):
+        """Load a newer model version if one appeared since the last check"""
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        version = self.latest_version()
+        if version is None or version == self.version:
+            return
+        try:
+            # Keep a reference to the loaded object, the serving function needs it alive
+            self._model, self._serve = self._load(version)
+            logger.info(f"Loaded local model version {version} from {self.model_dir}")
+            self.version = version
+        except Exception as e:
+            logger.error(f"Error loading model version {version}: {e}")
+
+    def predict(self, model_input):
+        """Predict for a batch of shape (N, 60, 1)"""
+        self.maybe_reload()
+        return self._serve(model_input)
+
+
 class Predictor:
-    def __init__(self, input_path, output_path, model_url):
+    def __init__(self, store_path, forecast_log_path, model_url, series=('cpu_usage',),
+                 max_batch_size=64, request_timeout=30, local_model=None, compact_interval=3600,
+                 forecast_retention_seconds=None):
         """
         Initialize the predictor.
         
         Args:
-            input_path: Path to the input CSV file with metrics
-            output_path: Path where predictions will be saved
+            store_path: Path to the metrics store written by the collector
+            forecast_log_path: Directory of the forecast log predictions are appended to
             model_url: URL of the deployed model endpoint
+            series: Names of the series to forecast
+            max_batch_size: Maximum number of windows sent in one request
+            request_timeout: Timeout of one prediction request in seconds
+            local_model: LocalModel to predict with in-process instead of model_url
+            compact_interval: Seconds between two compactions of the forecast log
+            forecast_retention_seconds: Age of the forecasts deleted by compaction, None to keep all
         """
-        self.input_path = input_path
-        self.output_path = output_path
+        self.store = MetricsStore(store_path)
+        self.series = list(series)
+        self.forecast_log = ForecastLog(forecast_log_path, retention_seconds=forecast_retention_seconds)
+        self.compact_interval = compact_interval
+        self._last_compaction = time.monotonic()
         self.model_url = model_url
-        self.last_prediction_time = None
+        self.max_batch_size = max_batch_size
+        self.request_timeout = request_timeout
+        self.local_model = local_model
+        self.last_prediction_time = {}
+        # Series already reported as not having a full window yet
+        self.filling = set()
+
+        # Rolling 60-minute input windows, fed incrementally from the store
+        self.tailers = {name: ChunkTailer(self.store, name, lookback_seconds=61 * 60) for name in self.series}
+        # One spare bucket so windows can end at the last complete minute
+        self.windows = {name: MinuteWindow(size=60, capacity=61) for name in self.series}
+        self.current_time = {}
+
+        # Keep-alive connections to KServe, retried on transient errors
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=["POST"])
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+
+    def update_windows(self):
+        """
+        Feed samples appended since the last call into the input windows.
+        
+        Returns:
+            dict: Timestamp of the newest sample seen per series with data
+        """
+        rows = 0
+        with instrumentation.timer('update_windows'):
+            for name in self.series:
+                timestamps, values, reset = self.tailers[name].read_new()
+                if reset:
+                    self.windows[name].clear()
+                    self.current_time.pop(name, None)
+                if len(timestamps):
+                    self.windows[name].add(timestamps, values)
+                    newest = float(timestamps.max())
+                    self.current_time[name] = max(self.current_time.get(name, newest), newest)
+                rows += len(timestamps)
+        instrumentation.count('update_windows', rows, rows * RECORD_DTYPE.itemsize)
+        return self.current_time
+
+    def predict_batch(self, windows):
+        """
+        Run one prediction for a stack of input windows, either in-process
+        or as one request to the model endpoint.
+        
+        During a canary rollout the requests of one batch may be answered
+        by different revisions, so the version is taken from every
+        prediction in the response rather than looked up separately.
+        
+        Args:
+            windows: Array of shape (N, 60) with one input window per row
+        
+        Returns:
+            tuple: (predictions of shape (N, 60), model version per row, -1 if unknown)
+        """
+        model_input = windows.reshape(len(windows), 60, 1)
+        
+        if self.local_model is not None:
+            with instrumentation.timer('local_inference'):
+                predictions = self.local_model.predict(model_input).reshape(len(windows), -1)
+            return predictions, np.full(len(windows), self.local_model.version, dtype=np.int64)
+        
+        # Prepare payload for API request
+        payload = {
+            "instances": model_input.tolist()
+        }
+        
+        # Make prediction request
+        with instrumentation.timer('kserve_request'):
+            response = self.session.post(self.model_url, json=payload, timeout=self.request_timeout)
+            response.raise_for_status()
+        instrumentation.count('kserve_request', len(windows), len(response.content))
+        predictions = response.json()["predictions"]
+        if predictions and isinstance(predictions[0], dict):
+            forecasts = np.array([prediction["forecast"] for prediction in predictions])
+            versions = np.array([prediction["model_version"] for prediction in predictions], dtype=np.int64)
+        else:
+            # Versions exported before the forecasts were tagged return the bare forecast
+            forecasts = np.array(predictions)
+            versions = np.full(len(windows), -1, dtype=np.int64)
+        return forecasts.reshape(len(windows), -1), versions
     
-    def predict_next_60_minutes(self):
+    def predict_next_60_minutes(self, series=None, end_buckets=None):
         """
         Make predictions for the next 60 minutes based on the last 60 minutes of data.
         
+        The windows of all requested series are stacked into as few requests
+        as possible. Uses the windows as of the last update_windows() call.
+        
+        Args:
+            series: Names of the series to forecast, defaults to all series
+            end_buckets: Last minute bucket of the input window per series,
+                defaults to the newest (possibly incomplete) minute
+        
         Returns:
-            tuple: (predictions array, last timestamp) or (None, None) if error occurs
+            dict: (predictions array, last timestamp, model version) per series that could be forecast
         """
-        try:
-            df = pd.read_csv(self.input_path, parse_dates=["timestamp"], index_col="timestamp")
-            df = df.resample("1min").mean().ffill()
-            last_60_minutes = np.array(df['cpu_usage'].tail(60))
-            last_timestamp = df.index[-1]
-            
+        start = time.perf_counter()
+        end_buckets = end_buckets or {}
+        ready, inputs = [], []
+        for name in series or self.series:
+            window = self.windows[name]
+            end_bucket = end_buckets.get(name)
+            values = window.values(end_bucket)
             # Check if we have enough data
-            if len(last_60_minutes) < 60:
-                logger.error(f"Insufficient data points: {len(last_60_minutes)}")
-                return None, None
-            
-            model_input = last_60_minutes.reshape(1, 60, 1)
-            
-            # Prepare payload for API request
-            payload = {
-                "instances": model_input.tolist()
-            }
-            
-            # Make prediction request
-            response = requests.post(self.model_url, json=payload)
-            response.raise_for_status()
-            predictions = np.array(response.json()["predictions"]).flatten()
-            
-            return predictions, last_timestamp
-            
-        except Exception as e:
-            logger.error(f"Error during prediction: {e}")
-            return None, None
+            if values is None or not window.is_ready(end_bucket):
+                # Expected for an hour after every start, warn once per series
+                log = logger.debug if name in self.filling else logger.warning
+                log(f"Insufficient data points for {name}: {window.span(end_bucket)}")
+                self.filling.add(name)
+                continue
+            self.filling.discard(name)
+            ready.append(name)
+            inputs.append(values)
+        
+        results = {}
+        for i in range(0, len(ready), self.max_batch_size):
+            names = ready[i:i + self.max_batch_size]
+            try:
+                predictions, versions = self.predict_batch(np.stack(inputs[i:i + self.max_batch_size]))
+            except Exception as e:
+                instrumentation.error('predict_next_60_minutes')
+                logger.error(f"Error during prediction: {e}")
+                continue
+            for name, prediction, version in zip(names, predictions, versions):
+                end_bucket = end_buckets.get(name, self.windows[name].latest_bucket)
+                last_timestamp = pd.to_datetime(end_bucket * 60, unit='s')
+                results[name] = (prediction, last_timestamp, int(version))
+        instrumentation.observe('predict_next_60_minutes', time.perf_counter() - start)
+        return results
     
-    def save_predictions(self, predictions, last_timestamp):
+    def save_predictions(self, predictions, last_timestamp, series=None, model_version=-1):
         """
-        Save predictions to CSV file.
+        Append predictions to the forecast log.
         
         Args:
             predictions: Array of predicted values
-            last_timestamp: Timestamp of the last input data point
+            last_timestamp: Timestamp of the last input data point, used as issue time
+            series: Name of the forecast series, defaults to the first series
+            model_version: Version of the model that made the predictions, -1 if unknown
         """
+        series = series or self.series[0]
         try:
             # Generate timestamps for predictions
-            future_timestamps = [last_timestamp + pd.Timedelta(minutes=i+1) for i in range(60)]
-            
-            # Create DataFrame with predictions
-            predictions_df = pd.DataFrame({
-                'timestamp': future_timestamps,
-                'predicted_cpu_usage': predictions
-            })
-            
-            # If file exists, append new predictions
-            if os.path.exists(self.output_path):
-                existing_df = pd.read_csv(self.output_path, parse_dates=['timestamp'])
-                existing_df['timestamp'] = pd.to_datetime(existing_df['timestamp'])
-                
-                # Remove predictions that overlap with new ones
-                existing_df = existing_df[existing_df['timestamp'] < future_timestamps[0]]
-                
-                # Concatenate existing and new predictions
-                predictions_df = pd.concat([existing_df, predictions_df])
+            issue_time = last_timestamp.timestamp()
+            target_times = issue_time + 60 * np.arange(1, len(predictions) + 1)
+            with instrumentation.timer('save_predictions'):
+                self.forecast_log.append(series, issue_time, target_times, predictions, model_version)
+            instrumentation.count('save_predictions', len(predictions), len(predictions) * FORECAST_DTYPE.itemsize)
+            logger.info(
+                f"Saved {series} predictions from {pd.to_datetime(target_times[0], unit='s')} "
+                f"to {pd.to_datetime(target_times[-1], unit='s')}"
+            )
             
-            # Save to file
-            predictions_df.to_csv(self.output_path, index=False)
-            logger.info(f"Saved predictions from {future_timestamps[0]} to {future_timestamps[-1]}")
+            # Merge the segments of past hours once per hour
+            if time.monotonic() - self._last_compaction >= self.compact_interval:
+                with instrumentation.timer('compact_forecasts'):
+                    for name in self.series:
+                        self.forecast_log.compact(name)
+                self._last_compaction = time.monotonic()
             
         except Exception as e:
+            instrumentation.error('save_predictions')
             logger.error(f"Error while saving predictions: {e}")
     
     def run_prediction_loop(self, interval_seconds=60):
@@ -108,26 +309,31 @@ class Predictor:
             interval_seconds: Number of seconds to wait between predictions
         """
         logger.info("Starting prediction loop...")
+        next_due = time.monotonic()
         
         while True:
+            # Late when the sleep or the previous iteration overran
+            iteration_start = time.monotonic()
+            instrumentation.lag('poll', max(iteration_start - next_due, 0.0))
+            next_due = iteration_start + interval_seconds
             try:
-                # Check if input file exists
-                if not os.path.exists(self.input_path):
-                    logger.warning(f"Input file not found: {self.input_path}")
+                # Check for new data
+                current_time = self.update_windows()
+                if not current_time:
+                    logger.warning(f"No data found for series {', '.join(self.series)}")
                     time.sleep(interval_seconds)
                     continue
                 
-                # Check for new data
-                df = pd.read_csv(self.input_path, parse_dates=["timestamp"])
-                current_time = pd.to_datetime(df['timestamp']).max()
-                
-                # Make predictions if new data is available
-                if self.last_prediction_time is None or current_time > self.last_prediction_time:
-                    predictions, last_timestamp = self.predict_next_60_minutes()
-                    
-                    if predictions is not None and last_timestamp is not None:
-                        self.save_predictions(predictions, last_timestamp)
-                        self.last_prediction_time = current_time
+                # Make predictions for the series with new data, in one batch
+                updated = [
+                    name for name, timestamp in current_time.items()
+                    if name not in self.last_prediction_time or timestamp > self.last_prediction_time[name]
+                ]
+                if updated:
+                    for name, (predictions, last_timestamp, model_version) in self.predict_next_60_minutes(updated).items():
+                        self.save_predictions(predictions, last_timestamp, name, model_version)
+                        self.last_prediction_time[name] = current_time[name]
+                    instrumentation.observe('iteration', time.monotonic() - iteration_start)
                 else:
                     logger.info("No new data to process")
                 
@@ -135,15 +341,89 @@ class Predictor:
                 time.sleep(interval_seconds)
                 
             except Exception as e:
+                instrumentation.error('iteration')
                 logger.error(f"Error in prediction loop: {e}")
                 time.sleep(interval_seconds)
 
+    def run_event_loop(self, watcher, max_wait=300):
+        """
+        Predict as soon as a new 1-minute bucket is complete.
+        
+        Instead of waking up on a fixed interval, wait for the collector to
+        flush new data (see StoreWatcher) and forecast every series whose
+        newest complete minute moved forward. No chunk is read while
+        nothing changes.
+        
+        Args:
+            watcher: StoreWatcher on the metrics store
+            max_wait: Seconds after which an idle wait is logged and restarted
+        """
+        logger.info("Starting event-driven prediction loop...")
+        last_buckets = {}
+        
+        while True:
+            try:
+                watermark = watcher.wait(timeout=max_wait)
+                if watermark is None:
+                    logger.info("No new data to process")
+                    continue
+                
+                # A bucket is complete once a sample from a later minute was flushed
+                complete = {
+                    name: int(watermark[name] // 60) - 1
+                    for name in self.series if name in watermark
+                }
+                due = [name for name, bucket in complete.items() if bucket > last_buckets.get(name, -1)]
+                if not due:
+                    continue
+                
+                # Time since the oldest due minute was complete
+                iteration_start = time.monotonic()
+                instrumentation.lag('event', time.time() - (min(complete[name] for name in due) + 1) * 60)
+                self.update_windows()
+                results = self.predict_next_60_minutes(due, end_buckets=complete)
+                for name, (predictions, last_timestamp, model_version) in results.items():
+                    self.save_predictions(predictions, last_timestamp, name, model_version)
+                    last_buckets[name] = complete[name]
+                instrumentation.observe('iteration', time.monotonic() - iteration_start)
+                
+            except Exception as e:
+                instrumentation.error('iteration')
+                logger.error(f"Error in prediction loop: {e}")
+                time.sleep(watcher.poll_interval)
+
 if __name__ == "__main__":
+    # Expose the hot path metrics on METRICS_PORT
+    start_metrics_server()
+
+    # Optionally serve the model exported to the shared PVC in-process
+    local_model = None
+    if os.getenv("INFERENCE_BACKEND", "remote") == "local":
+        local_model = LocalModel(
+            model_dir=os.getenv("MODEL_DIR", "/data/cpu-usage-forecaster"),
+            reload_interval=int(os.getenv("MODEL_RELOAD_INTERVAL", 60))
+        )
+
     # Initialize and run the predictor
     predictor = Predictor(
-        input_path="/data/metrics.csv",
-        output_path="/data/predictions.csv",
-        model_url="http://cpu-usage-forecaster-predictor-00001-private/v1/models/cpu-usage-forecaster:predict"
+        store_path=os.getenv("METRICS_STORE_PATH", "/data/metrics"),
+        forecast_log_path=os.getenv("FORECAST_LOG_PATH", "/data/forecasts"),
+        # The InferenceService route, which follows the canary traffic split
+        model_url=os.getenv(
+            "MODEL_URL", "http://cpu-usage-forecaster-predictor/v1/models/cpu-usage-forecaster:predict"
+        ),
+        series=os.getenv("PREDICT_SERIES", "cpu_usage").split(","),
+        max_batch_size=int(os.getenv("MAX_BATCH_SIZE", 64)),
+        local_model=local_model,
+        forecast_retention_seconds=float(os.getenv("FORECAST_RETENTION_HOURS", 168)) * 3600
     )
     
-    predictor.run_prediction_loop()
\ No newline at end of file
+    if os.getenv("PREDICTOR_MODE", "poll") == "event":
+        watcher = StoreWatcher(
+            predictor.store,
+            poll_interval=float(os.getenv("WATCH_POLL_INTERVAL", 0.5)),
+            debounce=float(os.getenv("WATCH_DEBOUNCE", 1))
+        )
+        predictor.run_event_loop(watcher)
+    else:
+        predictor.run_prediction_loop()
\ No newline at end of file
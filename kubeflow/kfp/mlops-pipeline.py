@@ -2,82 +2,700 @@ from kfp import dsl
 from kfp import kubernetes
 import kfp.compiler as compiler
 import json
+from typing import List
 
 @dsl.component(base_image="python:3.10", packages_to_install=["pandas", "numpy", "pathlib"])
-def prepare_data(hours_back: int = 3):
-    """Prepare time series data for training"""
+def prepare_data(
+    hours_back: int = 3,
+    series: str = "cpu_usage",
+    resample_rule: str = "1min",
+    retention_hours: int = 24,
+    data_root: str = "/data",
+) -> str:
+    """
+    Prepare time series data for training, one column per comma-separated series.
+
+    Every chunk of the metrics store is resampled into an immutable partition
+    named after the hash of its content, so chunks that did not change since
+    the last run are not read into pandas again. The partitions are joined
+    into a dataset directory keyed by the hash of its inputs, which is
+    reused as-is when nothing changed. Returns the dataset directory.
+    """
+    import hashlib
+    import json
+    import os
+    import shutil
+    import tempfile
+    import time
+    import numpy as np
     import pandas as pd
     from datetime import datetime, timedelta
     from pathlib import Path
 
-    path = Path("/data/metrics.csv")
-    df = pd.read_csv(path, parse_dates=["timestamp"], index_col="timestamp")
-    df = df.resample("1min").mean().ffill()
+    # Read only the newest chunks of the metrics store written by the collector
+    # (see cpu-usage/common/metrics_store.py for the layout)
+    store_path = Path(data_root, "metrics")
+    datasets_path = Path(data_root, "datasets")
+    store_index = json.loads((store_path / "index.json").read_text())
+    chunk_seconds = store_index["chunk_seconds"]
+    n_chunks = -(-hours_back * 3600 // chunk_seconds) + 1
+    record_dtype = np.dtype([("timestamp", "<f8"), ("value", "<f8")])
+    partition_dtype = np.dtype([("timestamp", "<f8"), ("sum", "<f8"), ("count", "<i8")])
+
+    def save_atomic(path, array):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+    def load_partition(name, chunk_start):
+        """Per-bucket sums and counts of one chunk, cached by the hash of its bytes"""
+        chunk_path = store_path / name / f"{chunk_start}.bin"
+        raw = chunk_path.read_bytes()
+        raw = raw[:len(raw) - len(raw) % record_dtype.itemsize]
+        key = hashlib.sha256(f"{name}\0{resample_rule}\0".encode() + raw).hexdigest()[:16]
+        partition_dir = datasets_path / "partitions" / name
+        partition_path = partition_dir / f"{chunk_start}-{key}.npy"
+        if partition_path.exists():
+            return key, np.load(partition_path)
+
+        records = np.frombuffer(raw, dtype=record_dtype)
+        index = pd.to_datetime(records["timestamp"], unit="s")
+        buckets = pd.Series(records["value"], index=index).resample(resample_rule).agg(["sum", "count"])
+        buckets = buckets[buckets["count"] > 0]
+        partition = np.empty(len(buckets), dtype=partition_dtype)
+        partition["timestamp"] = buckets.index.to_numpy(dtype="datetime64[s]").astype(np.float64)
+        partition["sum"] = buckets["sum"].to_numpy()
+        partition["count"] = buckets["count"].to_numpy()
+        save_atomic(partition_path, partition)
+        # Partitions of earlier contents of the same chunk are superseded
+        for old_path in partition_dir.glob(f"{chunk_start}-*.npy"):
+            if old_path != partition_path:
+                old_path.unlink(missing_ok=True)
+        return key, partition
+
+    names = series.split(",")
+    keys = []
+    columns = {}
+    for name in names:
+        parts = []
+        for chunk_start in store_index["series"].get(name, {}).get("chunks", [])[-n_chunks:]:
+            key, partition = load_partition(name, chunk_start)
+            keys.append(key)
+            parts.append(partition)
+        partitions = np.concatenate(parts) if parts else np.empty(0, dtype=partition_dtype)
+        if not len(partitions):
+            raise ValueError(f"No data for series {name} in the newest {n_chunks} chunks of {store_path}")
+
+        # Buckets can span two chunks when the rule does not divide the chunk length
+        timestamps, inverse = np.unique(partitions["timestamp"], return_inverse=True)
+        sums = np.bincount(inverse, weights=partitions["sum"])
+        counts = np.bincount(inverse, weights=partitions["count"])
+        index = pd.to_datetime(timestamps, unit="s")
+        index.name = "timestamp"
+        column = pd.Series(sums / counts, index=index)
+        columns[name] = column.reindex(pd.date_range(index.min(), index.max(), freq=resample_rule))
 
-    cutoff_time = df.index.max() - timedelta(hours=hours_back)
-    df_filtered = df[df.index > cutoff_time]
-    df_filtered = df_filtered.dropna()
+    dataset_key = hashlib.sha256(
+        json.dumps({"series": names, "resample_rule": resample_rule, "hours_back": hours_back, "partitions": keys}).encode()
+    ).hexdigest()[:16]
+    dataset_dir = datasets_path / dataset_key
+    if dataset_dir.exists():
+        print(f"Reusing dataset {dataset_dir}")
+    else:
+        df = pd.DataFrame(columns).ffill()
+
+        cutoff_time = df.index.max() - timedelta(hours=hours_back)
+        df_filtered = df[df.index > cutoff_time]
+        df_filtered = df_filtered.dropna()
+
+        # Write to a temporary directory and rename it, datasets are never modified
+        datasets_path.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f"{dataset_key}.", suffix=".tmp", dir=datasets_path))
+        np.save(tmp_dir / "timestamps.npy", df_filtered.index.to_numpy(dtype="datetime64[s]").astype(np.int64))
+        np.save(tmp_dir / "values.npy", df_filtered.to_numpy(dtype=np.float64))
+        (tmp_dir / "meta.json").write_text(json.dumps({
+            "series": names,
+            "resample_rule": resample_rule,
+            "hours_back": hours_back,
+            "start": df_filtered.index.min().isoformat(),
+            "end": df_filtered.index.max().isoformat(),
+        }))
+        try:
+            os.rename(tmp_dir, dataset_dir)
+            print(f"Wrote dataset {dataset_dir} with {len(df_filtered)} rows")
+        except OSError:
+            # A concurrent run wrote the same inputs first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not dataset_dir.exists():
+                raise
+            print(f"Reusing dataset {dataset_dir} written by a concurrent run")
+
+    # Drop datasets nobody asked for since retention_hours
+    os.utime(dataset_dir)
+    for path in datasets_path.iterdir():
+        if path.name != "partitions" and path != dataset_dir and path.stat().st_mtime < time.time() - retention_hours * 3600:
+            shutil.rmtree(path, ignore_errors=True)
     
-    df_filtered.to_csv("/data/data.csv")
+    return str(dataset_dir)
 
 
 @dsl.component(
     base_image="python:3.10",
     packages_to_install=["tensorflow", "numpy", "pandas", "model_registry", "scikit-learn", "pathlib"],
 )
-def train_model(model_name: str, model_version: str, author: str, model_pvc: str):
-    """Train LSTM model for time series forecasting"""
+def train_model(
+    dataset_path: str,
+    model_name: str,
+    model_version: str,
+    author: str,
+    candidate: str = "lstm",
+    lstm_units: int = 64,
+    dense_units: str = "128,64",
+    learning_rate: float = 1e-3,
+    batch_size: int = 256,
+    shuffle_buffer_size: int = 10000,
+    cache_dir: str = "/tmp/tf-data-cache",
+    max_epochs: int = 50,
+    time_budget_minutes: float = 0.0,
+    patience: int = 5,
+    warm_start: bool = False,
+    fine_tune_learning_rate: float = 1e-4,
+) -> str:
+    """
+    Train LSTM model for time series forecasting and stage it as a candidate
+    for select_model. Returns the candidate name.
+    """
+    import json
     import tensorflow as tf
     import numpy as np
     import pandas as pd
     import os
+    import time
     from model_registry import ModelRegistry
     from pathlib import Path
     
-    path = Path("/data/data.csv")
-    df = pd.read_csv(path, parse_dates=["timestamp"], index_col="timestamp")
+    # Values taken from ParallelFor items arrive as JSON numbers
+    lstm_units, batch_size = int(lstm_units), int(batch_size)
+    
+    # Dataset written by prepare_data: timestamps (rows,) and values (rows, series)
+    dataset = Path(dataset_path)
+    timestamps = np.load(dataset / "timestamps.npy")
+    dataset_values = np.load(dataset / "values.npy")
+    n_rows, n_series = dataset_values.shape
     
     input_sequence_length = 60
     output_sequence_length = 60
+    window_length = input_sequence_length + output_sequence_length
     
-    X, y = [], []
-    for i in range(len(df) - (input_sequence_length + output_sequence_length)):
-        X.append(df[i:i + input_sequence_length])
-        y.append(df[i + input_sequence_length:i + input_sequence_length + output_sequence_length])
+    model_dir = f'/models/{model_name}'
+    # Keras checkpoints live next to the numeric version directories, which
+    # TF Serving ignores, so a later run can continue training from them
+    checkpoint_dir = os.path.join(model_dir, "checkpoints")
+    candidate_dir = os.path.join(model_dir, "candidates", model_version, candidate)
+    training_cutoff = pd.Timestamp(timestamps[-1], unit="s")
+    
+    # Same helper as in fit_baselines, so all candidates share their validation windows
+    def window_split(n_rows, n_series):
+        """Per series, the ranges of training and validation window starts, split 80/20 in time"""
+        n_windows = max(n_rows - window_length + 1, 0)
+        train_size = int(0.8 * n_windows)
+        return [(range(0, train_size), range(train_size, n_windows))] * n_series
 
-    X, y = np.array(X), np.array(y)
+    # All series back to back in one float32 array. A window is identified by
+    # its start offset; windows never cross series, and every series is split
+    # in time so its validation windows come after its training windows.
+    values = np.ascontiguousarray(dataset_values.T, dtype=np.float32).ravel()
+    split = window_split(n_rows, n_series)
+    train_starts = np.concatenate([column * n_rows + np.array(train) for column, (train, _) in enumerate(split)])
+    val_starts = np.concatenate([column * n_rows + np.array(val) for column, (_, val) in enumerate(split)])
+    
+    # Warm start: fine-tune the version deploy_model promoted (or, before the
+    # first canary rollout, the newest version) on the training windows since
+    # its cutoff, if it has a Keras checkpoint and this candidate's architecture.
+    # Versions rolled back by the canary gate are never continued from.
+    base_model, base_version = None, None
+    stable_path = Path(model_dir, "serving", "stable")
+    if warm_start:
+        try:
+            registry = ModelRegistry(
+                server_address="http://model-registry-service.kubeflow.svc.cluster.local",
+                port=8080,
+                author=author,
+                is_secure=False
+            )
+            versions = sorted(
+                (
+                    version for version in registry.get_model_versions(model_name)
+                    if version.name.isdigit() and version.name != model_version
+                ),
+                key=lambda version: int(version.name),
+                reverse=True,
+            )
+            if stable_path.exists():
+                stable_version = stable_path.read_text().strip()
+                versions = [version for version in versions if version.name == stable_version]
+            # Versions served by a baseline have no checkpoint to continue from
+            latest = next(
+                (version for version in versions
+                 if os.path.exists(os.path.join(checkpoint_dir, f"{version.name}.keras"))),
+                None,
+            )
+            if latest is not None:
+                properties = latest.custom_properties or {}
+                # Versions registered before the sweep all used the default architecture
+                architecture = (int(properties.get("lstm_units", 64)), properties.get("dense_units", "128,64"))
+                if architecture != (lstm_units, dense_units):
+                    print(f"Version {latest.name} has another architecture, training from scratch")
+                    latest = None
+            if latest is not None:
+                base_model = tf.keras.models.load_model(os.path.join(checkpoint_dir, f"{latest.name}.keras"))
+                base_version = latest.name
+                previous_cutoff = properties.get("training_cutoff")
+                if previous_cutoff:
+                    # Keep one window of context before the cutoff so the first
+                    # new minutes can be forecast targets too
+                    start = pd.Timestamp(previous_cutoff) - pd.Timedelta(minutes=window_length - 1)
+                    first_row = int(np.searchsorted(timestamps, start.timestamp()))
+                    recent = train_starts[train_starts % n_rows >= first_row]
+                    if len(recent):
+                        train_starts = recent
+                print(f"Warm start from version {base_version} on {len(train_starts)} training windows")
+            else:
+                print("No checkpoint of a registered version found, training from scratch")
+        except Exception as e:
+            print(f"Warm start not possible, training from scratch: {e}")
     
-    train_size = int(0.8 * len(X))
-    X_train, X_test = X[:train_size], X[train_size:]
-    y_train, y_test = y[:train_size], y[train_size:]
+    series_values = tf.constant(values)
     
-    train_dataset = tf.data.Dataset.from_tensor_slices((X_train, y_train)).batch(32)
-    test_dataset = tf.data.Dataset.from_tensor_slices((X_test, y_test)).batch(32)
+    def cut_window(start):
+        window = series_values[start:start + window_length]
+        return window[:input_sequence_length, tf.newaxis], window[input_sequence_length:]
     
-    model = tf.keras.models.Sequential([
-        tf.keras.layers.LSTM(64, input_shape=(60, 1), return_sequences=True),
-        tf.keras.layers.LSTM(64, return_sequences=False),
-        tf.keras.layers.Dense(128, activation='relu'),
-        tf.keras.layers.Dense(64, activation='relu'),
-        tf.keras.layers.Dense(60)
-    ])
+    def window_dataset(starts):
+        """Stream windows cut from the series instead of materializing all of them up front"""
+        return tf.data.Dataset.from_tensor_slices(starts).map(
+            cut_window, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False
+        )
     
-    model.compile(
-        optimizer='adam',
-        loss='mse',
-        metrics=['mae']
+    # Windows are cut once and cached to a local file, then reshuffled every epoch
+    os.makedirs(cache_dir, exist_ok=True)
+    train_dataset = (
+        window_dataset(train_starts)
+        .cache(os.path.join(cache_dir, "train"))
+        .shuffle(shuffle_buffer_size)
+        .batch(batch_size)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+    val_dataset = (
+        window_dataset(val_starts)
+        .cache(os.path.join(cache_dir, "validation"))
+        .batch(batch_size)
+        .prefetch(tf.data.AUTOTUNE)
     )
     
-    history = model.fit(train_dataset, epochs=50)
+    if base_model is not None:
+        model = base_model
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate=fine_tune_learning_rate),
+            loss='mse',
+            metrics=['mae']
+        )
+    else:
+        model = tf.keras.models.Sequential([
+            tf.keras.layers.LSTM(lstm_units, input_shape=(60, 1), return_sequences=True),
+            tf.keras.layers.LSTM(lstm_units, return_sequences=False),
+            *[tf.keras.layers.Dense(int(units), activation='relu') for units in dense_units.split(",") if units],
+            tf.keras.layers.Dense(60)
+        ])
+        
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+            loss='mse',
+            metrics=['mae']
+        )
     
-    # Create versioned directory structure
-    model_dir = f'/models/{model_name}'
-    version_dir = os.path.join(model_dir, model_version)
-    os.makedirs(version_dir, exist_ok=True)
+    class TimeBudget(tf.keras.callbacks.Callback):
+        """Stop before the next epoch would run past the wall-clock budget"""
+
+        def __init__(self, seconds):
+            super().__init__()
+            self.seconds = seconds
+
+        def on_train_begin(self, logs=None):
+            self.start = time.monotonic()
+
+        def on_epoch_end(self, epoch, logs=None):
+            elapsed = time.monotonic() - self.start
+            if elapsed + elapsed / (epoch + 1) > self.seconds:
+                print(f"Stopping after epoch {epoch + 1}: time budget of {self.seconds:.0f}s reached")
+                self.model.stop_training = True
+
+    # Stop once the held-out windows stop improving and keep the best epoch's weights
+    has_validation = len(val_starts) > 0
+    monitor = "val_loss" if has_validation else "loss"
+    callbacks = [tf.keras.callbacks.EarlyStopping(monitor=monitor, patience=patience, restore_best_weights=True)]
+    if time_budget_minutes > 0:
+        callbacks.append(TimeBudget(time_budget_minutes * 60))
     
-    # Save model
-    model.export(version_dir)
+    training_start = time.monotonic()
+    history = model.fit(
+        train_dataset,
+        validation_data=val_dataset if has_validation else None,
+        epochs=max_epochs,
+        callbacks=callbacks,
+    )
+    training_seconds = time.monotonic() - training_start
+    best_epoch = int(np.argmin(history.history[monitor]))
+    
+    # Stage the model for serving, and as a Keras checkpoint for warm starts
+    os.makedirs(candidate_dir, exist_ok=True)
+    model.export(os.path.join(candidate_dir, "saved_model"))
+    model.save(os.path.join(candidate_dir, "model.keras"))
     
+    metadata = {
+        "model_family": "lstm",
+        "parameters": int(model.count_params()),
+        "lstm_units": lstm_units,
+        "dense_units": dense_units,
+        "learning_rate": learning_rate,
+        "batch_size": batch_size,
+        "loss": float(history.history['loss'][best_epoch]),
+        "mae": float(history.history['mae'][best_epoch]),
+        "epochs": len(history.history['loss']),
+        "best_epoch": best_epoch + 1,
+        "training_seconds": round(training_seconds, 1),
+        "training_cutoff": training_cutoff.isoformat(),
+    }
+    if base_version is not None:
+        metadata["warm_start_from"] = base_version
+    if has_validation:
+        metadata["val_loss"] = float(history.history['val_loss'][best_epoch])
+        metadata["val_mae"] = float(history.history['val_mae'][best_epoch])
+    Path(candidate_dir, "metrics.json").write_text(json.dumps(metadata))
+    return candidate
+
+
+@dsl.component(base_image="python:3.10", packages_to_install=["numpy", "pandas", "pathlib"])
+def fit_baselines(
+    dataset_path: str,
+    model_name: str,
+    model_version: str,
+    families: str = "naive,seasonal_naive,ewma,holt_winters,ridge",
+    season_length: int = 30,
+    ridge_alpha: float = 1e-3,
+):
+    """
+    Fit NumPy-only baseline forecasters and stage them as candidates for select_model.
+
+    Every baseline maps the 60 input minutes linearly to the 60 forecast
+    minutes, forecast = x @ W + b. The exponential smoothers are linear in
+    their inputs, so W is simply the smoother applied to the identity
+    matrix. Their mean squared error over all windows then only depends on
+    the Gram matrices of [x, 1] and y, which are accumulated in one pass
+    over the windows; the smoothing parameters are grid-searched and the
+    ridge model solved in closed form on those 61x61 matrices.
+    """
+    import itertools
+    import json
+    import os
+    import time
+    import numpy as np
+    import pandas as pd
+    from pathlib import Path
+
+    dataset = Path(dataset_path)
+    timestamps = np.load(dataset / "timestamps.npy")
+    dataset_values = np.load(dataset / "values.npy")
+
+    input_sequence_length = 60
+    output_sequence_length = 60
+    window_length = input_sequence_length + output_sequence_length
+    candidates_dir = os.path.join(f'/models/{model_name}', "candidates", model_version)
+
+    # Same helper as in train_model, so all candidates share their validation windows
+    def window_split(n_rows, n_series):
+        """Per series, the ranges of training and validation window starts, split 80/20 in time"""
+        n_windows = max(n_rows - window_length + 1, 0)
+        train_size = int(0.8 * n_windows)
+        return [(range(0, train_size), range(train_size, n_windows))] * n_series
+
+    def iter_windows(starts_by_series, chunk_size=65536):
+        """Yield the windows of every (series values, starts) pair, chunk_size rows at a time"""
+        for series_values, starts in starts_by_series:
+            # Strided views, the windows are only copied one chunk at a time
+            windows = np.lib.stride_tricks.sliding_window_view(series_values, window_length)
+            for i in range(starts.start, starts.stop, chunk_size):
+                yield windows[i:min(i + chunk_size, starts.stop)]
+
+    def gram(starts_by_series):
+        """Accumulate [x, 1]'[x, 1], [x, 1]'y and y'y over the windows, chunk by chunk"""
+        xx = np.zeros((input_sequence_length + 1, input_sequence_length + 1))
+        xy = np.zeros((input_sequence_length + 1, output_sequence_length))
+        yy = 0.0
+        count = 0
+        for chunk in iter_windows(starts_by_series):
+            chunk = chunk.astype(np.float64)
+            x = np.hstack([chunk[:, :input_sequence_length], np.ones((len(chunk), 1))])
+            y = chunk[:, input_sequence_length:]
+            xx += x.T @ x
+            xy += x.T @ y
+            yy += float(np.sum(y * y))
+            count += len(chunk)
+        return xx, xy, yy, count
+
+    def mse(weights, bias, stats):
+        """Mean squared error of forecast = x @ weights + bias from the Gram matrices"""
+        xx, xy, yy, count = stats
+        full = np.vstack([weights, bias[np.newaxis, :]])
+        sse = np.trace(full.T @ xx @ full) - 2 * np.trace(full.T @ xy) + yy
+        return max(sse, 0.0) / (count * output_sequence_length)
+
+    def mae(weights, bias, starts_by_series):
+        total, count = 0.0, 0
+        for chunk in iter_windows(starts_by_series):
+            forecast = chunk[:, :input_sequence_length] @ weights + bias
+            total += float(np.abs(forecast - chunk[:, input_sequence_length:]).sum())
+            count += len(chunk) * output_sequence_length
+        return total / count if count else float("nan")
+
+    # Forecasters on a batch of input windows of shape (N, 60), all linear in x
+    def naive(x):
+        return np.repeat(x[:, -1:], output_sequence_length, axis=1)
+
+    def seasonal_naive(x):
+        # Repeat the last season of the input
+        index = input_sequence_length - season_length + np.arange(output_sequence_length) % season_length
+        return x[:, index]
+
+    def ewma(x, alpha):
+        level = x[:, 0]
+        for t in range(1, input_sequence_length):
+            level = alpha * x[:, t] + (1 - alpha) * level
+        return np.repeat(level[:, np.newaxis], output_sequence_length, axis=1)
+
+    def holt_winters(x, alpha, beta, gamma):
+        # Additive Holt-Winters, initialized from the first two seasons of the window
+        m = season_length
+        level = x[:, :m].mean(axis=1)
+        trend = (x[:, m:2 * m].mean(axis=1) - level) / m
+        season = x[:, :m] - level[:, np.newaxis]
+        for t in range(input_sequence_length):
+            s = season[:, t % m].copy()
+            previous_level = level
+            level = alpha * (x[:, t] - s) + (1 - alpha) * (level + trend)
+            trend = beta * (level - previous_level) + (1 - beta) * trend
+            season[:, t % m] = gamma * (x[:, t] - level) + (1 - gamma) * s
+        horizon = np.arange(1, output_sequence_length + 1)
+        season_index = (input_sequence_length + horizon - 1) % m
+        return level[:, np.newaxis] + horizon * trend[:, np.newaxis] + season[:, season_index]
+
+    def linear_map(forecaster, **params):
+        """Rows of W are the forecasts of the unit input windows"""
+        return forecaster(np.eye(input_sequence_length), **params), np.zeros(output_sequence_length)
+
+    grids = {
+        "naive": (naive, {}),
+        "seasonal_naive": (seasonal_naive, {}),
+        "ewma": (ewma, {"alpha": [0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9]}),
+        "holt_winters": (holt_winters, {
+            "alpha": [0.1, 0.3, 0.5, 0.8],
+            "beta": [0.0, 0.01, 0.05, 0.1],
+            "gamma": [0.0, 0.05, 0.1, 0.3],
+        }),
+    }
+
+    train_split, val_split = [], []
+    for column, (train, val) in enumerate(window_split(*dataset_values.shape)):
+        series_values = np.ascontiguousarray(dataset_values[:, column])
+        train_split.append((series_values, train))
+        val_split.append((series_values, val))
+    train_stats = gram(train_split)
+    val_stats = gram(val_split)
+    has_validation = val_stats[3] > 0
+
+    for family in filter(None, families.split(",")):
+        start = time.monotonic()
+        if family == "ridge":
+            # Closed-form ridge regression on the 60 lags, the intercept is not penalized
+            xx, xy, _, _ = train_stats
+            penalty = ridge_alpha * np.trace(xx[:-1, :-1]) / input_sequence_length * np.eye(input_sequence_length + 1)
+            penalty[-1, -1] = 0.0
+            solution = np.linalg.solve(xx + penalty, xy)
+            weights, bias, params = solution[:-1], solution[-1], {"ridge_alpha": ridge_alpha}
+            n_parameters = solution.size
+        elif family in grids:
+            seasons_needed = {"seasonal_naive": 1, "holt_winters": 2}.get(family, 0)
+            if seasons_needed and not 1 <= season_length * seasons_needed <= input_sequence_length:
+                print(f"Skipping {family}: season_length {season_length} does not fit the input window")
+                continue
+            forecaster, grid = grids[family]
+            best = None
+            for values in itertools.product(*grid.values()):
+                candidate = dict(zip(grid.keys(), values))
+                weights, bias = linear_map(forecaster, **candidate)
+                loss = mse(weights, bias, train_stats)
+                if best is None or loss < best[0]:
+                    best = (loss, weights, bias, candidate)
+            _, weights, bias, params = best
+            n_parameters = len(params)
+        else:
+            print(f"Unknown baseline family {family}, skipping")
+            continue
+
+        metadata = {
+            "model_family": family,
+            "parameters": int(n_parameters),
+            "hyperparameters": json.dumps(params),
+            "loss": float(mse(weights, bias, train_stats)),
+            "training_seconds": round(time.monotonic() - start, 3),
+            "training_cutoff": pd.Timestamp(timestamps[-1], unit="s").isoformat(),
+        }
+        if has_validation:
+            metadata["val_loss"] = float(mse(weights, bias, val_stats))
+            metadata["val_mae"] = float(mae(weights, bias, val_split))
+
+        candidate_dir = os.path.join(candidates_dir, family)
+        os.makedirs(candidate_dir, exist_ok=True)
+        np.savez(os.path.join(candidate_dir, "linear_model.npz"), weights=weights, bias=bias)
+        Path(candidate_dir, "metrics.json").write_text(json.dumps(metadata))
+        print(f"{family}: {metadata}")
+
+
+@dsl.component(
+    base_image="python:3.10",
+    packages_to_install=["tensorflow", "numpy", "model_registry", "pathlib"],
+)
+def select_model(
+    model_name: str,
+    model_version: str,
+    author: str,
+    model_pvc: str,
+    trained_candidates: List[str],
+    tolerance: float = 0.05,
+    batch_size: int = 64,
+    latency_slack_ms: float = 0.5,
+):
+    """
+    Register the cheapest candidate whose validation loss is within
+    `tolerance` of the best one, and export it as the new model version.
+
+    Besides the LSTM candidates listed in `trained_candidates`, every
+    candidate staged for this version (the baselines) takes part. The cost
+    of a candidate is the measured latency of its serving function on a
+    batch of `batch_size` windows, in TensorFlow like TF Serving runs it.
+    Candidates within `latency_slack_ms` of the fastest one count as equally
+    cheap, and the most accurate of them is selected.
+    """
+    import json
+    import os
+    import shutil
+    import time
+    import numpy as np
+    import tensorflow as tf
+    from model_registry import ModelRegistry
+    from pathlib import Path
+
+    model_dir = f'/models/{model_name}'
+    candidates_dir = Path(model_dir, "candidates", model_version)
+    candidates = {
+        path.parent.name: json.loads(path.read_text())
+        for path in candidates_dir.glob("*/metrics.json")
+    }
+    missing = [name for name in trained_candidates if name not in candidates]
+    if missing:
+        raise ValueError(f"Candidates {', '.join(missing)} were trained but not staged in {candidates_dir}")
+    if not candidates:
+        raise ValueError(f"No candidates staged in {candidates_dir}")
+
+    # Candidates are compared on the shared validation windows, or on their
+    # training loss if the data was too short to hold any out
+    def score(metrics):
+        return metrics.get("val_loss", metrics["loss"])
+
+    class LinearForecaster(tf.Module):
+        def __init__(self, weights, bias):
+            super().__init__()
+            self.weights = tf.constant(weights, dtype=tf.float32)
+            self.bias = tf.constant(bias, dtype=tf.float32)
+
+        @tf.function(input_signature=[tf.TensorSpec([None, 60, 1], tf.float32, name="inputs")])
+        def serve(self, inputs):
+            return tf.matmul(inputs[:, :, 0], self.weights) + self.bias
+
+    def load(name):
+        source = candidates_dir / name
+        if (source / "saved_model").exists():
+            return tf.saved_model.load(str(source / "saved_model"))
+        linear = np.load(source / "linear_model.npz")
+        return LinearForecaster(linear["weights"], linear["bias"])
+
+    batch = tf.constant(np.random.default_rng(0).random((batch_size, 60, 1)), dtype=tf.float32)
+
+    def inference_ms(model, repeats=20):
+        """Median latency of one batch, after a warm-up call that pays for tracing"""
+        model.serve(batch).numpy()
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model.serve(batch).numpy()
+            timings.append(time.perf_counter() - start)
+        return float(np.median(timings)) * 1000
+
+    best_score = min(score(metrics) for metrics in candidates.values())
+    eligible = [name for name, metrics in candidates.items() if score(metrics) <= best_score * (1 + tolerance)]
+    models = {name: load(name) for name in eligible}
+    for name, model in models.items():
+        candidates[name]["inference_ms"] = inference_ms(model)
+    fastest = min(candidates[name]["inference_ms"] for name in eligible)
+    cheapest = [name for name in eligible if candidates[name]["inference_ms"] <= fastest + latency_slack_ms]
+    selected = min(cheapest, key=lambda name: score(candidates[name]))
+    for name, metrics in sorted(candidates.items(), key=lambda item: score(item[1])):
+        latency = f", {metrics['inference_ms']:.3f} ms per batch" if "inference_ms" in metrics else ""
+        print(f"{name}: score {score(metrics):.6f}, {metrics['parameters']} parameters{latency}")
+    print(f"Selected {selected}")
+
+    # Export to a temporary directory first, numeric directories are picked up by TF Serving
+    version_dir = os.path.join(model_dir, model_version)
+    staging_dir = f"{version_dir}.tmp"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    source = candidates_dir / selected
+
+    class VersionedForecaster(tf.Module):
+        """Serve every forecast together with the version that made it"""
+
+        def __init__(self, model, version):
+            super().__init__()
+            self.model = model
+            self.version = tf.constant(int(version), dtype=tf.int64)
+
+        @tf.function(input_signature=[tf.TensorSpec([None, 60, 1], tf.float32, name="inputs")])
+        def serve(self, inputs):
+            return {
+                "forecast": self.model.serve(inputs),
+                "model_version": tf.fill(tf.shape(inputs)[:1], self.version),
+            }
+
+    if (source / "saved_model").exists():
+        checkpoint_dir = os.path.join(model_dir, "checkpoints")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        shutil.copy(source / "model.keras", os.path.join(checkpoint_dir, f"{model_version}.keras"))
+    module = VersionedForecaster(models[selected], model_version)
+    tf.saved_model.save(module, staging_dir, signatures={"serving_default": module.serve})
+    if not (source / "saved_model").exists():
+        # Lets the predictor's local backend serve the model without TensorFlow
+        shutil.copy(source / "linear_model.npz", staging_dir)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.rename(staging_dir, version_dir)
+
+    metadata = {
+        key: value for key, value in candidates[selected].items()
+        if isinstance(value, (str, int, float, bool))
+    }
+    metadata["candidates"] = json.dumps({name: score(metrics) for name, metrics in candidates.items()})
+    metadata["selection_tolerance"] = tolerance
+
     # Register model
     registry = ModelRegistry(
         server_address="http://model-registry-service.kubeflow.svc.cluster.local",
@@ -92,81 +710,341 @@ def train_model(model_name: str, model_version: str, author: str, model_pvc: str
         model_format_name="tensorflow",
         model_format_version="2.0",
         version=model_version,
-        description="Simple RNN model for CPU usage prediction",
-        metadata={
-            "loss": float(history.history['loss'][-1]),
-            "mae": float(history.history['mae'][-1])
-        }
+        description=f"{selected} model for CPU usage prediction",
+        metadata=metadata
     )
+    shutil.rmtree(candidates_dir, ignore_errors=True)
 
 @dsl.component(
-    base_image="python:3.10", packages_to_install=["kserve", "model_registry"]
+    base_image="python:3.10", packages_to_install=["kserve", "numpy", "requests"]
 )
-def deploy_model(model_name: str, namespace: str, model_pvc: str):
-    """Deploy model to KServe with rolling updates"""
+def deploy_model(
+    model_name: str,
+    namespace: str,
+    model_pvc: str,
+    model_version: str,
+    dataset_path: str,
+    canary_traffic_percent: int = 10,
+    shadow_windows: int = 200,
+    latency_tolerance: float = 0.2,
+    latency_slack_ms: float = 5.0,
+    accuracy_tolerance: float = 0.05,
+    ready_timeout_minutes: float = 15.0,
+) -> str:
+    """
+    Roll the new model version out to KServe as a canary.
+
+    Every version is served from its own base path, so the revision of the
+    stable version keeps serving while the new one takes
+    `canary_traffic_percent` of the traffic. Both revisions are then
+    shadow-scored on the most recent windows of the dataset. The canary is
+    promoted if its p50/p99 latency is within `latency_tolerance` (plus
+    `latency_slack_ms`, so sub-millisecond jitter does not count) and its
+    MAE within `accuracy_tolerance` of the stable version, otherwise all
+    traffic goes back to the stable revision.
+
+    Returns:
+        "created", "unchanged", "promoted" or "rolled_back"
+    """
+    import time
+    import numpy as np
+    import requests
     from kubernetes import client
     from kserve import KServeClient, constants
-    from model_registry import ModelRegistry
     from kserve import V1beta1InferenceService
     from kserve import V1beta1InferenceServiceSpec
     from kserve import V1beta1PredictorSpec
     from kserve import V1beta1TFServingSpec
+    from pathlib import Path
+
+    input_sequence_length = 60
+    output_sequence_length = 60
+    model_dir = Path(f"/models/{model_name}")
+    serving_dir = model_dir / "serving"
+    stable_path = serving_dir / "stable"
 
     kserve_client = KServeClient()
 
-    isvc = V1beta1InferenceService(
-        api_version=constants.KSERVE_V1BETA1,
-        kind=constants.KSERVE_KIND,
-        metadata=client.V1ObjectMeta(
-            name=model_name,
-            namespace=namespace,
-        ),
-        spec=V1beta1InferenceServiceSpec(
-            predictor=V1beta1PredictorSpec(
-                tensorflow=V1beta1TFServingSpec(
-                    storage_uri=f"pvc://{model_pvc}/{model_name}",
-                    args=["--model_base_path=/mnt/pvc/cpu-usage-forecaster"]
+    def serving_base_path(version):
+        """TF Serving loads the newest version under its base path, one symlinked version pins it"""
+        link = serving_dir / version / version
+        link.parent.mkdir(parents=True, exist_ok=True)
+        if not link.is_symlink():
+            link.symlink_to(Path("..", "..", version))
+        return f"/mnt/pvc/{model_name}/serving/{version}"
+
+    def inference_service(version, canary_percent=None):
+        return V1beta1InferenceService(
+            api_version=constants.KSERVE_V1BETA1,
+            kind=constants.KSERVE_KIND,
+            metadata=client.V1ObjectMeta(
+                name=model_name,
+                namespace=namespace,
+            ),
+            spec=V1beta1InferenceServiceSpec(
+                predictor=V1beta1PredictorSpec(
+                    canary_traffic_percent=canary_percent,
+                    tensorflow=V1beta1TFServingSpec(
+                        storage_uri=f"pvc://{model_pvc}/{model_name}",
+                        args=[f"--model_base_path={serving_base_path(version)}"]
+                    )
                 )
             )
         )
-    )
+
+    def set_traffic(percent):
+        kserve_client.patch(
+            model_name,
+            {"spec": {"predictor": {"canaryTrafficPercent": percent}}},
+            namespace=namespace,
+        )
+
+    def predictor_status():
+        isvc = kserve_client.get(model_name, namespace=namespace)
+        return isvc.get("status", {}).get("components", {}).get("predictor", {})
+
+    def wait_for_new_revision(previous_revision):
+        deadline = time.monotonic() + ready_timeout_minutes * 60
+        while time.monotonic() < deadline:
+            status = predictor_status()
+            latest = status.get("latestReadyRevision")
+            if latest and latest != previous_revision and latest == status.get("latestCreatedRevision"):
+                return latest
+            time.sleep(10)
+        return None
+
+    def mark_stable(version):
+        stable_path.write_text(version)
+        # Only the stable version and the version under test are referenced by live revisions
+        for path in serving_dir.iterdir():
+            if path.is_dir() and path.name not in (version, model_version):
+                for link in path.iterdir():
+                    link.unlink()
+                path.rmdir()
 
     try:
-        kserve_client.get(model_name, isvc)
-    except:
-        kserve_client.create(isvc, watch=True)
+        kserve_client.get(model_name, namespace=namespace)
+    except Exception:
+        kserve_client.create(inference_service(model_version), watch=True)
+        mark_stable(model_version)
+        print(f"Created {model_name} serving version {model_version}")
+        return "created"
+
+    if stable_path.exists():
+        stable_version = stable_path.read_text().strip()
+    else:
+        # Deployed before versions were pinned: the service loads whatever is newest, which
+        # already is the new version. Pin the previous version first so there is a baseline.
+        previous = [
+            int(path.name) for path in model_dir.iterdir()
+            if path.name.isdigit() and int(path.name) < int(model_version)
+        ]
+        if not previous:
+            kserve_client.patch(model_name, inference_service(model_version), namespace=namespace)
+            mark_stable(model_version)
+            return "created"
+        stable_version = str(max(previous))
+        revision = predictor_status().get("latestReadyRevision")
+        kserve_client.patch(model_name, inference_service(stable_version), namespace=namespace)
+        if wait_for_new_revision(revision) is None:
+            raise RuntimeError(f"Pinning {model_name} to version {stable_version} timed out")
+        mark_stable(stable_version)
+
+    if stable_version == model_version:
+        print(f"Version {model_version} is already serving")
+        return "unchanged"
+
+    # Start the canary, the last revision rolled out to 100% keeps the rest of the traffic
+    status = predictor_status()
+    stable_revision = status.get("latestRolledoutRevision") or status.get("latestReadyRevision")
+    kserve_client.patch(
+        model_name, inference_service(model_version, canary_traffic_percent), namespace=namespace
+    )
+    canary_revision = wait_for_new_revision(status.get("latestReadyRevision"))
+    if canary_revision is None:
+        print(f"Canary of version {model_version} did not become ready, rolling back")
+        set_traffic(0)
+        return "rolled_back"
+    print(f"Canary {canary_revision} of version {model_version} takes {canary_traffic_percent}% of the traffic")
+
+    # Shadow-score both revisions on the most recent windows of every series
+    window_length = input_sequence_length + output_sequence_length
+
+    def recent_windows(series_values, count):
+        """The last count windows of one series as a strided view, fewer if the series is short"""
+        series_values = series_values[-(count + window_length - 1):]
+        if len(series_values) < window_length:
+            return np.empty((0, window_length), dtype=series_values.dtype)
+        return np.lib.stride_tricks.sliding_window_view(series_values, window_length)
+
+    dataset_values = np.load(Path(dataset_path) / "values.npy")
+    per_series = max(shadow_windows // max(dataset_values.shape[1], 1), 1)
+    windows = [recent_windows(dataset_values[:, column], per_series) for column in range(dataset_values.shape[1])]
+    windows = np.concatenate(windows) if windows else np.empty((0, window_length))
+    windows = windows[~np.isnan(windows).any(axis=1)]
+
+    revisions = {"stable": stable_revision, "canary": canary_revision}
+    urls = {
+        role: f"http://{revision}-private.{namespace}/v1/models/{model_name}:predict"
+        for role, revision in revisions.items()
+    }
+    latencies = {role: [] for role in urls}
+    errors = {role: [] for role in urls}
+    failures = {role: 0 for role in urls}
+    session = requests.Session()
+
+    def score(role, window):
+        payload = {"instances": window[:input_sequence_length].reshape(1, input_sequence_length, 1).tolist()}
+        start = time.perf_counter()
+        try:
+            response = session.post(urls[role], json=payload, timeout=10)
+            response.raise_for_status()
+            prediction = response.json()["predictions"][0]
+            # Versions exported before the forecasts were tagged return the bare forecast
+            forecast = np.array(prediction["forecast"] if isinstance(prediction, dict) else prediction).reshape(-1)
+        except Exception as e:
+            failures[role] += 1
+            print(f"Shadow request to {role} failed: {e}")
+            return
+        latencies[role].append(time.perf_counter() - start)
+        errors[role].append(float(np.abs(forecast - window[input_sequence_length:]).mean()))
+
+    # Warm up both revisions, then alternate which one goes first
+    for role in urls:
+        for window in windows[:5]:
+            score(role, window)
+        latencies[role].clear()
+        errors[role].clear()
+        failures[role] = 0
+    for i, window in enumerate(windows):
+        for role in (("stable", "canary") if i % 2 == 0 else ("canary", "stable")):
+            score(role, window)
+
+    summary = {}
+    for role in urls:
+        if latencies[role]:
+            p50, p99 = np.percentile(latencies[role], [50, 99])
+            summary[role] = {"p50": float(p50), "p99": float(p99), "mae": float(np.mean(errors[role]))}
+        print(f"{role} ({revisions[role]}): {summary.get(role)}, {failures[role]} failed requests")
+
+    if failures["canary"] or "canary" not in summary:
+        passed = False
+    elif "stable" not in summary:
+        # Nothing to compare against, a canary that answers is better than a broken stable version
+        passed = True
+    else:
+        canary, stable = summary["canary"], summary["stable"]
+        slack = latency_slack_ms / 1000
+        passed = (
+            canary["p50"] <= stable["p50"] * (1 + latency_tolerance) + slack
+            and canary["p99"] <= stable["p99"] * (1 + latency_tolerance) + slack
+            and canary["mae"] <= stable["mae"] * (1 + accuracy_tolerance)
+        )
+
+    if passed:
+        set_traffic(100)
+        mark_stable(model_version)
+        print(f"Promoted version {model_version}")
+        return "promoted"
+    # The rejected version stays in the spec with no traffic until the next rollout replaces it
+    set_traffic(0)
+    print(f"Rolled back to version {stable_version}")
+    return "rolled_back"
+
+
+# LSTM configurations trained side by side by forecasting_pipeline. Input and
+# output stay 60 minutes long, as the predictor and TF Serving expect.
+LSTM_CANDIDATES = [
+    {"name": "lstm-64", "lstm_units": 64, "dense_units": "128,64", "learning_rate": 1e-3, "batch_size": 256},
+    {"name": "lstm-32", "lstm_units": 32, "dense_units": "64", "learning_rate": 1e-3, "batch_size": 256},
+    {"name": "lstm-128", "lstm_units": 128, "dense_units": "128,64", "learning_rate": 5e-4, "batch_size": 512},
+]
+LSTM_PARALLELISM = 3
 
 
 @dsl.pipeline(name="Time Series Forecasting Pipeline")
 def forecasting_pipeline(
     hours_back: int = 10,
+    series: str = "cpu_usage",
     data_pvc: str = "metrics-data-pvc",
     model_pvc: str = "metrics-data-pvc",
     model_name: str = "cpu-usage-forecaster",
     model_version: str = "1",
     author: str = "system",
+    lstm_candidates: list = LSTM_CANDIDATES,
+    max_epochs: int = 50,
+    time_budget_minutes: float = 30.0,
+    warm_start: bool = True,
+    baseline_families: str = "naive,seasonal_naive,ewma,holt_winters,ridge",
+    selection_tolerance: float = 0.05,
+    canary_traffic_percent: int = 10,
     namespace: str = "kubeflow-user-example-com"
 ):
     # Prepare data
-    prepare_step = prepare_data(hours_back=hours_back)
+    prepare_step = prepare_data(hours_back=hours_back, series=series)
+    # The step itself must run every time, unchanged data is reused through
+    # the content-hashed partitions and datasets on the PVC
     prepare_step.set_caching_options(False)
     kubernetes.mount_pvc(prepare_step, pvc_name=data_pvc, mount_path="/data")
 
-    # Train model
-    train_step = train_model(
-        model_name=model_name, model_version=model_version, author=author, model_pvc=model_pvc
+    # Train one LSTM per candidate configuration, in parallel
+    with dsl.ParallelFor(items=lstm_candidates, parallelism=LSTM_PARALLELISM) as config:
+        train_step = train_model(
+            dataset_path=prepare_step.output,
+            model_name=model_name,
+            model_version=model_version,
+            author=author,
+            candidate=config.name,
+            lstm_units=config.lstm_units,
+            dense_units=config.dense_units,
+            learning_rate=config.learning_rate,
+            batch_size=config.batch_size,
+            max_epochs=max_epochs,
+            time_budget_minutes=time_budget_minutes,
+            warm_start=warm_start,
+        )
+        kubernetes.mount_pvc(train_step, pvc_name=model_pvc, mount_path="/models")
+        kubernetes.mount_pvc(train_step, pvc_name=data_pvc, mount_path="/data")
+    
+    # Fit the NumPy baselines on the same data
+    baselines_step = fit_baselines(
+        dataset_path=prepare_step.output,
+        model_name=model_name,
+        model_version=model_version,
+        families=baseline_families,
+    )
+    kubernetes.mount_pvc(baselines_step, pvc_name=model_pvc, mount_path="/models")
+    kubernetes.mount_pvc(baselines_step, pvc_name=data_pvc, mount_path="/data")
+    
+    # Register the cheapest candidate that is about as accurate as the best one,
+    # once all LSTM candidates and the baselines are staged
+    select_step = select_model(
+        model_name=model_name,
+        model_version=model_version,
+        author=author,
+        model_pvc=model_pvc,
+        trained_candidates=dsl.Collected(train_step.output),
+        tolerance=selection_tolerance,
     )
-    kubernetes.mount_pvc(train_step, pvc_name=model_pvc, mount_path="/models")
-    kubernetes.mount_pvc(train_step, pvc_name=data_pvc, mount_path="/data")
+    kubernetes.mount_pvc(select_step, pvc_name=model_pvc, mount_path="/models")
     
-    # Deploy model
+    # Roll the new version out as a canary, scored on the newest windows of the dataset
     deploy_step = deploy_model(
-        model_name=model_name, namespace=namespace, model_pvc=model_pvc
+        model_name=model_name,
+        namespace=namespace,
+        model_pvc=model_pvc,
+        model_version=model_version,
+        dataset_path=prepare_step.output,
+        canary_traffic_percent=canary_traffic_percent,
     )
+    kubernetes.mount_pvc(deploy_step, pvc_name=model_pvc, mount_path="/models")
+    kubernetes.mount_pvc(deploy_step, pvc_name=data_pvc, mount_path="/data")
 
     # Define execution order
     train_step.after(prepare_step)
-    deploy_step.after(train_step)
+    baselines_step.after(prepare_step)
+    select_step.after(baselines_step)
+    deploy_step.after(select_step)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,30 @@
+import importlib.util
+import os
+
+import pytest
+
+PIPELINE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mlops-pipeline.py')
+
+
+@pytest.fixture(scope='session')
+def pipeline():
+    pytest.importorskip('kfp')
+    spec = importlib.util.spec_from_file_location('mlops_pipeline', PIPELINE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def models_dir(tmp_path, monkeypatch):
+    """Redirect the components' /models volume to tmp_path"""
+    models_dir = tmp_path / 'models'
+    join = os.path.join
+
+    def redirected_join(path, *paths):
+        if isinstance(path, str) and path.startswith('/models/'):
+            path = str(models_dir) + path[len('/models'):]
+        return join(path, *paths)
+
+    monkeypatch.setattr(os.path, 'join', redirected_join)
+    return models_dir
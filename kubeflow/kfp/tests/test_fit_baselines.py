@@ -0,0 +1,74 @@
+import json
+
+import numpy as np
+import pytest
+
+INPUT, OUTPUT = 60, 60
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    rng = np.random.default_rng(0)
+    # Two series of a daily-ish pattern plus noise, one minute apart
+    minutes = np.arange(700)
+    values = np.stack([
+        np.sin(minutes / 30) + rng.normal(0, 0.1, len(minutes)),
+        2 + np.cos(minutes / 45) + rng.normal(0, 0.2, len(minutes)),
+    ], axis=1).astype(np.float32)
+    path = tmp_path / 'dataset'
+    path.mkdir()
+    np.save(path / 'values.npy', values)
+    np.save(path / 'timestamps.npy', 1_700_000_000 + 60 * minutes)
+    return path, values
+
+
+def split_windows(values):
+    """Training and validation windows, the first 80% of every series' windows train"""
+    train, val = [], []
+    for column in range(values.shape[1]):
+        windows = np.lib.stride_tricks.sliding_window_view(values[:, column].astype(np.float64), INPUT + OUTPUT)
+        train_size = int(0.8 * len(windows))
+        train.append(windows[:train_size])
+        val.append(windows[train_size:])
+    return np.concatenate(train), np.concatenate(val)
+
+
+def direct_errors(values, weights, bias):
+    """MSE and MAE over the training and the validation windows, window by window"""
+    train_errors, val_errors = (
+        windows[:, :INPUT] @ weights + bias - windows[:, INPUT:] for windows in split_windows(values)
+    )
+    return np.mean(train_errors ** 2), np.mean(val_errors ** 2), np.mean(np.abs(val_errors))
+
+
+def test_gram_matrix_losses_match_direct_computation(pipeline, dataset, models_dir):
+    path, values = dataset
+    families = ['naive', 'seasonal_naive', 'ewma', 'holt_winters', 'ridge']
+
+    pipeline.fit_baselines.python_func(
+        dataset_path=str(path), model_name='forecaster', model_version='4', families=','.join(families)
+    )
+
+    for family in families:
+        candidate = models_dir / 'forecaster' / 'candidates' / '4' / family
+        metadata = json.loads((candidate / 'metrics.json').read_text())
+        model = np.load(candidate / 'linear_model.npz')
+        loss, val_loss, val_mae = direct_errors(values, model['weights'], model['bias'])
+        assert metadata['loss'] == pytest.approx(loss, rel=1e-6), family
+        assert metadata['val_loss'] == pytest.approx(val_loss, rel=1e-6), family
+        assert metadata['val_mae'] == pytest.approx(val_mae, rel=1e-6), family
+
+
+def test_ridge_is_the_least_squares_fit(pipeline, dataset, models_dir):
+    path, values = dataset
+
+    pipeline.fit_baselines.python_func(
+        dataset_path=str(path), model_name='forecaster', model_version='4', families='ridge', ridge_alpha=0.0
+    )
+
+    model = np.load(models_dir / 'forecaster' / 'candidates' / '4' / 'ridge' / 'linear_model.npz')
+    train, _ = split_windows(values)
+    x = np.hstack([train[:, :INPUT], np.ones((len(train), 1))])
+    solution, *_ = np.linalg.lstsq(x, train[:, INPUT:], rcond=None)
+    forecast = x[:, :INPUT] @ model['weights'] + model['bias']
+    np.testing.assert_allclose(forecast, x @ solution, atol=1e-4)
@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import queue
+
+import pytest
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'webhook-server.py')
+
+
+@pytest.fixture(scope='session')
+def server_module():
+    # Loaded once, its Prometheus metrics can only be registered once per process
+    spec = importlib.util.spec_from_file_location('webhook_server', SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def webhook(server_module, tmp_path):
+    """The webhook server module with fresh state, kept in tmp_path"""
+    server_module.run_tracker = server_module.RunTracker(
+        cooldown_seconds=1800, dedup_seconds=21600, status_cache_seconds=0
+    )
+    server_module.version_allocator = server_module.VersionAllocator(str(tmp_path / 'model-versions.json'))
+    server_module.jobs.clear()
+    server_module.alert_queue = queue.Queue(maxsize=server_module.ALERT_QUEUE_SIZE)
+    return server_module
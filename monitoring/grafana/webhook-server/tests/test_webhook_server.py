@@ -0,0 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+RUN = {'run_id': 'run-1', 'job_name': 'grafana-alert-1', 'experiment_id': 'experiment', 'model_version': 3}
+
+
+def notification(*fingerprints, status='firing'):
+    return {'status': status, 'alerts': [{'status': status, 'fingerprint': fp} for fp in fingerprints]}
+
+
+def test_renotified_alert_is_answered_inline_with_its_run(webhook):
+    webhook.run_tracker.handle(None, {'a'}, lambda: RUN)
+    client = webhook.app.test_client()
+
+    response = client.post('/webhook', json=notification('a'))
+    assert response.status_code == 200
+    assert response.json['status'] == 'duplicate'
+    assert response.json['run_id'] == 'run-1'
+    assert webhook.alert_queue.empty()
+
+
+def test_new_alert_is_queued(webhook):
+    webhook.run_tracker.handle(None, {'a'}, lambda: RUN)
+    client = webhook.app.test_client()
+
+    response = client.post('/webhook', json=notification('a', 'b'))
+    assert response.status_code == 202
+    job_id = response.json['id']
+    assert webhook.alert_queue.get_nowait() == job_id
+    assert webhook.jobs[job_id]['fingerprints'] == ['a', 'b']
+
+
+class FakeKfpClient:
+    """Reports every run in the given state"""
+
+    def __init__(self, state='RUNNING'):
+        self.state = state
+
+    def get_run(self, run_id):
+        return type('Run', (), {'state': self.state})()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(webhook, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(webhook, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def tracker(webhook, clock):
+    return webhook.RunTracker(cooldown_seconds=1800, dedup_seconds=21600, status_cache_seconds=0)
+
+
+def launcher():
+    """Launch callable handing out run-1, run-2, ..."""
+    runs = []
+
+    def launch():
+        runs.append({'run_id': f'run-{len(runs) + 1}'})
+        return runs[-1]
+    return launch, runs
+
+
+def handle(tracker, client, firing, launch):
+    """(status, run_id) of one notification"""
+    status, run = tracker.handle(client, firing, launch)
+    return status, run['run_id']
+
+
+def test_run_tracker_starts_one_run_per_alert(tracker):
+    client = FakeKfpClient('RUNNING')
+    launch, runs = launcher()
+
+    assert handle(tracker, client, {'a'}, launch) == ('started', 'run-1')
+    assert handle(tracker, client, {'a'}, launch) == ('duplicate', 'run-1')
+    # A new alert while the run is in flight joins it instead of starting another
+    assert handle(tracker, client, {'a', 'b'}, launch) == ('in_progress', 'run-1')
+    assert tracker.known_run({'a'})['run_id'] == 'run-1'
+    assert tracker.known_run({'a', 'b'}) is None
+    assert len(runs) == 1
+
+
+def test_run_tracker_retries_after_a_failed_run(tracker):
+    client = FakeKfpClient('RUNNING')
+    launch, _ = launcher()
+    tracker.handle(client, {'a'}, launch)
+
+    client.state = 'FAILED'
+    assert handle(tracker, client, {'a'}, launch) == ('started', 'run-2')
+    assert tracker.active['run_id'] == 'run-2'
+    assert tracker.last_finished is None
+
+
+def test_run_tracker_cools_down_after_a_successful_run(tracker, clock):
+    client = FakeKfpClient('RUNNING')
+    launch, _ = launcher()
+    tracker.handle(client, {'a'}, launch)
+
+    client.state = 'SUCCEEDED'
+    assert handle(tracker, client, {'b'}, launch) == ('cooldown', 'run-1')
+    assert handle(tracker, client, {'a'}, launch) == ('duplicate', 'run-1')
+
+    clock.now += 1800
+    assert handle(tracker, client, {'b'}, launch) == ('started', 'run-2')
+
+
+def test_run_tracker_forgets_resolved_and_expired_alerts(tracker, clock):
+    tracker.cooldown_seconds = 0
+    client = FakeKfpClient('SUCCEEDED')
+    launch, _ = launcher()
+    tracker.handle(client, {'a', 'b'}, launch)
+
+    tracker.resolve({'a'})
+    assert handle(tracker, client, {'a'}, launch) == ('started', 'run-2')
+    assert handle(tracker, client, {'b'}, launch) == ('duplicate', 'run-1')
+
+    clock.now += 21600
+    assert tracker.known_run({'b'}) is None
+    assert handle(tracker, client, {'b'}, launch) == ('started', 'run-3')
+
+
+class FakeRegistry:
+    """Model registry holding the given versions, or no model at all"""
+
+    def __init__(self, versions=None):
+        self.versions = versions
+
+    def get_registered_model(self, name):
+        return None if self.versions is None else object()
+
+    def get_model_versions(self, name):
+        return [type('ModelVersion', (), {'name': str(version)})() for version in self.versions]
+
+
+def test_version_allocator_starts_at_1_for_an_unregistered_model(webhook, monkeypatch, tmp_path):
+    monkeypatch.setattr(webhook, '_registry', FakeRegistry())
+    allocator = webhook.VersionAllocator(str(tmp_path / 'versions' / 'model-versions.json'))
+
+    assert [allocator.allocate('forecaster') for _ in range(3)] == [1, 2, 3]
+    # The state survives a restart even though nothing was registered
+    restarted = webhook.VersionAllocator(allocator.state_path)
+    assert restarted.allocate('forecaster') == 4
+
+
+def test_version_allocator_reconciles_with_the_registry_once(webhook, monkeypatch, tmp_path):
+    registry = FakeRegistry(['1', '7', '3'])
+    monkeypatch.setattr(webhook, '_registry', registry)
+    allocator = webhook.VersionAllocator(str(tmp_path / 'model-versions.json'))
+
+    assert allocator.allocate('forecaster') == 8
+    # Registered later by the pipeline, the state is ahead of the registry from now on
+    registry.versions.append('8')
+    assert allocator.allocate('forecaster') == 9
+
+    # Versions registered behind its back are picked up after a restart
+    registry.versions.append('20')
+    assert allocator.allocate('forecaster') == 10
+    assert webhook.VersionAllocator(allocator.state_path).allocate('forecaster') == 21
+
+
+def test_version_allocator_never_hands_out_a_version_twice(webhook, monkeypatch, tmp_path):
+    monkeypatch.setattr(webhook, '_registry', FakeRegistry([]))
+    allocators = [webhook.VersionAllocator(str(tmp_path / 'model-versions.json')) for _ in range(2)]
+
+    # Two allocators on one state file stand in for two server processes
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        versions = list(executor.map(lambda i: allocators[i % 2].allocate('forecaster'), range(40)))
+    assert sorted(versions) == list(range(1, 41))
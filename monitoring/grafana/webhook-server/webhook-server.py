@@ -1,9 +1,18 @@
 from flask import Flask, request, jsonify
 import logging
+from collections import OrderedDict
 from datetime import datetime
+import fcntl
+import hashlib
 import json
+import os
+import queue
+import threading
+import time
+import uuid
 import kfp
 from model_registry import ModelRegistry
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 # Set up logging
 logging.basicConfig(
@@ -14,35 +23,431 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+NAMESPACE = "kubeflow-user-example-com"
+MODEL_NAME = "cpu-usage-forecaster"
+
+# Alerts arriving while a run is in flight, or within the cooldown after it
+# finished, are attached to that run instead of starting a new one
+COOLDOWN_SECONDS = int(os.getenv("ALERT_COOLDOWN_SECONDS", 1800))
+# Re-notifications of an alert that already started a run are ignored this long
+DEDUP_SECONDS = int(os.getenv("ALERT_DEDUP_SECONDS", 21600))
+# Experiment, pipeline and version IDs are looked up again after this many seconds
+PIPELINE_CACHE_SECONDS = int(os.getenv("PIPELINE_CACHE_SECONDS", 600))
+# The state of the in-flight run is polled from KFP at most this often
+RUN_STATUS_CACHE_SECONDS = int(os.getenv("RUN_STATUS_CACHE_SECONDS", 15))
+
+# Last allocated model version per model, kept on the webhook server's PVC
+VERSION_STATE_PATH = os.getenv("VERSION_STATE_PATH", "/state/model-versions.json")
+
+# Alerts are queued and handled by ALERT_WORKERS background threads
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", 100))
+ALERT_WORKERS = int(os.getenv("ALERT_WORKERS", 2))
+# Number of processed alerts kept for /runs/<id>
+MAX_JOBS = int(os.getenv("MAX_JOBS", 1000))
+
+FINISHED_RUN_STATES = {"SUCCEEDED", "FAILED", "CANCELED", "SKIPPED", "CANCELLED"}
+# Finished without a new model: no cooldown, and the alerts may retry right away
+UNSUCCESSFUL_RUN_STATES = {"FAILED", "CANCELED", "SKIPPED", "CANCELLED"}
+
+alert_queue = queue.Queue(maxsize=ALERT_QUEUE_SIZE)
+jobs = OrderedDict()  # job id -> job, oldest first
+jobs_lock = threading.Lock()
+
+queue_depth = Gauge('webhook_alert_queue_depth', 'Number of alerts waiting in the queue')
+queue_capacity = Gauge('webhook_alert_queue_capacity', 'Maximum number of alerts the queue holds')
+queue_capacity.set(ALERT_QUEUE_SIZE)
+alerts_received = Counter('webhook_alerts_received_total', 'Alert notifications accepted into the queue')
+alerts_rejected = Counter('webhook_alerts_rejected_total', 'Alert notifications rejected because the queue was full')
+alerts_processed = Counter('webhook_alerts_processed_total', 'Processed alert notifications by result', ['result'])
+job_duration = Histogram('webhook_alert_processing_seconds', 'Time spent processing one queued alert')
+
+_clients_lock = threading.Lock()
+_registry = None
+_kfp_client = None
+_pipeline_target = None
+
 def get_model_registry():
-    """Initialize Model Registry client with proper configuration."""
-    try:
-        registry = ModelRegistry(
-            server_address="http://model-registry-service.kubeflow.svc.cluster.local",
-            port=8080,
-            author="system",
-            is_secure=False
-        )
-        logger.info("Successfully initialized Model Registry client")
-        return registry
-    except Exception as e:
-        logger.error(f"Error initializing Model Registry client: {str(e)}")
-        raise
+    """Return the Model Registry client, created once and reused."""
+    global _registry
+    with _clients_lock:
+        if _registry is not None:
+            return _registry
+        try:
+            _registry = ModelRegistry(
+                server_address="http://model-registry-service.kubeflow.svc.cluster.local",
+                port=8080,
+                author="system",
+                is_secure=False
+            )
+            logger.info("Successfully initialized Model Registry client")
+            return _registry
+        except Exception as e:
+            logger.error(f"Error initializing Model Registry client: {str(e)}")
+            raise
+
+def get_kfp_client():
+    """Return the KFP client, created once and reused."""
+    global _kfp_client
+    with _clients_lock:
+        if _kfp_client is None:
+            logger.info("Initializing KFP client")
+            client = kfp.Client()
+            client.set_user_namespace(namespace=NAMESPACE)
+            _kfp_client = client
+        return _kfp_client
+
+def get_pipeline_target(client):
+    """
+    Return (experiment_id, pipeline_id, version_id) of the pipeline to run.
+
+    The IDs are cached for PIPELINE_CACHE_SECONDS, so a newly uploaded
+    pipeline version is picked up without listing everything on every alert.
+    """
+    global _pipeline_target
+    with _clients_lock:
+        if _pipeline_target is not None and time.monotonic() - _pipeline_target[0] < PIPELINE_CACHE_SECONDS:
+            return _pipeline_target[1]
+
+        # Get experiment ID
+        try:
+            experiment = client.get_experiment(experiment_name="mlops")
+            experiment_id = experiment.experiment_id
+            logger.info(f"Found experiment ID: {experiment_id}")
+        except Exception as e:
+            logger.error(f"Error getting experiment: {str(e)}")
+            raise
+
+        # Get pipeline and version IDs
+        try:
+            pipelines = client.list_pipelines(namespace=NAMESPACE).pipelines
+            if not pipelines:
+                raise ValueError("No pipelines found in namespace")
+            pipeline_id = pipelines[0].pipeline_id
+
+            versions = client.list_pipeline_versions(pipeline_id=pipeline_id).pipeline_versions
+            if not versions:
+                raise ValueError(f"No versions found for pipeline {pipeline_id}")
+            version_id = versions[-1].pipeline_version_id
+
+            logger.info(f"Using pipeline ID: {pipeline_id}, version ID: {version_id}")
+        except Exception as e:
+            logger.error(f"Error getting pipeline/version info: {str(e)}")
+            raise
+
+        _pipeline_target = (time.monotonic(), (experiment_id, pipeline_id, version_id))
+        return _pipeline_target[1]
 
 def get_latest_model_version(registry, model_name):
-    """Get the latest model version safely."""
+    """Get the latest model version safely, 0 if the model has no versions or is not registered yet."""
     try:
-        versions = registry.get_model_versions(model_name)
+        # get_model_versions raises a StoreError for a model that was never registered
+        if registry.get_registered_model(model_name) is None:
+            logger.info(f"Model {model_name} is not registered yet, starting from version 1")
+            return 0
+        versions = [int(version.name) for version in registry.get_model_versions(model_name)]
         if not versions:
             logger.info(f"No versions found for model {model_name}, starting from version 1")
             return 0
-        latest_version = max(int(version.name) for version in versions)
+        latest_version = max(versions)
         logger.info(f"Found latest version {latest_version} for model {model_name}")
         return latest_version
     except Exception as e:
         logger.error(f"Error getting latest model version: {str(e)}")
         raise
 
+class VersionAllocator:
+    """
+    Hand out model versions from a state file instead of scanning the registry.
+
+    The last allocated version of every model is kept in a small JSON file.
+    Allocation takes an exclusive lock on a lock file next to it, reads the
+    file, increments the version and replaces the file atomically, so it
+    costs the same for any number of versions and two allocations can never
+    return the same version, even from two server processes. The state is
+    reconciled with the newest version in the registry once, before the
+    first allocation.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.lock_path = f"{state_path}.lock"
+        self.lock = threading.Lock()
+        self.reconciled = set()
+
+    def _read(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, state):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def _locked(self, update):
+        """Run update(state) under the thread and file locks and persist its result."""
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                result = update(state)
+                self._write(state)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reconcile(self, model_name):
+        """Make sure the state is not behind the versions already in the registry."""
+        registered = get_latest_model_version(get_model_registry(), model_name)
+
+        def update(state):
+            last = max(state.get(model_name, 0), registered)
+            state[model_name] = last
+            return last
+
+        last = self._locked(update)
+        self.reconciled.add(model_name)
+        logger.info(f"Version allocator for {model_name} reconciled at version {last}")
+
+    def allocate(self, model_name):
+        """Reserve and return the next version of a model."""
+        if model_name not in self.reconciled:
+            self.reconcile(model_name)
+
+        def update(state):
+            state[model_name] = state.get(model_name, 0) + 1
+            return state[model_name]
+
+        return self._locked(update)
+
+
+version_allocator = VersionAllocator(VERSION_STATE_PATH)
+
+def alert_fingerprints(alert_data):
+    """Return the fingerprints of the firing and of the resolved alerts of a notification."""
+    firing, resolved = set(), set()
+    for alert in alert_data.get("alerts", []):
+        fingerprint = alert.get("fingerprint")
+        if not fingerprint:
+            labels = json.dumps(alert.get("labels", {}), sort_keys=True)
+            fingerprint = hashlib.sha256(labels.encode()).hexdigest()[:16]
+        (resolved if alert.get("status") == "resolved" else firing).add(fingerprint)
+    return firing, resolved
+
+
+class RunTracker:
+    """
+    Remember the retraining run in flight and the alerts that started runs.
+
+    All decisions are taken under one lock, so concurrent notifications
+    can never start two runs or pick the same model version.
+    """
+
+    def __init__(self, cooldown_seconds, dedup_seconds, status_cache_seconds):
+        self.cooldown_seconds = cooldown_seconds
+        self.dedup_seconds = dedup_seconds
+        self.status_cache_seconds = status_cache_seconds
+        self.lock = threading.Lock()
+        self.active = None  # run in flight
+        self.last_finished = None  # (run, finished at)
+        self.fingerprints = {}  # fingerprint -> (run, seen at)
+        self._status_checked = 0.0
+
+    def _refresh(self, client):
+        """
+        Move the in-flight run to last_finished once KFP reports it done.
+
+        A run that did not succeed starts no cooldown and forgets the
+        alerts that started it, so they can retry on the next notification.
+        """
+        if self.active is None or time.monotonic() - self._status_checked < self.status_cache_seconds:
+            return
+        self._status_checked = time.monotonic()
+        try:
+            state = str(client.get_run(self.active["run_id"]).state).upper()
+        except Exception as e:
+            logger.warning(f"Could not get the state of run {self.active['run_id']}: {e}")
+            return
+        self.active["state"] = state
+        if state in FINISHED_RUN_STATES:
+            logger.info(f"Run {self.active['run_id']} finished with state {state}")
+            if state in UNSUCCESSFUL_RUN_STATES:
+                run_id = self.active["run_id"]
+                self.fingerprints = {
+                    fingerprint: entry for fingerprint, entry in self.fingerprints.items()
+                    if entry[0]["run_id"] != run_id
+                }
+            else:
+                self.last_finished = (self.active, time.monotonic())
+            self.active = None
+
+    def handle(self, client, firing, launch):
+        """
+        Start a run for the firing alerts unless one already covers them.
+
+        Args:
+            client: KFP client used to poll the state of the in-flight run
+            firing: Fingerprints of the firing alerts
+            launch: Callable starting a run and returning its description
+
+        Returns:
+            tuple: (status, run) where status is "started", "duplicate",
+                "in_progress" or "cooldown"
+        """
+        with self.lock:
+            self._refresh(client)
+            now = time.monotonic()
+            run = self._known_run(firing, now)
+
+            if run is not None:
+                status = "duplicate"
+            elif self.active is not None:
+                status, run = "in_progress", self.active
+            elif self.last_finished is not None and now - self.last_finished[1] < self.cooldown_seconds:
+                status, run = "cooldown", self.last_finished[0]
+            else:
+                status, run = "started", launch()
+                self.active = run
+                self._status_checked = time.monotonic()
+
+            # Only alerts that started a run are deduplicated against it
+            if status == "started":
+                for fingerprint in firing:
+                    self.fingerprints[fingerprint] = (run, now)
+            return status, run
+
+    def _known_run(self, firing, now):
+        """Return the run all firing alerts already started, forgetting expired fingerprints."""
+        self.fingerprints = {
+            fingerprint: entry for fingerprint, entry in self.fingerprints.items()
+            if now - entry[1] < self.dedup_seconds
+        }
+        if firing and all(fingerprint in self.fingerprints for fingerprint in firing):
+            return self.fingerprints[next(iter(firing))][0]
+        return None
+
+    def known_run(self, firing):
+        """
+        Return the run the firing alerts already started, or None.
+
+        Only looks at local state, so re-notifications can be answered
+        without queueing them or talking to KFP.
+        """
+        with self.lock:
+            return self._known_run(firing, time.monotonic())
+
+    def resolve(self, resolved):
+        """Forget resolved alerts, so they start a new run if they fire again."""
+        with self.lock:
+            for fingerprint in resolved:
+                self.fingerprints.pop(fingerprint, None)
+
+
+run_tracker = RunTracker(COOLDOWN_SECONDS, DEDUP_SECONDS, RUN_STATUS_CACHE_SECONDS)
+
+def start_pipeline_run(client):
+    """Start a retraining run for the next model version."""
+    experiment_id, pipeline_id, version_id = get_pipeline_target(client)
+
+    # Generate job name
+    job_name = f"grafana-alert-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+    # Reserve the next model version, never handed out twice
+    model_version = version_allocator.allocate(MODEL_NAME)
+    logger.info(f"Using model version: {model_version}")
+
+    # Prepare pipeline parameters
+    params = {
+        'hours_back': 5,
+        'model_version': f"{model_version}"
+    }
+
+    # Run the pipeline with detailed configuration
+    logger.info("Starting pipeline run")
+    try:
+        run = client.run_pipeline(
+            experiment_id=experiment_id,
+            pipeline_id=pipeline_id,
+            version_id=version_id,
+            job_name=job_name,
+            params=params
+        )
+    except Exception:
+        # The cached IDs may be stale, look them up again next time
+        global _pipeline_target
+        _pipeline_target = None
+        raise
+    logger.info(f"Successfully started pipeline run with ID: {run.run_id}")
+
+    return {
+        "run_id": run.run_id,
+        "job_name": job_name,
+        "experiment_id": experiment_id,
+        "model_version": model_version,
+        "started_at": datetime.now().isoformat(),
+    }
+
+ALERT_MESSAGES = {
+    "started": "Pipeline run started successfully",
+    "duplicate": "Alert already handled by an earlier pipeline run",
+    "in_progress": "A pipeline run is already in progress",
+    "cooldown": "A pipeline run finished recently, not starting another one",
+}
+
+def process_alert(job):
+    """Decide on and start the pipeline run for one queued alert notification."""
+    client = get_kfp_client()
+    status, run = run_tracker.handle(client, job["fingerprints"], lambda: start_pipeline_run(client))
+    if status != "started":
+        logger.info(f"{ALERT_MESSAGES[status]}: {run['run_id']}")
+    job.update({
+        "status": status,
+        "message": ALERT_MESSAGES[status],
+        "run_id": run["run_id"],
+        "job_name": run["job_name"],
+        "experiment_id": run["experiment_id"],
+        "model_version": run["model_version"],
+    })
+
+def alert_worker():
+    """Process queued alert notifications one at a time."""
+    while True:
+        job_id = alert_queue.get()
+        job = jobs.get(job_id)
+        queue_depth.set(alert_queue.qsize())
+        if job is None:
+            alert_queue.task_done()
+            continue
+        job["state"] = "processing"
+        start = time.monotonic()
+        try:
+            process_alert(job)
+            job["state"] = "done"
+            alerts_processed.labels(result=job["status"]).inc()
+        except Exception as e:
+            logger.error(f"Error processing alert {job_id}: {str(e)}")
+            import traceback
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            job.update({"state": "error", "status": "error", "message": str(e)})
+            alerts_processed.labels(result="error").inc()
+        finally:
+            job["finished_at"] = datetime.now().isoformat()
+            job_duration.observe(time.monotonic() - start)
+            alert_queue.task_done()
+
+def remember_job(job):
+    """Keep the job for /runs/<id>, forgetting the oldest ones beyond MAX_JOBS."""
+    with jobs_lock:
+        jobs[job["id"]] = job
+        while len(jobs) > MAX_JOBS:
+            jobs.popitem(last=False)
+
 @app.route('/webhook', methods=['POST'])
 def handle_alert():
     try:
@@ -53,84 +458,68 @@ def handle_alert():
         logger.debug("=== Headers ===")
         for header, value in request.headers:
             logger.debug(f"{header}: {value}")
-        
+
         logger.debug("=== Request Data ===")
         raw_data = request.get_data(as_text=True)
         logger.debug(f"Raw data: {raw_data}")
-        
+
         if request.is_json:
             alert_data = request.json
             logger.debug(f"JSON data: {json.dumps(alert_data, indent=2)}")
-            
-            # Initialize Model Registry
-            registry = get_model_registry()
-            
-            # Initialize KFP client
-            logger.info("Initializing KFP client")
-            client = kfp.Client()
-            client.set_user_namespace(namespace="kubeflow-user-example-com")
-            
-            # Get experiment ID
-            try:
-                experiment = client.get_experiment(experiment_name="mlops")
-                experiment_id = experiment.experiment_id
-                logger.info(f"Found experiment ID: {experiment_id}")
-            except Exception as e:
-                logger.error(f"Error getting experiment: {str(e)}")
-                raise
-            
-            # Get pipeline and version IDs
-            try:
-                pipelines = client.list_pipelines(namespace="kubeflow-user-example-com").pipelines
-                if not pipelines:
-                    raise ValueError("No pipelines found in namespace")
-                pipeline_id = pipelines[0].pipeline_id
-                
-                versions = client.list_pipeline_versions(pipeline_id=pipeline_id).pipeline_versions
-                if not versions:
-                    raise ValueError(f"No versions found for pipeline {pipeline_id}")
-                version_id = versions[-1].pipeline_version_id
-                
-                logger.info(f"Using pipeline ID: {pipeline_id}, version ID: {version_id}")
-            except Exception as e:
-                logger.error(f"Error getting pipeline/version info: {str(e)}")
-                raise
-            
-            # Generate job name
-            job_name = f"grafana-alert-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-            
-            # Get next model version
-            model_version = get_latest_model_version(registry, "cpu-usage-forecaster") + 1
-            logger.info(f"Using model version: {model_version}")
-
-            # Prepare pipeline parameters
-            params = {
-                'hours_back': 5,
-                'model_version': f"{model_version}"
+
+            firing, resolved = alert_fingerprints(alert_data)
+            run_tracker.resolve(resolved)
+            if not firing and (resolved or alert_data.get("status") == "resolved"):
+                return jsonify({
+                    "status": "resolved",
+                    "message": "No firing alerts, no pipeline run started",
+                    "timestamp": datetime.now().isoformat()
+                }), 200
+
+            # Re-notifications of alerts that already started a run are answered inline
+            run = run_tracker.known_run(firing)
+            if run is not None:
+                alerts_processed.labels(result="duplicate").inc()
+                return jsonify({
+                    "status": "duplicate",
+                    "message": ALERT_MESSAGES["duplicate"],
+                    "timestamp": datetime.now().isoformat(),
+                    "run_id": run["run_id"],
+                    "job_name": run["job_name"],
+                    "experiment_id": run["experiment_id"],
+                    "model_version": run["model_version"],
+                }), 200
+
+            # Talking to KFP happens on the workers, the sender gets its answer right away
+            job = {
+                "id": uuid.uuid4().hex,
+                "state": "queued",
+                "fingerprints": sorted(firing),
+                "received_at": datetime.now().isoformat(),
             }
+            remember_job(job)
+            try:
+                alert_queue.put_nowait(job["id"])
+            except queue.Full:
+                with jobs_lock:
+                    jobs.pop(job["id"], None)
+                alerts_rejected.inc()
+                logger.error(f"Alert queue is full ({ALERT_QUEUE_SIZE}), rejecting alert")
+                return jsonify({
+                    "status": "error",
+                    "message": "Alert queue is full, retry later"
+                }), 503, {"Retry-After": "30"}
+            queue_depth.set(alert_queue.qsize())
+            alerts_received.inc()
 
-            # Run the pipeline with detailed configuration
-            logger.info("Starting pipeline run")
-            run = client.run_pipeline(
-                experiment_id=experiment_id,
-                pipeline_id=pipeline_id,
-                version_id=version_id,
-                job_name=job_name,
-                params=params
-            )
-            
-            logger.info(f"Successfully started pipeline run with ID: {run.run_id}")
-            
             return jsonify({
-                "status": "success",
-                "message": "Pipeline run started successfully",
+                "status": "accepted",
+                "message": "Alert queued",
                 "timestamp": datetime.now().isoformat(),
-                "run_id": run.run_id,
-                "job_name": job_name,
-                "experiment_id": experiment_id,
-                "model_version": model_version
-            }), 200
-            
+                "id": job["id"],
+                "status_url": f"/runs/{job['id']}"
+            }), 202
+
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
         logger.error(f"Exception type: {type(e)}")
@@ -141,6 +530,35 @@ def handle_alert():
             "message": str(e)
         }), 500
 
+@app.route('/runs/<run_id>', methods=['GET'])
+def run_status(run_id):
+    """Status of a queued alert, looked up by its id or by the id of its pipeline run."""
+    with jobs_lock:
+        job = jobs.get(run_id) or next(
+            (job for job in reversed(jobs.values()) if job.get("run_id") == run_id), None
+        )
+        job = dict(job) if job is not None else None
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unknown id {run_id}"}), 404
+
+    if job.get("run_id"):
+        try:
+            job["run_state"] = str(get_kfp_client().get_run(job["run_id"]).state)
+        except Exception as e:
+            logger.warning(f"Could not get the state of run {job['run_id']}: {e}")
+    return jsonify(job), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
 if __name__ == '__main__':
+    try:
+        version_allocator.reconcile(MODEL_NAME)
+    except Exception as e:
+        # Retried before the first allocation
+        logger.error(f"Could not reconcile model versions with the registry: {str(e)}")
+    for i in range(ALERT_WORKERS):
+        threading.Thread(target=alert_worker, name=f"alert-worker-{i}", daemon=True).start()
     logger.info("Starting KFP webhook server on port 5000...")
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -1,9 +1,12 @@
-import pandas as pd
 import numpy as np
-from sklearn.metrics import r2_score, mean_squared_error
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime
 from prometheus_client import start_http_server, Gauge
 import time
+import os
+from metrics_store import MetricsStore, ChunkTailer
+from forecast_log import ForecastLog, ForecastTailer, FORECAST_DTYPE, dedupe_forecasts
+from instrumentation import Instrumentation
 
 # Initialize Prometheus metrics
 r2_metric = Gauge('model_r2_score', 'R-squared score of the model')
@@ -13,62 +16,407 @@ mse_metric = Gauge('model_mse', 'Mean squared error of the model')
 predicted_value = Gauge('predicted_value', 'Predicted value of the CPU usage')
 actual_value = Gauge('actual_value', 'Actual value of the CPU usage')
 
-def calculate_metrics(actual_data_path="/data/metrics.csv", pred_data_path="/data/predictions.csv", cutoff_time_hours=1):
+# Same metrics over every evaluation window
+window_r2_metric = Gauge('model_window_r2_score', 'R-squared score of the model per evaluation window', ['window'])
+window_rmse_metric = Gauge('model_window_rmse', 'Root mean squared error of the model per evaluation window', ['window'])
+window_mse_metric = Gauge('model_window_mse', 'Mean squared error of the model per evaluation window', ['window'])
+window_samples_metric = Gauge('model_window_samples', 'Number of evaluated minutes per evaluation window', ['window'])
+
+# Accuracy per forecast horizon bucket and model version, over the issues of the horizon window
+HORIZON_LABELS = ['horizon', 'model_version']
+horizon_mae_metric = Gauge('model_horizon_mae', 'Mean absolute error per forecast horizon and model version', HORIZON_LABELS)
+horizon_mape_metric = Gauge('model_horizon_mape', 'Mean absolute percentage error per forecast horizon and model version', HORIZON_LABELS)
+horizon_wape_metric = Gauge('model_horizon_wape', 'Weighted absolute percentage error (sum |error| / sum |actual|) per forecast horizon and model version', HORIZON_LABELS)
+horizon_bias_metric = Gauge('model_horizon_bias', 'Mean signed error (predicted - actual) per forecast horizon and model version', HORIZON_LABELS)
+horizon_rmse_metric = Gauge('model_horizon_rmse', 'Root mean squared error per forecast horizon and model version', HORIZON_LABELS)
+horizon_samples_metric = Gauge('model_horizon_samples', 'Number of evaluated forecast points per forecast horizon and model version', HORIZON_LABELS)
+latest_issue_mae_metric = Gauge('model_latest_issue_mae', 'Mean absolute error over all horizons of the newest fully evaluated forecast')
+
+# Horizon buckets in minutes ahead, both ends included
+HORIZON_BUCKETS = ((1, 5), (6, 15), (16, 30), (31, 60))
+
+# Latency, row and error metrics of the evaluation itself
+instrumentation = Instrumentation('model-metrics-exporter')
+
+store = MetricsStore(os.getenv("METRICS_STORE_PATH", "/data/metrics"))
+forecast_log = ForecastLog(os.getenv("FORECAST_LOG_PATH", "/data/forecasts"))
+
+
+class SlidingErrorWindow:
+    """Running sums of actual and predicted values over the last `minutes` minutes"""
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.points = deque()
+        self._reset_sums()
+        self._updates = 0
+
+    def _reset_sums(self):
+        self.n = 0
+        self.sum_y = 0.0
+        self.sum_y2 = 0.0
+        self.sum_pred = 0.0
+        self.sse = 0.0
+
+    def _accumulate(self, y, y_pred, sign):
+        self.n += sign
+        self.sum_y += sign * y
+        self.sum_y2 += sign * y * y
+        self.sum_pred += sign * y_pred
+        self.sse += sign * (y - y_pred) ** 2
+
+    def add(self, bucket, y, y_pred):
+        """Add one evaluated minute and drop the ones that left the window"""
+        self.points.append((bucket, y, y_pred))
+        self._accumulate(y, y_pred, 1)
+        while self.points and self.points[0][0] <= bucket - self.minutes:
+            _, old_y, old_pred = self.points.popleft()
+            self._accumulate(old_y, old_pred, -1)
+
+        # Rebuild the sums from scratch now and then so rounding errors of
+        # the add/subtract updates cannot pile up
+        self._updates += 1
+        if self._updates >= self.minutes:
+            self._updates = 0
+            self._reset_sums()
+            for _, old_y, old_pred in self.points:
+                self._accumulate(old_y, old_pred, 1)
+
+    def clear(self):
+        self.points.clear()
+        self._reset_sums()
+
+    def metrics(self):
+        """Return (r2, rmse, mse) of the window, or None if it is empty"""
+        if not self.n:
+            return None
+        mse = max(self.sse, 0.0) / self.n
+        sst = self.sum_y2 - self.sum_y ** 2 / self.n
+        r2 = 1 - self.sse / sst if sst > 0 else float('nan')
+        return r2, np.sqrt(mse), mse
+
+
+class StreamingEvaluator:
+    """
+    Join actual minutes with their forecasts as both arrive.
+
+    Actual samples are tailed from the metrics store and averaged per
+    minute; a minute is evaluated once a sample from a later minute shows
+    up. Forecasts are tailed from the forecast log and only the newest one
+    per future minute is kept. Every update costs O(new points), apart from
+    merging a compacted forecast file back in once per compaction, and
+    memory is bounded by the longest window.
+    """
+
+    def __init__(self, store, forecast_log, series="cpu_usage", windows_minutes=(60, 360, 1440),
+                 horizon_window_minutes=360):
+        self.series = series
+        self.horizon_window_minutes = horizon_window_minutes
+        self.windows = {minutes: SlidingErrorWindow(minutes) for minutes in windows_minutes}
+        self.max_minutes = max(windows_minutes)
+        self.actuals = ChunkTailer(store, series, lookback_seconds=(self.max_minutes + 1) * 60)
+        self.forecasts = ForecastTailer(forecast_log, series)
+        self.pending = {}  # minute -> [sum, count] of minutes still being filled
+        self.forecast_by_minute = {}  # target minute -> (issue time, value)
+        self.last_evaluated = None
+        self.last_point = None
+        # Every horizon of the recent issues and the actual mean of the recent
+        # minutes, for the per-horizon metrics
+        self.issues = np.empty(0, dtype=FORECAST_DTYPE)
+        self.minute_actuals = {}
+
+    def _add_forecasts(self, records):
+        records = records[records['issue_time'] < records['target_time']]
+        if not len(records):
+            return
+        # New issues are usually later than every buffered one and can simply
+        # be appended; only re-read compacted files overlap the buffer
+        new_issues = dedupe_forecasts(records)
+        if not len(self.issues) or new_issues['issue_time'][0] > self.issues['issue_time'][-1]:
+            self.issues = np.concatenate([self.issues, new_issues])
+        else:
+            self.issues = dedupe_forecasts(np.concatenate([self.issues, new_issues]))
+        # Newest issue per target minute within the batch
+        order = np.lexsort((records['issue_time'], records['target_time']))
+        records = records[order]
+        last = np.ones(len(records), dtype=bool)
+        last[:-1] = records['target_time'][1:] != records['target_time'][:-1]
+        for issue_time, target_time, value in zip(
+            records['issue_time'][last], records['target_time'][last], records['value'][last]
+        ):
+            minute = int(target_time // 60)
+            known = self.forecast_by_minute.get(minute)
+            if known is None or issue_time >= known[0]:
+                self.forecast_by_minute[minute] = (issue_time, value)
+
+    def _add_actuals(self, timestamps, values):
+        minutes = (timestamps // 60).astype(np.int64)
+        unique, inverse = np.unique(minutes, return_inverse=True)
+        sums = np.bincount(inverse, weights=values)
+        counts = np.bincount(inverse)
+        for minute, total, count in zip(unique.tolist(), sums, counts):
+            if self.last_evaluated is not None and minute <= self.last_evaluated:
+                continue
+            entry = self.pending.setdefault(minute, [0.0, 0])
+            entry[0] += total
+            entry[1] += count
+
+    def update(self):
+        """
+        Consume new actuals and forecasts and evaluate completed minutes.
+
+        Returns:
+            int: Number of minutes evaluated by this update
+        """
+        timestamps, values, reset = self.actuals.read_new()
+        if reset:
+            for window in self.windows.values():
+                window.clear()
+            self.pending = {}
+            self.minute_actuals = {}
+            self.last_evaluated = None
+
+        # Forecasts for minutes that are already evaluated are never read again
+        min_issue_time = None
+        if len(timestamps):
+            min_issue_time = timestamps.min() - self.forecasts.log.max_horizon
+        elif self.last_evaluated is not None:
+            min_issue_time = (self.last_evaluated + 1) * 60 - self.forecasts.log.max_horizon
+        self._add_forecasts(self.forecasts.read_new(min_issue_time))
+        if len(timestamps):
+            self._add_actuals(timestamps, values)
+
+        # All but the newest minute are complete
+        if not self.pending:
+            return 0
+        newest = max(self.pending)
+        evaluated = 0
+        for minute in sorted(m for m in self.pending if m < newest):
+            total, count = self.pending.pop(minute)
+            self.minute_actuals[minute] = total / count
+            forecast = self.forecast_by_minute.pop(minute, None)
+            self.last_evaluated = minute
+            if forecast is None:
+                continue
+            y, y_pred = total / count, forecast[1]
+            for window in self.windows.values():
+                window.add(minute, y, y_pred)
+            self.last_point = (minute, y, y_pred)
+            evaluated += 1
+
+        # Forecasts for minutes that are already evaluated will never be used
+        if self.last_evaluated is not None:
+            for minute in [m for m in self.forecast_by_minute if m <= self.last_evaluated]:
+                del self.forecast_by_minute[minute]
+            self._prune_issues()
+        return evaluated
+
+    def _prune_issues(self):
+        """Forget issues older than the horizon window and actuals no issue of it targets"""
+        oldest_issue = (self.last_evaluated - self.horizon_window_minutes) * 60
+        self.issues = self.issues[self.issues['issue_time'] >= oldest_issue]
+        oldest_minute = int(oldest_issue // 60)
+        for minute in [m for m in self.minute_actuals if m <= oldest_minute]:
+            del self.minute_actuals[minute]
+
+    def horizon_matrix(self):
+        """
+        Arrange the recent forecasts as an (issue_time x horizon) matrix.
+
+        Returns:
+            tuple: (issue_times, model_versions, predicted, actual) where
+                predicted and actual have shape (issues, horizon steps) and
+                hold NaN where there is no forecast or no actual yet
+        """
+        steps = int(self.forecasts.log.max_horizon // 60)
+        records = self.issues
+        issue_times, rows = np.unique(records['issue_time'], return_inverse=True)
+        cols = np.rint((records['target_time'] - records['issue_time']) / 60).astype(np.int64) - 1
+        valid = (cols >= 0) & (cols < steps)
+        rows, cols, records = rows[valid], cols[valid], records[valid]
+
+        predicted = np.full((len(issue_times), steps), np.nan)
+        predicted[rows, cols] = records['value']
+        target_minutes = np.full((len(issue_times), steps), -1, dtype=np.int64)
+        target_minutes[rows, cols] = (records['target_time'] // 60).astype(np.int64)
+        model_versions = np.full(len(issue_times), -1, dtype=np.int64)
+        model_versions[rows] = records['model_version']
+
+        actual = np.full(predicted.shape, np.nan)
+        if self.minute_actuals:
+            minutes = np.fromiter(self.minute_actuals.keys(), dtype=np.int64, count=len(self.minute_actuals))
+            means = np.fromiter(self.minute_actuals.values(), dtype=float, count=len(self.minute_actuals))
+            order = np.argsort(minutes)
+            minutes, means = minutes[order], means[order]
+            positions = np.clip(np.searchsorted(minutes, target_minutes), 0, len(minutes) - 1)
+            found = minutes[positions] == target_minutes
+            actual[found] = means[positions[found]]
+        return issue_times, model_versions, predicted, actual
+
+
+def window_label(minutes):
+    return f"{minutes // 60}h" if minutes % 60 == 0 else f"{minutes}m"
+
+
+def horizon_label(first, last):
+    return f"{first}-{last}m"
+
+
+def horizon_metrics(model_versions, predicted, actual):
+    """
+    Compute MAE, MAPE, WAPE, bias and RMSE per (model version, horizon bucket).
+
+    Every point of the (issue_time x horizon) matrix is assigned a group id
+    from its row's model version and its column's bucket, and the error
+    sums of all groups are accumulated with one bincount each. MAPE blows
+    up on minutes of near-zero usage, WAPE divides by the summed actuals
+    instead and is the one to alert on.
+
+    Returns:
+        dict: (horizon label, model version) -> dict of metrics
+    """
+    steps = predicted.shape[1]
+    bucket_of_step = np.full(steps, -1, dtype=np.int64)
+    for index, (first, last) in enumerate(HORIZON_BUCKETS):
+        bucket_of_step[first - 1:min(last, steps)] = index
+    versions, version_index = np.unique(model_versions, return_inverse=True)
+
+    groups = version_index[:, None] * len(HORIZON_BUCKETS) + bucket_of_step[None, :]
+    errors = predicted - actual
+    mask = ~np.isnan(errors) & (bucket_of_step[None, :] >= 0)
+    groups, errors, actual = groups[mask], errors[mask], actual[mask]
+    size = len(versions) * len(HORIZON_BUCKETS)
+
+    counts = np.bincount(groups, minlength=size)
+    abs_sum = np.bincount(groups, weights=np.abs(errors), minlength=size)
+    err_sum = np.bincount(groups, weights=errors, minlength=size)
+    sq_sum = np.bincount(groups, weights=errors ** 2, minlength=size)
+    actual_sum = np.bincount(groups, weights=np.abs(actual), minlength=size)
+    # Percentage errors are undefined where the actual value is zero
+    nonzero = actual != 0
+    pct_counts = np.bincount(groups[nonzero], minlength=size)
+    pct_sum = np.bincount(groups[nonzero], weights=np.abs(errors[nonzero] / actual[nonzero]), minlength=size)
+
+    results = {}
+    for group in np.flatnonzero(counts):
+        version, bucket = divmod(int(group), len(HORIZON_BUCKETS))
+        n = counts[group]
+        results[(horizon_label(*HORIZON_BUCKETS[bucket]), str(versions[version]))] = {
+            "mae": abs_sum[group] / n,
+            "mape": pct_sum[group] / pct_counts[group] if pct_counts[group] else float('nan'),
+            "wape": abs_sum[group] / actual_sum[group] if actual_sum[group] else float('nan'),
+            "bias": err_sum[group] / n,
+            "rmse": np.sqrt(sq_sum[group] / n),
+            "samples": n,
+        }
+    return results
+
+
+def update_horizon_metrics(evaluator, exported):
+    """
+    Publish the per-horizon metrics and drop label sets that disappeared.
+
+    Args:
+        evaluator: StreamingEvaluator to read the forecast matrix from
+        exported: Set of label tuples published by the previous call, updated in place
+    """
+    _, model_versions, predicted, actual = evaluator.horizon_matrix()
+    results = horizon_metrics(model_versions, predicted, actual)
+    gauges = {
+        "mae": horizon_mae_metric,
+        "mape": horizon_mape_metric,
+        "wape": horizon_wape_metric,
+        "bias": horizon_bias_metric,
+        "rmse": horizon_rmse_metric,
+        "samples": horizon_samples_metric,
+    }
+    for labels, values in results.items():
+        for name, gauge in gauges.items():
+            gauge.labels(*labels).set(values[name])
+    for labels in exported - set(results):
+        for gauge in gauges.values():
+            gauge.remove(*labels)
+    exported.clear()
+    exported.update(results)
+
+    # Newest issue whose horizons have all been evaluated
+    complete = ~np.isnan(actual).any(axis=1) & ~np.isnan(predicted).any(axis=1)
+    if complete.any():
+        row = np.flatnonzero(complete)[-1]
+        latest_issue_mae_metric.set(np.mean(np.abs(predicted[row] - actual[row])))
+
+    for (horizon, version), values in results.items():
+        print(f"Horizon {horizon} (model {version}): MAE {values['mae']:.4f}, "
+              f"MAPE {values['mape']:.4f}, WAPE {values['wape']:.4f}, bias {values['bias']:.4f}")
+
+
+def calculate_metrics(evaluator, exported_horizons):
+    start = time.perf_counter()
     try:
-        # Read and process data
-        actual_df = pd.read_csv(actual_data_path, parse_dates=["timestamp"], index_col="timestamp")
-        pred_df = pd.read_csv(pred_data_path, parse_dates=["timestamp"], index_col="timestamp")
-        
-        # Resample actual data to 1-minute intervals
-        actual_df = actual_df.resample("1min").mean()
-        
-        # Calculate time window
-        max_time = actual_df.index.max()
-        cutoff_time = max_time - timedelta(hours=cutoff_time_hours)
-        
-        # Filter data for the last hour
-        actual_df = actual_df[actual_df.index > cutoff_time]
-        pred_df = pred_df[(max_time >= pred_df.index) & (pred_df.index > cutoff_time)]
-        
-        # Extract values for comparison
-        y_true = actual_df["cpu_usage"]
-        y_pred = pred_df["predicted_cpu_usage"]
-        
-        
-        # Calculate metrics
-        r2 = r2_score(y_true, y_pred)
-        rmse = np.sqrt(mean_squared_error(y_true, y_pred))
-        mse = mean_squared_error(y_true, y_pred)
-        
-        actual_cpu = actual_df[actual_df.index == max_time]["cpu_usage"].iloc[0]
-        actual_pred = pred_df[pred_df.index == max_time]["predicted_cpu_usage"].iloc[0]
-        
+        with instrumentation.timer('evaluator_update'):
+            evaluated = evaluator.update()
+        instrumentation.count('evaluator_update', evaluated)
+        if evaluator.last_point is None:
+            raise ValueError(f"No evaluated minutes for series {evaluator.series} yet")
+
+        for minutes, window in evaluator.windows.items():
+            result = window.metrics()
+            if result is None:
+                continue
+            r2, rmse, mse = result
+            label = window_label(minutes)
+            window_r2_metric.labels(window=label).set(r2)
+            window_rmse_metric.labels(window=label).set(rmse)
+            window_mse_metric.labels(window=label).set(mse)
+            window_samples_metric.labels(window=label).set(window.n)
+
+        # The unlabeled metrics keep covering the last hour, as alerts rely on them
+        r2, rmse, mse = evaluator.windows[60].metrics()
+        _, actual_cpu, actual_pred = evaluator.last_point
+
         # Update Prometheus metrics
         r2_metric.set(r2)
         rmse_metric.set(rmse)
         mse_metric.set(mse)
         predicted_value.set(actual_pred)
         actual_value.set(actual_cpu)
-        
-        print(f"Metrics updated at {datetime.now()}")
+
+        print(f"Metrics updated at {datetime.now()} ({evaluated} new minutes)")
         print(f"R2: {r2:.4f}")
         print(f"RMSE: {rmse:.4f}")
         print(f"MSE: {mse:.4f}")
         print(f"Actual CPU usage: {actual_cpu:.4f}")
         print(f"Predicted CPU usage: {actual_pred:.4f}")
+        with instrumentation.timer('update_horizon_metrics'):
+            update_horizon_metrics(evaluator, exported_horizons)
         print("-" * 50)
-        
+
     except Exception as e:
+        instrumentation.error('calculate_metrics')
         print(f"Error occurred: {e}")
+    instrumentation.observe('calculate_metrics', time.perf_counter() - start)
 
 def main():
     # Start up the server to expose metrics
     start_http_server(8000)
     print("Metrics server started at port 8000")
-    
+
+    # The 1h window always runs since it backs the unlabeled metrics
+    windows = {int(minutes) for minutes in os.getenv("EVALUATION_WINDOWS", "60,360,1440").split(",")}
+    windows = sorted(windows | {60})
+    evaluator = StreamingEvaluator(
+        store, forecast_log, windows_minutes=windows,
+        horizon_window_minutes=int(os.getenv("HORIZON_EVALUATION_WINDOW", 360))
+    )
+    exported_horizons = set()
+    next_due = time.monotonic()
+
     while True:
-        calculate_metrics()
-        time.sleep(60)  # Wait 5 minutes before next update
+        iteration_start = time.monotonic()
+        instrumentation.lag('update', max(iteration_start - next_due, 0.0))
+        next_due = iteration_start + 60
+        calculate_metrics(evaluator, exported_horizons)
+        time.sleep(60)  # Wait 1 minute before next update
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
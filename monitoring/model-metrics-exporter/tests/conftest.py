@@ -0,0 +1,29 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+EXPORTER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXPORTER_PATH = os.path.join(EXPORTER_DIR, 'model-metrics-exporter.py')
+
+# The exporter imports the common modules as top-level modules, from /code
+sys.path.insert(0, os.path.join(EXPORTER_DIR, '..', '..', 'cpu-usage', 'common'))
+
+
+@pytest.fixture(scope='session')
+def exporter(tmp_path_factory):
+    # Loaded once, its Prometheus metrics can only be registered once per
+    # process; the module-level store and forecast log point at a tmp dir
+    data = tmp_path_factory.mktemp('data')
+    environ = dict(os.environ)
+    os.environ['METRICS_STORE_PATH'] = str(data / 'metrics')
+    os.environ['FORECAST_LOG_PATH'] = str(data / 'forecasts')
+    try:
+        spec = importlib.util.spec_from_file_location('model_metrics_exporter', EXPORTER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+    return module
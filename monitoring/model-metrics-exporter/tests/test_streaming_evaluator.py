@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from forecast_log import ForecastLog
+from metrics_store import MetricsStore
+
+HOUR = 1_700_000_000 // 3600 * 3600
+MINUTE = HOUR // 60
+
+
+def direct_metrics(y, y_pred):
+    y, y_pred = np.asarray(y), np.asarray(y_pred)
+    mse = np.mean((y - y_pred) ** 2)
+    r2 = 1 - np.sum((y - y_pred) ** 2) / np.sum((y - y.mean()) ** 2)
+    return r2, np.sqrt(mse), mse
+
+
+def test_sliding_error_window_matches_direct_metrics(exporter):
+    window = exporter.SlidingErrorWindow(minutes=30)
+    assert window.metrics() is None
+
+    rng = np.random.default_rng(0)
+    y, y_pred = rng.random(200) * 100, rng.random(200) * 100
+    # Every other minute is missing, the window spans 30 minutes, not 30 points
+    minutes = np.arange(200) * 2
+    for i, minute in enumerate(minutes):
+        window.add(minute, y[i], y_pred[i])
+        inside = (minutes > minute - 30) & (minutes <= minute)
+        if i:
+            np.testing.assert_allclose(window.metrics(), direct_metrics(y[inside], y_pred[inside]))
+    assert len(window.points) == 15
+
+    window.clear()
+    assert window.metrics() is None
+
+
+@pytest.fixture
+def evaluator(exporter, tmp_path):
+    store = MetricsStore(str(tmp_path / 'metrics'))
+    log = ForecastLog(str(tmp_path / 'forecasts'))
+    return exporter.StreamingEvaluator(store, log, windows_minutes=(5, 60), horizon_window_minutes=60)
+
+
+def add_actuals(evaluator, first_minute, last_minute):
+    """Four samples per minute, minute k of the hour valued 2k"""
+    timestamps = np.arange((MINUTE + first_minute) * 60, (MINUTE + last_minute + 1) * 60, 15, dtype=np.float64)
+    evaluator.actuals.store.append_many('cpu_usage', timestamps, 2 * (timestamps // 60 - MINUTE))
+
+
+def test_streaming_evaluator_joins_actuals_with_forecasts(evaluator):
+    # One issue at HOUR forecasting k for the minute k minutes ahead
+    evaluator.forecasts.log.append('cpu_usage', HOUR, HOUR + 60 * np.arange(1, 61), np.arange(1.0, 61.0), 3)
+    add_actuals(evaluator, 0, 10)
+
+    # Minute 10 is still being filled, minute 0 has no forecast
+    assert evaluator.update() == 9
+    assert evaluator.last_evaluated == MINUTE + 9
+    assert evaluator.last_point == (MINUTE + 9, 18.0, 9.0)
+    minutes = np.arange(1, 10)
+    np.testing.assert_allclose(evaluator.windows[60].metrics(), direct_metrics(2.0 * minutes, minutes))
+    np.testing.assert_allclose(evaluator.windows[5].metrics(), direct_metrics(2.0 * minutes[-5:], minutes[-5:]))
+
+    # Only the new minutes are evaluated on the next update
+    assert evaluator.update() == 0
+    add_actuals(evaluator, 11, 12)
+    assert evaluator.update() == 2
+    assert evaluator.last_point == (MINUTE + 11, 22.0, 11.0)
+
+    issue_times, model_versions, predicted, actual = evaluator.horizon_matrix()
+    np.testing.assert_array_equal(issue_times, [HOUR])
+    np.testing.assert_array_equal(model_versions, [3])
+    np.testing.assert_array_equal(predicted[0], np.arange(1.0, 61.0))
+    np.testing.assert_array_equal(actual[0, :11], 2.0 * np.arange(1, 12))
+    assert np.isnan(actual[0, 11:]).all()
+
+
+def test_horizon_metrics_match_direct_computation(exporter):
+    rng = np.random.default_rng(1)
+    predicted = rng.random((6, 60)) * 10
+    actual = rng.random((6, 60)) * 10
+    actual[rng.random(actual.shape) < 0.2] = np.nan
+    actual[0, :5] = 0.0
+    model_versions = np.array([1, 1, 2, 2, 2, -1])
+
+    results = exporter.horizon_metrics(model_versions, predicted, actual)
+
+    assert len(results) == 3 * len(exporter.HORIZON_BUCKETS)
+    for (first, last) in exporter.HORIZON_BUCKETS:
+        for version in (1, 2, -1):
+            p = predicted[model_versions == version, first - 1:last].ravel()
+            a = actual[model_versions == version, first - 1:last].ravel()
+            p, a = p[~np.isnan(a)], a[~np.isnan(a)]
+            errors = p - a
+            nonzero = a != 0
+            metrics = results[(exporter.horizon_label(first, last), str(version))]
+            assert metrics['samples'] == len(a)
+            assert metrics['mae'] == pytest.approx(np.mean(np.abs(errors)))
+            assert metrics['mape'] == pytest.approx(np.mean(np.abs(errors[nonzero] / a[nonzero])))
+            assert metrics['wape'] == pytest.approx(np.sum(np.abs(errors)) / np.sum(np.abs(a)))
+            assert metrics['bias'] == pytest.approx(np.mean(errors))
+            assert metrics['rmse'] == pytest.approx(np.sqrt(np.mean(errors ** 2)))
+
+
+def test_horizon_metrics_skip_groups_without_actuals(exporter):
+    predicted = np.ones((1, 60))
+    actual = np.full((1, 60), np.nan)
+    actual[0, :3] = 0.0
+
+    results = exporter.horizon_metrics(np.array([4]), predicted, actual)
+
+    # Only the first bucket has actuals; all of them are zero
+    assert list(results) == [(exporter.horizon_label(1, 5), '4')]
+    metrics = results[(exporter.horizon_label(1, 5), '4')]
+    assert metrics['samples'] == 3 and metrics['mae'] == 1.0
+    assert np.isnan(metrics['mape']) and np.isnan(metrics['wape'])